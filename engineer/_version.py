@@ -0,0 +1,13 @@
+# coding=utf-8
+import time
+from datetime import date
+from propane_distribution import version_class
+
+# This file is originally generated from Git information by running 'setup.py
+# version'. Distributions contain a pre-generated copy of this file.
+
+__version__ = '0.0.1'
+__date__ = date(2026, 10, 18)
+__time__ = time.gmtime(1792341734.55)
+
+version = version_class(__version__, __date__, __time__)
@@ -0,0 +1,452 @@
+# coding=utf-8
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import posixpath
+import re
+import time
+from io import BytesIO
+
+from path import path
+
+from engineer import version
+from engineer.conf import settings
+from engineer.processors import less_dependencies
+from engineer.util import compress, relpath
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(kind, data):
+    """
+    Returns a key for caching the result of processing *data*, a byte string, in the way described by *kind*. Keys
+    depend only on the content, not on the path of the file it came from, so identical files share cached results.
+    """
+    h = hashlib.sha256()
+    h.update('%s:%s:' % (version, kind))
+    h.update(data)
+    return h.hexdigest()
+
+
+class AssetFingerprints(object):
+    """
+    Computes content-based 'fingerprinted' names for static assets in the output cache, e.g.
+    ``stylesheets/site.3f2a9c01de.css`` for ``stylesheets/site.css``. Since the name changes whenever the content
+    does, fingerprinted assets can be served with long-lived cache headers.
+
+    A fingerprint is computed from the asset as it is when pages are rendered, i.e. before it's minified. CSS files
+    generated from a LESS file next to them are fingerprinted using the LESS file and everything it imports, since they
+    might not have been generated yet.
+
+    Templates request fingerprinted names using :meth:`request`. Requests are recorded as side effects of the page
+    being rendered, so that pages are rendered again if an asset they use changes; see
+    :meth:`~engineer.dependencies.DependencyGraph.is_current`. The fingerprinted copies of the requested assets are
+    written by :func:`write_fingerprinted_assets`.
+    """
+    length = 10
+
+    def __init__(self, root):
+        self.root = path(root)
+        self.reset()
+
+    def reset(self):
+        """Forgets the fingerprints computed and the assets requested in the current build."""
+        self._fingerprints = {}
+        self._originals = {}
+        self.requested = {}
+
+    def key(self, the_file):
+        return unicode(self.root.relpathto(path(the_file).abspath())).replace('\\', '/')
+
+    def fingerprint(self, key):
+        """Returns the fingerprint of the asset with the given *key*, or ``None`` if the asset doesn't exist."""
+        if key not in self._fingerprints:
+            source = self.root / key
+            less_file = path(source[:-4] + '.less')
+            if source.ext == '.css' and less_file.isfile():
+                data = self._less_graph(less_file)
+            elif source.isfile():
+                data = settings.OUTPUT_MANIFEST.content(source)
+            else:
+                data = None
+            self._fingerprints[key] = None if data is None else content_key('fingerprint', data)[:self.length]
+        return self._fingerprints[key]
+
+    @staticmethod
+    def _less_graph(less_file):
+        # The content of a LESS file and of every file it imports, named relative to it so that fingerprints don't
+        # depend on where the output cache is
+        less_file = less_file.abspath()
+        parts = [less_file.bytes()]
+        for dependency in sorted(less_dependencies(less_file)):
+            name = less_file.dirname().relpathto(dependency).replace('\\', '/')
+            parts.append('%s:%s' % (name, dependency.read_hexhash('sha256') if dependency.isfile() else '-'))
+        return '\n'.join(parts)
+
+    @staticmethod
+    def fingerprinted_name(name, fingerprint):
+        """Returns the file name *name* with *fingerprint* inserted before its extension."""
+        base, ext = posixpath.splitext(name)
+        return '%s.%s%s' % (base, fingerprint, ext)
+
+    def request(self, the_file):
+        """
+        Returns the fingerprinted file name of the asset at *the_file*, and records that it's used by the page being
+        rendered. If the asset doesn't exist, its name is returned unchanged.
+        """
+        key = self.key(the_file)
+        fingerprint = self.fingerprint(key)
+        if fingerprint is None:
+            return path(the_file).name
+        if not settings.BUILD_DEPENDENCIES.record_side_effect('fingerprint', (key, fingerprint)):
+            self.requested[key] = fingerprint
+        name = self.fingerprinted_name(path(the_file).name, fingerprint)
+        self._originals[posixpath.join(posixpath.dirname(key), name)] = key
+        return name
+
+    def original(self, the_file):
+        """
+        Returns the path of the asset that *the_file* is a fingerprinted copy of, if its name was returned by
+        :meth:`request` in the current build, e.g. because a template linked to it using ``urlname('static')`` inside
+        a ``compress`` filter block. Otherwise *the_file* is returned unchanged.
+        """
+        try:
+            return self.root / self._originals[self.key(the_file)]
+        except KeyError:
+            return the_file
+
+
+def write_fingerprinted_assets(manifest, fingerprints):
+    """
+    Writes a fingerprinted copy of every asset requested from *fingerprints*, an :class:`AssetFingerprints`, in the
+    current build, along with an ``assets.json`` file in the root of the output cache that maps the assets' paths to
+    the paths of their fingerprinted copies. The copies are written through *manifest*, an
+    :class:`~engineer.cache.OutputManifest`, as files derived from the originals, so they're removed from the output
+    cache when they're no longer requested. Returns the mapping.
+    """
+    mapping = {}
+    for key, fingerprint in sorted(fingerprints.requested.items()):
+        the_file = fingerprints.root / key
+        if not the_file.isfile():
+            logger.warning("Couldn't fingerprint %s since it doesn't exist." % relpath(the_file))
+            continue
+        mapping[key] = posixpath.join(posixpath.dirname(key), fingerprints.fingerprinted_name(the_file.name,
+                                                                                              fingerprint))
+        manifest.write(fingerprints.root / mapping[key], the_file.bytes(), source=the_file)
+    if mapping:
+        # The asset map is derived from the output cache as a whole
+        manifest.write(fingerprints.root / 'assets.json', json.dumps(mapping, indent=2, sort_keys=True),
+                       source=fingerprints.root)
+        logger.info("Wrote %d fingerprinted assets." % len(mapping))
+    return mapping
+
+
+class AssetBundles(object):
+    """
+    Tracks the bundles requested by pages in the current build. A bundle is a single file made by concatenating the
+    CSS or JavaScript files linked in a ``compress`` filter block, in order. Bundles are named by a hash of the paths
+    and :class:`fingerprints <AssetFingerprints>` of the files in them, so a bundle's name changes whenever its content
+    does.
+
+    Like fingerprints, bundle requests are recorded as side effects of the page being rendered, and the bundles
+    themselves are written once per build by :func:`write_bundles`.
+    """
+    directory = 'bundles'
+
+    def __init__(self, root, fingerprints):
+        self.root = path(root)
+        self.fingerprints = fingerprints
+        self.reset()
+
+    def reset(self):
+        """Forgets the bundles requested in the current build."""
+        self.requested = {}
+
+    def bundle_key(self, compression_type, members):
+        """
+        Returns the path, relative to the output cache, of the bundle of *members*, a sequence of paths relative to
+        the output cache, or ``None`` if any of them doesn't exist.
+        """
+        fingerprints = [self.fingerprints.fingerprint(key) for key in members]
+        if None in fingerprints:
+            return None
+        name = content_key('bundle', repr(zip(members, fingerprints)))[:AssetFingerprints.length]
+        static_dir = self.root.relpathto(settings.OUTPUT_STATIC_DIR).replace('\\', '/')
+        return posixpath.join(static_dir, self.directory, '%s.%s' % (name, compression_type))
+
+    def request(self, compression_type, files):
+        """
+        Returns the path, relative to the output cache, of the bundle of *files*, and records that it's used by the
+        page being rendered. Returns ``None`` if the files can't be bundled.
+        """
+        members = tuple(self.fingerprints.key(the_file) for the_file in files)
+        key = self.bundle_key(compression_type, members)
+        if key is None:
+            return None
+        if not settings.BUILD_DEPENDENCIES.record_side_effect('bundle', (key, compression_type, members)):
+            self.requested[key] = compression_type, members
+        return key
+
+
+# Matches the URLs a stylesheet refers to in url() values and @import rules
+_css_url_pattern = re.compile(r"""(url\(\s*['"]?|@import\s+['"])([^'")\s]+)""")
+
+
+def rebase_css(css, source_key, target_key):
+    """
+    Rewrites the relative URLs in *css*, the content of the file at *source_key*, so that they still refer to the same
+    files when the CSS is moved to *target_key*. Both paths are relative to the output cache.
+    """
+    source_dir = posixpath.dirname(source_key)
+    target_dir = posixpath.dirname(target_key)
+    if source_dir == target_dir:
+        return css
+
+    def rebase(match):
+        url = match.group(2)
+        if url.startswith(('/', '#', 'data:')) or '://' in url:
+            return match.group(0)
+        return match.group(1) + posixpath.relpath(posixpath.normpath(posixpath.join(source_dir, url)), target_dir)
+
+    return _css_url_pattern.sub(rebase, css)
+
+
+def write_bundles(manifest, bundles, minify=True, workers=1):
+    """
+    Writes every bundle requested from *bundles*, an :class:`AssetBundles`, in the current build. Relative URLs in
+    bundled stylesheets are rebased onto the bundle's location. If *minify* is ``True``, bundles are minified using
+    :func:`minify_data`.
+
+    Bundles are written through *manifest*, an :class:`~engineer.cache.OutputManifest`, as files derived from the
+    output cache as a whole, so they're removed when they're no longer requested. Returns a dict mapping each bundle's
+    path relative to the output cache to a dict of statistics: its ``'members'`` and its ``'size'`` in bytes.
+    """
+    items = []
+    for key, (compression_type, members) in sorted(bundles.requested.items()):
+        parts = []
+        for member in members:
+            data = manifest.content(bundles.root / member)
+            if compression_type == 'css':
+                data = rebase_css(data, member, key)
+            parts.append(data)
+        # Scripts are separated by semicolons in case one of them doesn't end its last statement
+        items.append((key, ('\n' if compression_type == 'css' else ';\n').join(parts), compression_type))
+
+    if minify:
+        results, keys = minify_data([(data, compression_type) for key, data, compression_type in items], workers)
+        items = [(key, results[minified_key][1], compression_type)
+                 for (key, data, compression_type), minified_key in zip(items, keys)]
+
+    stats = {}
+    for key, data, compression_type in items:
+        manifest.write(bundles.root / key, data, source=bundles.root)
+        stats[key] = {
+            'members': list(bundles.requested[key][1]),
+            'size': len(data),
+        }
+    if stats:
+        logger.info("Wrote %d bundles of %d files." % (len(stats), sum(len(s['members']) for s in stats.values())))
+    return stats
+
+
+def _minify(item):
+    data, compression_type = item
+    start = time.time()
+    output = compress(data, compression_type)
+    return output, time.time() - start
+
+
+def minify_data(items, workers=1):
+    """
+    Minifies the byte strings in *items*, an iterable of ``(data, compression type)`` tuples, using the cache in
+    :attr:`~engineer.conf.EngineerConfiguration.ASSET_CACHE`. Data that isn't cached is minified using a pool of
+    *workers* processes if *workers* is more than one.
+
+    Returns a dict mapping the :func:`content key <content_key>` of each item to a tuple of ``(original size,
+    minified data, seconds spent minifying, whether it was cached)``, and a list of the items' keys in order.
+    """
+    cache = settings.ASSET_CACHE.namespace('MINIFIED')
+    keys = []
+    results = {}
+    to_minify = {}
+    for data, compression_type in items:
+        key = content_key(compression_type, data)
+        keys.append(key)
+        if key in results or key in to_minify:
+            continue
+        try:
+            results[key] = len(data), cache[key], 0.0, True
+        except KeyError:
+            to_minify[key] = data, compression_type
+
+    if to_minify:
+        items = sorted(to_minify.items())
+        if workers > 1 and len(items) > 1:
+            logger.info("Minifying %d files using %d worker processes." % (len(items), workers))
+            pool = multiprocessing.Pool(processes=min(workers, len(items)))
+            try:
+                minified = pool.map(_minify, [item for key, item in items])
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            minified = [_minify(item) for key, item in items]
+        for (key, (data, compression_type)), (output, seconds) in zip(items, minified):
+            cache[key] = output
+            results[key] = len(data), output, seconds, False
+    return results, keys
+
+
+def minify_assets(files, workers=1):
+    """
+    Minifies the CSS and JavaScript files in *files*, an iterable of ``(file path, compression type)`` tuples, in
+    place.
+
+    Minified output is cached in :attr:`~engineer.conf.EngineerConfiguration.ASSET_CACHE` by the hash of the original
+    content, so a file is only minified again if its content changes, and identical files in different places or
+    sites are only minified once. Files that aren't cached are minified using a pool of *workers* processes if
+    *workers* is more than one. Files are minified in place through
+    :attr:`~engineer.conf.EngineerConfiguration.OUTPUT_MANIFEST`, so a static file that's still minified from the same
+    source isn't read or written at all.
+
+    Returns a dict mapping each file's path relative to the output cache to a dict of statistics: its ``'original'``
+    and ``'minified'`` sizes in bytes, the ``'seconds'`` spent minifying it, and whether it was ``'cached'``.
+    """
+    manifest = settings.OUTPUT_MANIFEST
+    stats = {}
+    files = [(path(the_file), compression_type) for the_file, compression_type in sorted(files)]
+    to_minify = []
+    for the_file, compression_type in files:
+        if not manifest.is_recorded(the_file):
+            manifest.register(the_file)
+        if manifest.keep_processed(the_file, 'minify:%s' % compression_type):
+            original, minified = manifest.sizes(the_file)
+            stats[manifest.key(the_file)] = {
+                'original': original,
+                'minified': minified,
+                'seconds': 0.0,
+                'cached': True,
+            }
+        else:
+            to_minify.append((the_file, compression_type))
+    results, keys = minify_data([(manifest.content(the_file), compression_type)
+                                 for the_file, compression_type in to_minify], workers)
+
+    for (the_file, compression_type), key in zip(to_minify, keys):
+        original, output, seconds, cached = results[key]
+        manifest.process(the_file, output, 'minify:%s' % compression_type)
+        stats[manifest.key(the_file)] = {
+            'original': original,
+            'minified': len(output),
+            'seconds': seconds,
+            'cached': cached,
+        }
+        logger.debug("Minified %s: %d ==> %d bytes in %.3f seconds%s." % (relpath(the_file), original, len(output),
+                                                                          seconds, ' (cached)' if cached else ''))
+    if stats:
+        logger.info("Minified %d files (%d cached), saving %d bytes." % (
+            len(stats),
+            len([s for s in stats.values() if s['cached']]),
+            sum(s['original'] - s['minified'] for s in stats.values())))
+    return stats
+
+
+def gzip_bytes(data):
+    """Returns *data* compressed using gzip at the maximum compression level."""
+    output = BytesIO()
+    # The timestamp is fixed so that the compressed bytes only change when the content does
+    with gzip.GzipFile(filename='', mode='wb', fileobj=output, compresslevel=9, mtime=0) as the_file:
+        the_file.write(data)
+    return output.getvalue()
+
+
+def _gzip_file(the_file):
+    return gzip_bytes(path(the_file).bytes())
+
+
+def write_gzip_sidecars(manifest, extensions, min_size=0, workers=1):
+    """
+    Writes a gzipped copy of every file in the output cache with one of the given *extensions* that's at least
+    *min_size* bytes, next to the file with ``.gz`` appended to its name. Static web servers can serve these
+    'sidecars' directly to clients that accept gzipped content.
+
+    Only the files recorded in *manifest*, an :class:`~engineer.cache.OutputManifest`, in the current build are
+    considered. Sidecars are written through the manifest as files derived from their originals, so they're published
+    along with them, and removed when their originals are. Compressed bytes are cached in the site's
+    :attr:`~engineer.conf.EngineerConfiguration.CACHE` by the hash of the original content until that content is no
+    longer in the site; files that aren't cached are compressed using a pool of *workers* processes if *workers* is
+    more than one.
+
+    Returns a dict of statistics: the number of sidecars ``'written'``, left ``'unchanged'`` because they already had
+    the right content, and whose compressed bytes were ``'cached'``, and the ``'original'`` and ``'compressed'`` sizes
+    of the files in bytes.
+    """
+    cache = settings.CACHE.namespace('GZIPPED')
+    extensions = set('.%s' % e.lower().lstrip('.') for e in extensions)
+    originals = []
+    for key in manifest.recorded():
+        the_file = manifest.root / key
+        if the_file.ext.lower() in extensions and the_file.size >= min_size:
+            originals.append((the_file, content_key('gzip', manifest.checksum(the_file))))
+
+    results = {}
+    to_compress = {}
+    for the_file, key in originals:
+        if key in results or key in to_compress:
+            continue
+        try:
+            results[key] = cache[key]
+        except KeyError:
+            to_compress[key] = the_file
+
+    stats = {
+        'written': 0,
+        'unchanged': 0,
+        'cached': len(originals),
+        'original': 0,
+        'compressed': 0,
+    }
+    if to_compress:
+        items = sorted(to_compress.items())
+        if workers > 1 and len(items) > 1:
+            pool = multiprocessing.Pool(processes=min(workers, len(items)))
+            try:
+                compressed = pool.map(_gzip_file, [the_file for key, the_file in items])
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            compressed = [_gzip_file(the_file) for key, the_file in items]
+        for (key, the_file), output in zip(items, compressed):
+            cache[key] = output
+            results[key] = output
+        stats['cached'] -= len([the_file for the_file, key in originals if key in to_compress])
+
+    for the_file, key in originals:
+        output = results[key]
+        if manifest.write(the_file + '.gz', output, source=the_file):
+            stats['written'] += 1
+        else:
+            stats['unchanged'] += 1
+        stats['original'] += the_file.size
+        stats['compressed'] += len(output)
+
+    # Forget the compressed copies of content that's no longer in the site, so the cache doesn't grow with every change
+    used = set(key for the_file, key in originals)
+    for key in list(cache):
+        if key not in used:
+            del cache[key]
+    if originals:
+        logger.info("Wrote %(written)d gzipped files; %(unchanged)d were unchanged (%(cached)d cached). Compressed "
+                    "%(original)d bytes to %(compressed)d bytes." % stats)
+    return stats
@@ -1,59 +1,971 @@
 # coding=utf-8
+import Queue
+import collections
+import functools
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
 from path import path
 
+from engineer.util import transfer_file
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 __author__ = 'Tyler Butler <tyler@tylerbutler.com>'
 
+logger = logging.getLogger(__name__)
+
+# Files modified less than this many seconds before their stat signature is recorded are considered 'racy'
+_RACY_WINDOW = 2
+
+
+def stat_signature(the_path):
+    """
+    Returns a tuple of ``(mtime_ns, size, inode)`` for *the_path*. If any of these values differ between two calls,
+    the file has almost certainly changed.
+    """
+    st = os.stat(the_path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return mtime_ns, st.st_size, st.st_ino
+
+
+def _trusted_signature(signature):
+    # A file modified very recently could be modified again without its signature changing, so such 'racy'
+    # signatures aren't recorded. Files without a recorded signature are always validated using their checksum.
+    if time.time() - signature[0] / 1000000000.0 < _RACY_WINDOW:
+        return None
+    return signature
+
 
 class SimpleFileCache(object):
-    #noinspection PyUnusedLocal
-    def __init__(self, version=None, *args):
-        self._cache = {}
-        self._meta = {}
+    """
+    A cache of values associated with files. Cached values are only returned as long as the file they are associated
+    with hasn't changed.
+
+    Whether a file has changed is determined using its :attr:`validation` mode. In ``'stat'`` mode (the default),
+    the file's ``(mtime_ns, size, inode)`` signature is checked first and the file is only hashed if the signature
+    differs from the one recorded when the item was cached. In ``'checksum'`` mode, the file is always hashed.
+
+    If a :class:`SQLiteCacheStore` is passed in *store*, the cache's entries are kept in that store under
+    *namespace*, one row per file, and are only read from the store when they're needed. Values that have been read
+    or written are kept in memory, so reading an item twice returns the same object.
+
+    Store-backed caches can also defer loading the bulky parts of a value. If a value has a ``cache_split()``
+    method, it's called when the value is cached and should return a tuple of ``(record, body)``; the two are stored
+    separately. When the record is read back, its ``cache_attach(loader)`` method is called with a
+    :class:`CacheEntryLoader` that returns the body when called.
+    """
+    VALIDATION_MODES = ('stat', 'checksum')
+
+    def __init__(self, version=None, store=None, namespace=None):
+        if store is None:
+            self._cache = {}
+            self._meta = {}
+            self._body = None
+        else:
+            self._cache = store.namespace(namespace, 'value')
+            self._meta = store.namespace(namespace, 'meta')
+            self._body = store.namespace(namespace, 'body')
+        self._live = {}
         self._version = version
+        self.validation = 'stat'
+        self.reset_stats()
+
+        if store is None:
+            self.clear()
 
-        self.clear()
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Hit counts are only meaningful for a single build, so they aren't persisted.
+        del state['stats']
+        state['_live'] = {}
+        return state
 
-        if version is not None:
-            self._version = version
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('validation', 'stat')
+        self.__dict__.setdefault('_live', {})
+        self.reset_stats()
 
     def __getitem__(self, item):
-        return self._cache[item]
+        if item not in self._live:
+            value = self._cache[item]
+            if self._body is not None and hasattr(value, 'cache_attach'):
+                value.cache_attach(CacheEntryLoader(self._body, item))
+            self._live[item] = value
+        return self._live[item]
 
     def __setitem__(self, key, value):
         k = path(key)
         if k.exists():
             self._meta[key] = {
-                #                'mtime': key.mtime,
-                #                'size': key.size,
-                'checksum': key.read_hexhash('sha256')
+                'stat': _trusted_signature(stat_signature(k)),
+                'checksum': k.read_hexhash('sha256')
             }
         else:
             raise ValueError("File to be cached does not exist.")
 
-        self._cache[key] = value
+        if self._body is not None and hasattr(value, 'cache_split'):
+            record, body = value.cache_split()
+            self._cache[key] = record
+            self._body[key] = body
+        else:
+            self._cache[key] = value
+        self._live[key] = value
 
     def __delitem__(self, key):
         del self._meta[key]
         del self._cache[key]
+        if self._body is not None and key in self._body:
+            del self._body[key]
+        self._live.pop(key, None)
 
     def __contains__(self, item):
-        if item not in self._meta:
+        if item not in self._meta or item not in self._cache:
+            self.stats['miss'] += 1
+            return False
+
+        cache_entry = self._meta[item]
+        try:
+            signature = stat_signature(item)
+        except OSError:
+            self.stats['miss'] += 1
             return False
-        else:
-            cache_entry = self._meta[item]
-            #            if cache_entry['mtime'] != item.mtime:
-            #                return False
-            #            if cache_entry['size'] != item.size:
-            #                return False
-            if cache_entry['checksum'] != item.read_hexhash('sha256'):
-                return False
-            return item in self._cache
+
+        if self.validation == 'stat' and signature == cache_entry.get('stat'):
+            self.stats['stat'] += 1
+            return True
+
+        if cache_entry['checksum'] != path(item).read_hexhash('sha256'):
+            self.stats['miss'] += 1
+            return False
+
+        if self.validation == 'stat':
+            # The file was touched but its contents are the same, so record the new signature. The next check can
+            # then skip the hash.
+            cache_entry['stat'] = _trusted_signature(signature)
+            self._meta[item] = cache_entry
+        self.stats['checksum'] += 1
+        return True
 
     def __repr__(self):
         from pprint import pprint
 
         return pprint((self._meta, self._cache))
 
+    def reset_stats(self):
+        """Resets the hit counts in :attr:`stats`."""
+        self.stats = {
+            'stat': 0,  # validated using the stat signature alone
+            'checksum': 0,  # validated by hashing the file
+            'miss': 0,  # not cached or the file changed
+        }
+
     def clear(self):
         self._cache.clear()
         self._meta.clear()
+        self._live.clear()
+
+
+class CacheEntryLoader(object):
+    """
+    A callable that loads a single item from a :class:`CacheNamespace`. Loaders can be pickled, so values that hold
+    on to one can be sent to other processes.
+    """
+
+    def __init__(self, namespace, key):
+        self.namespace = namespace
+        self.key = key
+
+    def __call__(self):
+        return self.namespace[self.key]
+
+
+class SQLiteCacheStore(object):
+    """
+    A persistent cache stored in a SQLite database.
+
+    Every cached item is stored in its own row, keyed by a namespace and a key, so reading or writing an item doesn't
+    require reading or writing any others. Each row has ``value``, ``meta`` and ``body`` columns, which are read and
+    written independently. Values are pickled.
+
+    Writes happen in a single transaction that is committed when :meth:`sync` or :meth:`close` is called, so a build
+    that dies halfway through leaves the cache as it was before the build started.
+
+    The store can be used as a mapping directly; items set that way are kept in a namespace of their own. Unlike the
+    shelf the store replaces, changes to mutable values retrieved from the store are not written back automatically;
+    the value must be set again.
+    """
+    COLUMNS = ('value', 'meta', 'body')
+    _root_namespace = '__store__'
+
+    def __init__(self, filename):
+        self.filename = path(filename)
+        self.read_only = False
+        """If ``True``, connections opened by this process can't modify the database. Used in worker processes."""
+
+        self._connection = None
+        self._inherited_connection = None
+        self._pid = None
+        self._root = self.namespace(self._root_namespace)
+
+    def __getstate__(self):
+        # Connections can't be pickled; a copy of the store opens its own connection when it is first used.
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    @property
+    def connection(self):
+        # Connections can't be shared with forked worker processes, so each process opens its own.
+        if self._connection is None or self._pid != os.getpid():
+            if self._connection is not None:
+                # Closing a connection inherited from a parent process can interfere with the parent's use of the
+                # database, so it's kept open but never used.
+                self._inherited_connection = self._connection
+            self._connection = self._connect()
+            self._pid = os.getpid()
+            if self.read_only:
+                self._connection.execute('PRAGMA query_only = ON')
+        return self._connection
+
+    def _connect(self):
+        self.filename.dirname().makedirs_p()
+        connection = sqlite3.connect(self.filename)
+        try:
+            self._create_schema(connection)
+        except sqlite3.DatabaseError:
+            # Most likely a cache file from an older version of Engineer, which used a different format.
+            logger.warning("%s is not a valid cache database. Replacing it." % self.filename)
+            connection.close()
+            self.filename.remove_p()
+            connection = sqlite3.connect(self.filename)
+            self._create_schema(connection)
+        return connection
+
+    @staticmethod
+    def _create_schema(connection):
+        # Write-ahead logging lets worker processes read from the database while the main build process writes to it
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                           'namespace TEXT NOT NULL, '
+                           'key TEXT NOT NULL, '
+                           'value BLOB, '
+                           'meta BLOB, '
+                           'body BLOB, '
+                           'PRIMARY KEY (namespace, key))')
+        connection.commit()
+
+    def namespace(self, name, column='value'):
+        """Returns a :class:`CacheNamespace` mapping over *column* of the rows in namespace *name*."""
+        return CacheNamespace(self, name, column)
+
+    def get(self, namespace, key, column='value'):
+        """Returns the unpickled value of *column* for the given item. Raises :exc:`KeyError` if it isn't set."""
+        self._check_column(column)
+        row = self.connection.execute('SELECT %s FROM cache WHERE namespace=? AND key=?' % column,
+                                      (namespace, unicode(key))).fetchone()
+        if row is None or row[0] is None:
+            raise KeyError(key)
+        return pickle.loads(str(row[0]))
+
+    def set(self, namespace, key, value, column='value'):
+        """Sets *column* of the given item to *value*, leaving its other columns as they are."""
+        self._check_column(column)
+        key = unicode(key)
+        data = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.connection.execute('INSERT OR IGNORE INTO cache (namespace, key) VALUES (?, ?)', (namespace, key))
+        self.connection.execute('UPDATE cache SET %s=? WHERE namespace=? AND key=?' % column,
+                                (data, namespace, key))
+
+    def has(self, namespace, key, column='value'):
+        """Returns ``True`` if *column* of the given item is set."""
+        self._check_column(column)
+        row = self.connection.execute('SELECT 1 FROM cache WHERE namespace=? AND key=? AND %s IS NOT NULL' % column,
+                                      (namespace, unicode(key))).fetchone()
+        return row is not None
+
+    def delete(self, namespace, key, column=None):
+        """
+        Deletes *column* of the given item, or the whole item if *column* is ``None``. Raises :exc:`KeyError` if
+        there's nothing to delete.
+        """
+        if column is None:
+            cursor = self.connection.execute('DELETE FROM cache WHERE namespace=? AND key=?',
+                                             (namespace, unicode(key)))
+        else:
+            self._check_column(column)
+            cursor = self.connection.execute('UPDATE cache SET %(column)s=NULL '
+                                             'WHERE namespace=? AND key=? AND %(column)s IS NOT NULL' %
+                                             {'column': column}, (namespace, unicode(key)))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def keys(self, namespace, column='value'):
+        """Returns a list of the keys in *namespace* that have *column* set."""
+        self._check_column(column)
+        return [row[0] for row in
+                self.connection.execute('SELECT key FROM cache WHERE namespace=? AND %s IS NOT NULL ORDER BY key' %
+                                        column, (namespace,))]
+
+    def clear_namespace(self, namespace):
+        """Deletes every item in *namespace*."""
+        self.connection.execute('DELETE FROM cache WHERE namespace=?', (namespace,))
+
+    def sync(self):
+        """Commits all changes made since the last call to :meth:`sync`."""
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.commit()
+
+    def close(self):
+        """Commits any outstanding changes and closes the database. The store reopens it if it's used again."""
+        if self._connection is not None and self._pid == os.getpid():
+            try:
+                self._connection.commit()
+            except sqlite3.Error as e:
+                # The database may have been deleted out from under us, e.g. by 'engineer clean'.
+                logger.warning("Couldn't save the cache to %s: %s" % (self.filename, e))
+            self._connection.close()
+        self._connection = None
+
+    def _check_column(self, column):
+        if column not in self.COLUMNS:
+            raise ValueError("Unexpected cache column: %s" % column)
+
+    # Mapping interface over the store's own namespace
+    def __getitem__(self, key):
+        return self._root[key]
+
+    def __setitem__(self, key, value):
+        self._root[key] = value
+
+    def __delitem__(self, key):
+        del self._root[key]
+
+    def __contains__(self, key):
+        return key in self._root
+
+    def __len__(self):
+        return len(self._root)
+
+    def clear(self):
+        """Deletes everything in the store, including all namespaces."""
+        self.connection.execute('DELETE FROM cache')
+
+
+class CacheNamespace(collections.MutableMapping):
+    """A mapping over one column of the rows in a single namespace of a :class:`SQLiteCacheStore`."""
+
+    def __init__(self, store, name, column='value'):
+        self.store = store
+        self.name = name
+        self.column = column
+
+    def __getitem__(self, key):
+        return self.store.get(self.name, key, self.column)
+
+    def __setitem__(self, key, value):
+        self.store.set(self.name, key, value, self.column)
+
+    def __delitem__(self, key):
+        self.store.delete(self.name, key, self.column)
+
+    def __contains__(self, key):
+        return self.store.has(self.name, key, self.column)
+
+    def __iter__(self):
+        return iter(self.store.keys(self.name, self.column))
+
+    def __len__(self):
+        return len(self.store.keys(self.name, self.column))
+
+    def clear(self):
+        self.store.clear_namespace(self.name)
+
+
+class StagedFile(object):
+    """
+    A file written under a temporary name next to *output_path* from *chunks*, an iterable of byte strings, so that
+    it can be moved into place by :meth:`OutputManifest.write_staged`. The chunks are hashed as they're written, so
+    the whole content never has to be held in memory.
+
+    Staged files can be pickled, so they can be written by one process and moved into place by another.
+    """
+    _name_pattern = re.compile(r'^\..+\.\d+\.tmp$')
+
+    def __init__(self, output_path, chunks, make_directory=True):
+        self.output_path = path(output_path)
+        if make_directory:
+            self.output_path.dirname().makedirs_p()
+        self.path = self.output_path.dirname() / ('.%s.%d.tmp' % (self.output_path.name, os.getpid()))
+        h = hashlib.sha256()
+        self.size = 0
+        try:
+            with open(self.path, mode='wb') as the_file:
+                for chunk in chunks:
+                    h.update(chunk)
+                    self.size += len(chunk)
+                    the_file.write(chunk)
+        except:
+            self.discard()
+            raise
+        self.checksum = h.hexdigest()
+
+    def bytes(self):
+        """Returns the content of the staged file."""
+        return self.path.bytes()
+
+    def discard(self):
+        """Deletes the staged file."""
+        self.path.remove_p()
+
+    @classmethod
+    def is_staged(cls, the_path):
+        """``True`` if *the_path* looks like a staged file, e.g. one left behind by an interrupted build."""
+        return cls._name_pattern.match(path(the_path).name) is not None
+
+
+class OutputManifest(object):
+    """
+    Records the SHA-256 hash and size of every file in the output cache, keyed by the file's path relative to *root*.
+
+    Generated files are written through :meth:`write`, or :meth:`write_staged` if they were streamed to a
+    :class:`StagedFile`, neither of which touches the file on disk if its content hasn't changed. Static files are
+    copied into the output cache using :meth:`copy`, which only copies a file again if its source changes. Files put in
+    the output cache some other way are recorded using :meth:`register`.
+
+    Files that are processed in place, e.g. minified, are written with :meth:`process`, which records the hash of the
+    content they were processed from. A processed file isn't overwritten with the content it was processed from again,
+    so it's only processed again if that content changes; see :meth:`keep_processed` and :meth:`content`.
+
+    Files derived from other files in the output cache, such as gzipped copies, are written with the path of the file
+    they're derived from as their *source*. They're removed from the output cache if they aren't written again in a
+    build, e.g. because their source was deleted.
+
+    Along with its current hash, each entry holds the hash the file had when the output cache was last published to
+    the output directory. The files that need to be published are computed from those hashes by :meth:`changes`, so
+    determining what has changed doesn't require comparing the output cache with the output directory.
+    """
+
+    def __init__(self, store, root, namespace='OUTPUT_MANIFEST'):
+        self.root = path(root)
+        self._entries = store.namespace(namespace)
+        self.reset()
+
+    def reset(self):
+        """Forgets which files have been recorded in the current build and resets the counts in :attr:`stats`."""
+        self._seen = set()
+        # The unprocessed content of the processed files that were left in place rather than written or copied again,
+        # or None for copies; see restore_unprocessed
+        self._pending = {}
+        # Published files whose signature in the output directory needs to be recorded again
+        self._restat = set()
+        self.stats = {
+            'written': 0,  # written because the content changed
+            'unchanged': 0,  # not written since the content was the same as in the previous build
+        }
+
+    def key(self, output_path):
+        return unicode(self.root.relpathto(path(output_path).abspath())).replace('\\', '/')
+
+    def is_recorded(self, output_path):
+        """``True`` if *output_path* has been written or registered in the current build."""
+        return self.key(output_path) in self._seen
+
+    def recorded(self):
+        """Returns a sorted list of the keys of the files written or registered in the current build."""
+        return sorted(self._seen)
+
+    def checksum(self, output_path):
+        """Returns the recorded SHA-256 hash of *output_path*, or ``None`` if it hasn't been recorded."""
+        return self._entry(self.key(output_path))['hash']
+
+    def _entry(self, key):
+        try:
+            return self._entries[key]
+        except KeyError:
+            return {'hash': None, 'size': None, 'stat': None, 'published': None, 'published_stat': None,
+                    'source': None, 'origin': None, 'origin_stat': None, 'original': None, 'original_size': None,
+                    'processed': None}
+
+    def _matches(self, the_path, entry, checksum):
+        """``True`` if the file at *the_path* exists and has the given *checksum*, which *entry* was recorded with."""
+        try:
+            signature = stat_signature(the_path)
+        except OSError:
+            return False
+        if entry['hash'] != checksum or signature[1] != entry['size']:
+            return False
+        return signature == entry['stat'] or the_path.read_hexhash('sha256') == checksum
+
+    def write(self, output_path, data, source=None):
+        """
+        Writes the byte string *data* to *output_path* unless the file already has exactly that content. Returns
+        ``True`` if the file was written.
+
+        If the file was :meth:`processed <process>` from *data*, it's left as it is, and is restored by
+        :meth:`restore_unprocessed` unless it's processed again in the current build.
+
+        :param source: The path of the file in the output cache that the written file is derived from, if any.
+        """
+        output_path = path(output_path)
+        key, entry = self._begin_write(output_path, source, keep_processed=True)
+        checksum = hashlib.sha256(data).hexdigest()
+        if entry.get('processed') and checksum == entry['original'] and \
+                self._matches(output_path, entry, entry['hash']):
+            self._pending[key] = data
+            return self._end_write(key, entry, entry['hash'], entry['size'], False, None)
+        entry.update(original=None, processed=None)
+        return self._write_data(key, entry, output_path, data, checksum)
+
+    def _write_data(self, key, entry, output_path, data, checksum):
+        if self._matches(output_path, entry, checksum):
+            return self._end_write(key, entry, checksum, len(data), False, None)
+
+        output_path.dirname().makedirs_p()
+        # The file is replaced rather than overwritten in case it's linked to a published copy
+        output_path.remove_p()
+        with open(output_path, mode='wb') as the_file:
+            the_file.write(data)
+        return self._end_write(key, entry, checksum, len(data), True,
+                               _trusted_signature(stat_signature(output_path)))
+
+    def copy(self, source, output_path):
+        """
+        Copies the file *source*, which is outside the output cache, to *output_path* unless it's already a copy of
+        *source* as it is now. *source* is only hashed if its stat signature differs from the one recorded when it was
+        last copied. Returns ``True`` if the file was copied.
+
+        If the file was :meth:`processed <process>` from *source* as it is now, it's left as it is, and is restored by
+        :meth:`restore_unprocessed` unless it's processed again in the current build.
+        """
+        source = path(source).abspath()
+        output_path = path(output_path)
+        key, entry = self._begin_write(output_path, None, origin=source, keep_processed=True)
+        signature = stat_signature(source)
+        if entry.get('origin_stat') == signature:
+            checksum = entry['original'] if entry.get('processed') else entry['hash']
+        else:
+            checksum = source.read_hexhash('sha256')
+        entry['origin_stat'] = _trusted_signature(signature)
+        if entry.get('processed') and checksum == entry['original'] and \
+                self._matches(output_path, entry, entry['hash']):
+            self._pending[key] = None
+            self._entries[key] = entry
+            return self._end_write(key, entry, entry['hash'], entry['size'], False, None)
+        entry.update(original=None, processed=None)
+        if checksum is not None and self._matches(output_path, entry, checksum):
+            self._entries[key] = entry
+            return self._end_write(key, entry, checksum, signature[1], False, None)
+
+        output_path.dirname().makedirs_p()
+        transfer_file(source, output_path)
+        return self._end_write(key, entry, checksum, signature[1], True,
+                               _trusted_signature(stat_signature(output_path)))
+
+    def write_staged(self, staged, source=None):
+        """
+        Moves the :class:`StagedFile` *staged* into place unless the file already has exactly its content, in which
+        case the staged file is discarded. Returns ``True`` if the file was written.
+
+        :param source: The path of the file in the output cache that the written file is derived from, if any.
+        """
+        key, entry = self._begin_write(staged.output_path, source)
+        written, signature = self._place(staged, entry)
+        return self._end_write(key, entry, staged.checksum, staged.size, written, signature)
+
+    def _begin_write(self, output_path, source, origin=None, keep_processed=False):
+        key = self.key(output_path)
+        self._seen.add(key)
+        self._pending.pop(key, None)
+        entry = self._entry(key)
+        source = None if source is None else self.key(source)
+        origin = None if origin is None else unicode(origin)
+        if entry.get('source') != source or entry.get('origin') != origin:
+            # Written files aren't copies, even if the file used to be one, and what a file was processed from is only
+            # known for the same kind of file
+            entry.update(source=source, origin=origin, origin_stat=None, original=None, processed=None)
+            self._entries[key] = entry
+        elif not keep_processed and entry.get('processed') is not None:
+            entry.update(original=None, processed=None)
+            self._entries[key] = entry
+        return key, entry
+
+    def keep_processed(self, output_path, processing):
+        """
+        Keeps the content of *output_path* if it's the result of *processing*, a string describing how the file was
+        processed, e.g. ``'minify:css'``, applied to its current unprocessed content, so it isn't restored by
+        :meth:`restore_unprocessed`. Returns ``True`` if the content was kept; otherwise the file needs to be
+        processed again using :meth:`process`.
+        """
+        key = self.key(output_path)
+        if key not in self._seen or self._entry(key).get('processed') != processing:
+            return False
+        self._pending.pop(key, None)
+        return True
+
+    def content(self, output_path):
+        """
+        Returns the content of *output_path* before it was :meth:`processed <process>`, i.e. the content it was
+        written with or the content of its source if it's a processed copy, or else the content of the file itself.
+        """
+        output_path = path(output_path)
+        key = self.key(output_path)
+        if self._pending.get(key) is not None:
+            return self._pending[key]
+        entry = self._entry(key)
+        if entry.get('processed') and entry.get('origin'):
+            return path(entry['origin']).bytes()
+        return output_path.bytes()
+
+    def sizes(self, output_path):
+        """
+        Returns the recorded size in bytes of the unprocessed content of *output_path* and of the file itself, which are
+        the same unless it was :meth:`processed <process>`.
+        """
+        entry = self._entry(self.key(output_path))
+        if entry.get('processed'):
+            return entry['original_size'], entry['size']
+        return entry['size'], entry['size']
+
+    def process(self, output_path, data, processing):
+        """
+        Replaces the content of *output_path*, which must have been recorded in the current build, with *data*, the
+        result of *processing* its :meth:`content`. The file isn't touched if it already has exactly that content.
+        Returns ``True`` if the file was written.
+        """
+        output_path = path(output_path)
+        key = self.key(output_path)
+        self._pending.pop(key, None)
+        entry = self._entry(key)
+        if not entry.get('processed'):
+            entry.update(original=entry['hash'], original_size=entry['size'])
+        entry['processed'] = processing
+        self._entries[key] = entry
+        return self._write_data(key, entry, output_path, data, hashlib.sha256(data).hexdigest())
+
+    def restore_unprocessed(self):
+        """
+        Restores the unprocessed content of the processed files that were left in place by :meth:`write` or
+        :meth:`copy` but weren't processed again in the current build, e.g. because minification was turned off.
+        """
+        pending, self._pending = self._pending, {}
+        for key, data in sorted(pending.items()):
+            entry = self._entries[key]
+            # A source is hashed again since the recorded hash is the processed one
+            entry.update(original=None, processed=None, origin_stat=None)
+            self._entries[key] = entry
+            if data is None:
+                self.copy(entry['origin'], self.root / key)
+            else:
+                self._write_data(key, entry, self.root / key, data, hashlib.sha256(data).hexdigest())
+
+    def _place(self, staged, entry):
+        # Only touches the file system, not the store, so it's safe to call from any thread. Returns whether the file
+        # was written and, if so, its signature.
+        output_path = staged.output_path
+        if self._matches(output_path, entry, staged.checksum):
+            staged.discard()
+            return False, None
+        # Renaming replaces the file rather than overwriting it, in case it's linked to a published copy
+        output_path.remove_p()
+        staged.path.rename(output_path)
+        return True, _trusted_signature(stat_signature(output_path))
+
+    def _end_write(self, key, entry, checksum, size, written, signature):
+        if not written:
+            self.stats['unchanged'] += 1
+            return False
+        entry.update(hash=checksum, size=size, stat=signature)
+        self._entries[key] = entry
+        self.stats['written'] += 1
+        return True
+
+    def register(self, output_path):
+        """
+        Records the content of *output_path*, which was put in the output cache without using :meth:`write`. The file
+        is only hashed if its stat signature differs from the one previously recorded.
+        """
+        output_path = path(output_path)
+        key = self.key(output_path)
+        entry = self._entry(key)
+        if entry.get('source') is not None:
+            # Derived files are only recorded by writing them
+            return
+        self._seen.add(key)
+        signature = stat_signature(output_path)
+        if entry['hash'] is not None and signature == entry['stat']:
+            return
+        checksum = output_path.read_hexhash('sha256')
+        if checksum != entry['hash'] or signature != entry['stat']:
+            if checksum != entry['hash']:
+                # The file was replaced, so it no longer holds processed content
+                entry.update(original=None, processed=None)
+            entry.update(hash=checksum, size=signature[1], stat=_trusted_signature(signature))
+            self._entries[key] = entry
+
+    def remove_unrecorded(self):
+        """
+        Marks every file that hasn't been written or registered in the current build as deleted. Files that were
+        never published are forgotten entirely. Derived files that weren't written are also removed from the output
+        cache.
+        """
+        for key in list(self._entries):
+            if key in self._seen:
+                continue
+            entry = self._entries[key]
+            if entry.get('source') is not None:
+                (self.root / key).remove_p()
+            if entry['published'] is None:
+                del self._entries[key]
+            elif entry['hash'] is not None:
+                entry.update(hash=None, size=None, stat=None)
+                self._entries[key] = entry
+
+    def changes(self, target=None):
+        """
+        Returns a dict of sets of the keys of files that are ``'new'``, ``'overwritten'`` or ``'deleted'`` since the
+        output cache was last published.
+
+        If *target*, the folder the output cache was published to, is given, the published copies of the files that
+        haven't changed are checked too. Copies that were deleted from *target* are reported as ``'new'`` and copies
+        that were edited there as ``'overwritten'``, so that they're published again. A copy is only hashed if its stat
+        signature differs from the one recorded when it was published.
+        """
+        report = {
+            'deleted': set(),
+            'overwritten': set(),
+            'new': set()
+        }
+        for key in self._entries:
+            entry = self._entries[key]
+            if entry['hash'] == entry['published']:
+                if target is not None and entry['hash'] is not None:
+                    drift = self._published_drift(key, path(target) / key, entry)
+                    if drift is not None:
+                        report[drift].add(key)
+                continue
+            elif entry['published'] is None:
+                report['new'].add(key)
+            elif entry['hash'] is None:
+                report['deleted'].add(key)
+            else:
+                report['overwritten'].add(key)
+        return report
+
+    def _published_drift(self, key, published_path, entry):
+        # Returns how the published copy of a file differs from the output cache, if it does
+        try:
+            signature = stat_signature(published_path)
+        except OSError:
+            return 'new'
+        if signature == entry.get('published_stat'):
+            return None
+        if signature[1] != entry['size'] or published_path.read_hexhash('sha256') != entry['hash']:
+            return 'overwritten'
+        # The copy is unchanged, but its signature isn't known yet, e.g. because it was recently published
+        self._restat.add(key)
+        return None
+
+    def recorded_keys(self):
+        """Returns a list of the keys of the files currently in the output cache, i.e. those that aren't deleted."""
+        return [key for key in self._entries if self._entries[key]['hash'] is not None]
+
+    def forget_published(self):
+        """
+        Records that nothing has been published, e.g. because the output directory is empty, so every file in the
+        output cache is considered new.
+        """
+        for key in list(self._entries):
+            entry = self._entries[key]
+            if entry['hash'] is None:
+                del self._entries[key]
+            elif entry['published'] is not None:
+                entry['published'] = None
+                self._entries[key] = entry
+
+    def mark_published(self, target=None, published=None):
+        """
+        Records that the output cache has been published to the folder *target*, i.e. that the output directory
+        matches it. The stat signatures of the files in *published*, a set of keys of the files that were just copied
+        to *target*, are recorded so that :meth:`changes` can tell when they're modified there.
+        """
+        published = published or set()
+        for key in list(self._entries):
+            entry = self._entries[key]
+            if entry['hash'] is None:
+                del self._entries[key]
+                continue
+            restat = target is not None and (key in published or key in self._restat)
+            if entry['published'] != entry['hash'] or restat:
+                entry['published'] = entry['hash']
+                entry['published_stat'] = None
+                if restat:
+                    try:
+                        entry['published_stat'] = _trusted_signature(stat_signature(path(target) / key))
+                    except OSError:
+                        pass
+                self._entries[key] = entry
+        self._restat = set()
+
+
+class _PendingWrite(object):
+    def __init__(self, key, entry):
+        self.key = key
+        self.entry = entry
+        self.callback = None
+        self.aborted = False
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+_END = object()
+
+
+class OutputWriter(object):
+    """
+    Writes files to the output cache on a pool of *threads* background threads, so that rendering pages and writing
+    them to disk overlap.
+
+    Files are either streamed using :meth:`stage`, which hands each chunk of the file to a background thread as soon
+    as it's produced, or staged by another process as a :class:`StagedFile`. Either way, they're then submitted in
+    order using :meth:`write_staged`. At most *queue_size* files can wait for a thread; submitting more blocks until one
+    is free.
+
+    The *manifest*, an :class:`OutputManifest`, is only updated on the thread that submits the files, in the order they
+    were submitted, as :meth:`write_staged` and :meth:`finish` find them written. Errors are raised the same way, after
+    every file submitted before the one that failed has been recorded. Call :meth:`finish` to wait for all the files to
+    be written, then :meth:`close` to stop the threads.
+    """
+
+    def __init__(self, manifest, threads=4, queue_size=32):
+        self.manifest = manifest
+        self._tasks = Queue.Queue(maxsize=queue_size)
+        self._pending = collections.deque()
+        self._directories = set()
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._run, name='OutputWriter-%d' % i)
+            # Don't keep a failed build from exiting
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        for task in iter(self._tasks.get, None):
+            task()
+
+    def make_directories(self, directories):
+        """Creates the *directories* that don't exist yet in the background, as a single batch."""
+        self._tasks.put(functools.partial(self._make_directories, sorted(set(path(d) for d in directories))))
+
+    def _make_directories(self, directories):
+        for directory in directories:
+            try:
+                self._make_directory(directory)
+            except OSError:
+                # The file that needs it will try again and report the error
+                pass
+
+    def _make_directory(self, directory):
+        if directory not in self._directories:
+            directory.makedirs_p()
+            self._directories.add(directory)
+
+    def stage(self, output_path, chunks):
+        """
+        Streams *chunks*, an iterable of byte strings, to a background thread that writes them to a
+        :class:`StagedFile` for *output_path*. Returns once every chunk has been handed over; pass the result to
+        :meth:`write_staged`.
+        """
+        output_path = path(output_path)
+        pending = _PendingWrite(*self.manifest._begin_write(output_path, None))
+        channel = Queue.Queue(maxsize=4)
+        self._tasks.put(functools.partial(self._write_chunks, pending, output_path, channel))
+        try:
+            for chunk in chunks:
+                channel.put(chunk)
+        except:
+            pending.aborted = True
+            raise
+        finally:
+            channel.put(_END)
+        return pending
+
+    def _write_chunks(self, pending, output_path, channel):
+        chunks = iter(channel.get, _END)
+        try:
+            self._make_directory(output_path.dirname())
+            staged = StagedFile(output_path, chunks, make_directory=False)
+            if pending.aborted:
+                staged.discard()
+            else:
+                self._place(pending, staged)
+        except Exception:
+            pending.error = sys.exc_info()
+            # Keep reading so the thread producing the chunks doesn't block
+            for _ in chunks:
+                pass
+        finally:
+            pending.done.set()
+
+    def _place(self, pending, staged):
+        try:
+            written, signature = self.manifest._place(staged, pending.entry)
+            pending.result = staged.checksum, staged.size, written, signature
+        except Exception:
+            pending.error = sys.exc_info()
+        finally:
+            pending.done.set()
+
+    def write_staged(self, staged, callback=None):
+        """
+        Submits *staged*, either a :class:`StagedFile` or the result of :meth:`stage`, to be moved into place like
+        :meth:`OutputManifest.write_staged` would. *callback* is called with no arguments once the file has been
+        written and recorded in the manifest.
+
+        Records any files submitted earlier that have been written since, and raises the first error writing them.
+        """
+        if not isinstance(staged, _PendingWrite):
+            pending = _PendingWrite(*self.manifest._begin_write(staged.output_path, None))
+            self._tasks.put(functools.partial(self._place, pending, staged))
+            staged = pending
+        staged.callback = callback
+        self._pending.append(staged)
+        self._record(block=False)
+
+    def _record(self, block):
+        while self._pending and (block or self._pending[0].done.is_set()):
+            pending = self._pending.popleft()
+            # Waiting with a timeout keeps the build interruptible
+            while not pending.done.wait(1):
+                pass
+            if pending.error is not None:
+                raise pending.error[0], pending.error[1], pending.error[2]
+            self.manifest._end_write(pending.key, pending.entry, *pending.result)
+            if pending.callback is not None:
+                pending.callback()
+
+    def finish(self):
+        """Waits for every file submitted to be written and records them, raising the first error writing them."""
+        self._record(block=True)
+
+    def close(self):
+        """Stops the threads once they've written the files already submitted."""
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -1,8 +1,10 @@
 # coding=utf-8
 from inspect import isfunction
+import hashlib
+import json
 import logging
 import platform
-import shelve
+import posixpath
 from datetime import datetime
 
 from appdirs import user_cache_dir, user_data_dir
@@ -15,9 +17,12 @@ from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from path import path
 from brownie.caching import cached_property
 
-from engineer.cache import SimpleFileCache
+from engineer.cache import OutputManifest, SimpleFileCache, SQLiteCacheStore
+from engineer.dependencies import DependencyGraph
 from engineer.plugins import get_all_plugin_types, JinjaEnvironmentPlugin
-from engineer.util import urljoin, slugify, ensure_exists, wrap_list, update_additive, make_precompiled_reference
+from engineer.profiling import timed
+from engineer.util import (urljoin, slugify, ensure_exists, wrap_list, update_additive, make_precompiled_reference,
+                           worker_count, PUBLISH_STRATEGIES)
 from engineer import version
 
 
@@ -76,6 +81,7 @@ class EngineerConfiguration(object):
         THEMES_DIR = (ROOT_DIR / 'themes').abspath()
         LIB_DIR = (STATIC_DIR / 'engineer/lib/').abspath()
         JINJA_CACHE_DIR = ensure_exists(path(user_cache_dir('Engineer', 'Engineer')) / '_jinja_cache')
+        ASSET_CACHE_FILE = path(user_cache_dir('Engineer', 'Engineer')) / 'assets.cache.sqlite'
 
         FOUNDATION_CSS = 'foundation'
         JQUERY = 'jquery-1.11.0.min.js'
@@ -93,6 +99,7 @@ class EngineerConfiguration(object):
     def __init__(self, settings_file=None):
         self.reload(settings_file)
         self.COMPRESS_FILE_LIST = set()
+        self.LESS_FILE_LIST = set()
 
     def reload(self, settings_file=None):
         if settings_file is None:
@@ -150,6 +157,17 @@ class EngineerConfiguration(object):
             raise SettingsFileNotFoundException("Settings file %s not found!" % settings_file)
 
     def _initialize(self, config):
+        # Caches opened using the previous configuration may point at a different cache file
+        self.close_caches()
+        # Likewise for anything else derived from the previous configuration
+        for name in ('OUTPUT_STATIC_DIR', 'JINJA_ENV'):
+            self.__dict__.pop(name, None)
+        # The results of the compress filter, which depend on the settings, keyed by the filtered markup
+        self.COMPRESS_CACHE = {}
+
+        # A fingerprint of the complete configuration, so the build can tell whether any setting has changed
+        self.SETTINGS_FINGERPRINT = hashlib.sha256(json.dumps(config, sort_keys=True, default=repr)).hexdigest()
+
         self._check_deprecated_settings(config)
         self.ENGINEER = EngineerConfiguration._EngineerConstants()
 
@@ -187,7 +205,7 @@ class EngineerConfiguration(object):
             self.CACHE_DIR = self.normalize(self.CACHE_DIR)
 
         self.CACHE_FILE = self.normalize(
-            config.pop('CACHE_FILE', (self.CACHE_DIR / 'engineer.cache').abspath())
+            config.pop('CACHE_FILE', (self.CACHE_DIR / 'engineer.cache.sqlite').abspath())
         )
         self.OUTPUT_CACHE_DIR = self.normalize(
             config.pop('OUTPUT_CACHE_DIR', (self.CACHE_DIR / 'output_cache').abspath())
@@ -199,6 +217,20 @@ class EngineerConfiguration(object):
             config.pop('BUILD_STATS_FILE', (self.CACHE_DIR / 'build_stats.cache').abspath())
         )
 
+        # BUILD SETTINGS
+        self.BUILD_WORKERS = worker_count(config.pop('BUILD_WORKERS', 1))
+        self.CACHE_VALIDATION = config.pop('CACHE_VALIDATION', 'stat')
+        if self.CACHE_VALIDATION not in SimpleFileCache.VALIDATION_MODES:
+            logger.warning("'%s' is not a valid CACHE_VALIDATION setting. Defaulting to 'stat'." %
+                           self.CACHE_VALIDATION)
+            self.CACHE_VALIDATION = 'stat'
+        self.PRECOMPILE_TEMPLATES = config.pop('PRECOMPILE_TEMPLATES', False)
+        self.PUBLISH_STRATEGY = config.pop('PUBLISH_STRATEGY', 'copy')
+        if self.PUBLISH_STRATEGY not in PUBLISH_STRATEGIES:
+            logger.warning("'%s' is not a valid PUBLISH_STRATEGY setting. Defaulting to 'copy'." %
+                           self.PUBLISH_STRATEGY)
+            self.PUBLISH_STRATEGY = 'copy'
+
         # PLUGINS
         self.PLUGINS = self.normalize_list(config.pop('PLUGINS', None))
         if self.PLUGINS is not None:
@@ -219,6 +251,12 @@ class EngineerConfiguration(object):
         # PREPROCESSOR / COMPRESSOR SETTINGS
         self.COMPRESSOR_ENABLED = config.pop('COMPRESSOR_ENABLED', True)
         self.COMPRESSOR_FILE_EXTENSIONS = config.pop('COMPRESSOR_FILE_EXTENSIONS', ['js', 'css'])
+        self.FINGERPRINT_ASSETS = config.pop('FINGERPRINT_ASSETS', False)
+        self.BUNDLE_ASSETS = config.pop('BUNDLE_ASSETS', False)
+        self.GZIP_SIDECARS = config.pop('GZIP_SIDECARS', False)
+        self.GZIP_SIDECAR_EXTENSIONS = wrap_list(config.pop('GZIP_SIDECAR_EXTENSIONS',
+                                                            ['html', 'css', 'js', 'xml', 'json']))
+        self.GZIP_SIDECAR_MIN_SIZE = int(config.pop('GZIP_SIDECAR_MIN_SIZE', 1024))
         self.PREPROCESS_LESS = config.pop('PREPROCESS_LESS', True)
         if not 'LESS_PREPROCESSOR' in config:
             if platform.system() == 'Windows':
@@ -255,6 +293,7 @@ class EngineerConfiguration(object):
         self.FEED_DESCRIPTION = config.pop('FEED_DESCRIPTION',
                                            'The %s most recent posts from %s.' % (self.FEED_ITEM_LIMIT, self.SITE_URL))
         self.FEED_URL = config.pop('FEED_URL', urljoin(self.HOME_URL, 'feeds/atom.xml'))
+        self.TAG_FEEDS = config.pop('TAG_FEEDS', False)
 
         # These 'constants' are updated here so they're relative to the STATIC_URL value
         lib_path = urljoin(self.STATIC_URL, 'engineer/lib')
@@ -274,12 +313,24 @@ class EngineerConfiguration(object):
             page_path = urljoin(self.HOME_URL, page_path)
             return page_path
 
+        def tag_feed(name):
+            return urljoin(tag(name), 'feeds/atom.xml')
+
+        def static(relative_path):
+            url = urljoin(self.STATIC_URL, relative_path)
+            if self.FINGERPRINT_ASSETS:
+                fingerprinted_name = self.ASSET_FINGERPRINTS.request(self.OUTPUT_STATIC_DIR / relative_path)
+                url = urljoin(posixpath.dirname(url), fingerprinted_name)
+            return url
+
         self.URLS = {
             'home': self.HOME_URL,
             'archives': urljoin(self.HOME_URL, 'archives'),
             'feed': self.FEED_URL,
             'listpage': page,
             'tag': tag,
+            'tag_feed': tag_feed,
+            'static': static,
         }
         # Update URLs from the config setting if they're present
         self.URLS.update(config.pop('URLS', {}))
@@ -352,7 +403,8 @@ class EngineerConfiguration(object):
 
         # JinjaEnvironment plugins
         for plugin in JinjaEnvironmentPlugin.plugins:
-            plugin.update_environment(env)
+            with timed('plugins', '%s.update_environment' % plugin.get_name()):
+                plugin.update_environment(env)
 
         # Built-in globals
         env.globals['theme'] = ThemeManager.current_theme()
@@ -363,6 +415,11 @@ class EngineerConfiguration(object):
         env.globals['STATIC_URL'] = self.STATIC_URL
         env.globals['DEBUG'] = self.DEBUG
         env.globals['settings'] = self
+
+        if self.PRECOMPILE_TEMPLATES:
+            from engineer.template_cache import precompile_templates
+
+            precompile_templates(env, self.JINJA_CACHE_DIR)
         return env
 
     @cached_property
@@ -373,38 +430,90 @@ class EngineerConfiguration(object):
         if self is None:
             return
 
-        # Use a shelf as the main cache
+        # Use a SQLite database as the main cache
         try:
-            CACHE = shelve.open(self.CACHE_FILE, writeback=True)
+            CACHE = SQLiteCacheStore(self.CACHE_FILE)
+            is_current = 'version' in CACHE and CACHE['version'] == version
         except Exception as e:
             logger.exception(e)
             CACHE = None
             exit()
 
-        if CACHE is None or len(CACHE) == 0 or 'version' not in CACHE or CACHE['version'] != version:
+        if not is_current:
             # all new caches
             logger.warning("Caches either don't exist or are old, so creating new ones...")
             CACHE.clear()
             CACHE['version'] = version
+            CACHE.sync()
         return CACHE
 
+    def _get_file_cache(self, name):
+        file_cache = SimpleFileCache(version=version, store=self.CACHE, namespace=name)
+        file_cache.validation = self.CACHE_VALIDATION
+        return file_cache
+
+    def close_caches(self):
+        """
+        Commits and closes the cache database, if it's open. The caches are reopened the next time they're used.
+        """
+        for name in ('CACHE', 'ASSET_CACHE'):
+            if name in self.__dict__:
+                self.__dict__[name].close()
+        for name in ('CACHE', 'ASSET_CACHE', 'POST_CACHE', 'LESS_CACHE', 'BUILD_DEPENDENCIES', 'OUTPUT_MANIFEST',
+                     'ASSET_FINGERPRINTS', 'ASSET_BUNDLES', 'FRAGMENT_CACHE'):
+            self.__dict__.pop(name, None)
+
     @cached_property
+    def ASSET_CACHE(self):
+        """
+        A cache of processed assets, such as minified CSS, keyed by the hash of their content. Unlike the other caches,
+        it's shared by all sites.
+        """
+        return SQLiteCacheStore(self.ENGINEER.ASSET_CACHE_FILE)
+
+    @property
     def COMPRESSION_CACHE(self):
-        if 'COMPRESSION_CACHE' not in self.CACHE:
-            self.CACHE['COMPRESSION_CACHE'] = SimpleFileCache(version=version)
-        return self.CACHE['COMPRESSION_CACHE']
+        """
+        Deprecated; the minified output cached in :attr:`ASSET_CACHE`, keyed by content hash rather than by file.
+        """
+        logger.warning("COMPRESSION_CACHE was deprecated in version 0.6: minified files are now cached in ASSET_CACHE.")
+        return self.ASSET_CACHE.namespace('MINIFIED')
 
     @cached_property
     def POST_CACHE(self):
-        if 'POST_CACHE' not in self.CACHE:
-            self.CACHE['POST_CACHE'] = SimpleFileCache(version=version)
-        return self.CACHE['POST_CACHE']
+        return self._get_file_cache('POST_CACHE')
 
     @cached_property
     def LESS_CACHE(self):
-        if 'LESS_CACHE' not in self.CACHE:
-            self.CACHE['LESS_CACHE'] = SimpleFileCache(version=version)
-        return self.CACHE['LESS_CACHE']
+        from engineer.processors import LessCache
+
+        return LessCache(self.CACHE)
+
+    @cached_property
+    def BUILD_DEPENDENCIES(self):
+        return DependencyGraph(self.CACHE, self.OUTPUT_CACHE_DIR)
+
+    @cached_property
+    def OUTPUT_MANIFEST(self):
+        return OutputManifest(self.CACHE, self.OUTPUT_CACHE_DIR)
+
+    @cached_property
+    def ASSET_FINGERPRINTS(self):
+        from engineer.assets import AssetFingerprints
+
+        return AssetFingerprints(self.OUTPUT_CACHE_DIR)
+
+    @cached_property
+    def FRAGMENT_CACHE(self):
+        from engineer.fragments import FragmentCache
+
+        return FragmentCache(self.CACHE)
+
+    @cached_property
+    def ASSET_BUNDLES(self):
+        from engineer.assets import AssetBundles
+
+        return AssetBundles(self.OUTPUT_CACHE_DIR, self.ASSET_FINGERPRINTS)
 
     def normalize(self, p):
         if p is None:
@@ -0,0 +1,313 @@
+# coding=utf-8
+import hashlib
+import logging
+from contextlib import contextmanager
+
+from jinja2 import TemplateNotFound, TemplateSyntaxError, meta
+from path import path
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+logger = logging.getLogger(__name__)
+
+
+def digest(*items):
+    """Returns a SHA-256 hex digest of the ``repr`` of *items*."""
+    return hashlib.sha256(repr(items)).hexdigest()
+
+
+def site_digest():
+    """
+    Returns a digest of the site-wide inputs to every page: the settings, the Engineer version and the loaded plugins.
+    """
+    from engineer import version
+    from engineer.conf import settings
+    from engineer.plugins import get_all_plugin_types
+
+    plugins = sorted(p.get_name() for plugin_type in get_all_plugin_types() for p in plugin_type.plugins)
+    return digest(settings.SETTINGS_FINGERPRINT, str(version), plugins)
+
+
+def template_set_digest(env):
+    """Returns a digest of the name and source of every template available in the Jinja environment *env*."""
+    h = hashlib.sha256()
+    for name in sorted(env.list_templates()):
+        try:
+            source = env.loader.get_source(env, name)[0]
+        except (TemplateNotFound, UnicodeDecodeError):
+            continue
+        h.update(name.encode('utf-8'))
+        h.update(source.encode('utf-8'))
+    return h.hexdigest()
+
+
+class TemplateDependencies(object):
+    """
+    Computes digests of the templates a page is rendered with: the page's own template plus every template it
+    extends, includes or imports macros from, recursively.
+
+    References are found by parsing each template once. If any template in a page's closure refers to another template
+    by a name that's only known when the template is rendered, e.g. ``{% include theme_template %}``, the closure can't
+    be determined, so the page depends on the whole template set instead.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self._sources = {}
+        self._references = {}
+        self._digests = {}
+        self._template_set_digest = None
+
+    def _load(self, name):
+        if name in self._sources:
+            return
+        try:
+            source = self.env.loader.get_source(self.env, name)[0]
+        except (TemplateNotFound, UnicodeDecodeError):
+            # Missing templates are part of the closure too; creating one (e.g. to override a theme template) changes
+            # the digest.
+            self._sources[name] = None
+            self._references[name] = set()
+            return
+        self._sources[name] = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        try:
+            references = meta.find_referenced_templates(self.env.parse(source, name))
+            self._references[name] = set(references)
+        except TemplateSyntaxError:
+            self._references[name] = set([None])
+
+    def closure(self, *names):
+        """
+        Returns a sorted list of the names of *names* and every template they depend on, or ``None`` if the closure
+        can't be determined.
+        """
+        seen = set()
+        to_visit = list(names)
+        while to_visit:
+            name = to_visit.pop()
+            if name is None:
+                return None
+            if name in seen:
+                continue
+            seen.add(name)
+            self._load(name)
+            to_visit.extend(self._references[name])
+        return sorted(seen)
+
+    def digest(self, *names):
+        """Returns a digest of the templates in the closure of *names*."""
+        if names not in self._digests:
+            closure = self.closure(*names)
+            if closure is None:
+                if self._template_set_digest is None:
+                    self._template_set_digest = template_set_digest(self.env)
+                self._digests[names] = self._template_set_digest
+            else:
+                self._digests[names] = digest([(name, self._sources[name]) for name in closure])
+        return self._digests[names]
+
+
+def post_summary(post):
+    """
+    Returns the parts of *post* that can appear on pages other than the post's own page, like its title, URL and tags.
+    """
+    return (post.source, post.url, post.title, post.slug, post.timestamp.isoformat(), post.tags, post.status.name,
+            post.link, post.via, post.via_link, sorted(post.custom_properties.items()))
+
+
+def listing_digest(posts):
+    """Returns a digest of the :func:`summaries <post_summary>` of *posts*, in order."""
+    return digest([post_summary(p) for p in posts])
+
+
+def content_digest(posts):
+    """Returns a digest of the content of *posts*."""
+    return digest([p.content_hash for p in posts])
+
+
+class DependencyGraph(object):
+    """
+    Records the inputs each file in the output cache was generated from, so that files whose inputs haven't changed
+    don't need to be generated again in the next build.
+
+    Inputs are a dict mapping input names to digests. Each page is recorded along with its inputs and any side effects
+    its templates had, such as preprocessing a LESS file. If the page is skipped in a later build because it's current,
+    those side effects are replayed instead.
+
+    Files that are copied to the output cache rather than generated are registered using :meth:`add_output`. Any file
+    that was generated or copied in the previous build but not in the current one is removed from the output cache by
+    :meth:`remove_orphans`.
+    """
+
+    transient = ('fragment',)
+    """The kinds of side effects that aren't recorded with the outputs that had them."""
+
+    def __init__(self, store, root, namespace='BUILD_DEPENDENCIES'):
+        self.root = path(root)
+        self._records = store.namespace(namespace)
+        self._side_effects = None
+        self.reset()
+
+    def reset(self):
+        """Forgets which outputs have been produced in the current build and resets the counts in :attr:`stats`."""
+        self._produced = set()
+        self._applied = set()
+        self.stats = {
+            'rendered': 0,  # generated because an input changed
+            'skipped': 0,  # current, so not generated
+            'removed': 0,  # orphaned outputs removed from the output cache
+        }
+
+    def key(self, output_path):
+        return unicode(self.root.relpathto(path(output_path).abspath())).replace('\\', '/')
+
+    def is_empty(self):
+        """``True`` if nothing has been recorded, e.g. because the cache was just created."""
+        return len(self._records) == 0
+
+    def is_current(self, output_path, inputs):
+        """
+        ``True`` if *output_path* exists and was generated from exactly *inputs*, and every asset whose fingerprinted
+        name or bundle it refers to still has the same name.
+        """
+        if not path(output_path).exists():
+            return False
+        try:
+            record = self._records[self.key(output_path)]
+        except KeyError:
+            return False
+        if record is None or record['inputs'] != inputs:
+            return False
+        return self.side_effects_valid(record['side_effects'])
+
+    def skip(self, output_path):
+        """Marks *output_path* as current and applies the side effects recorded when it was generated."""
+        key = self.key(output_path)
+        self._produced.add(key)
+        self.stats['skipped'] += 1
+        self.apply(self._records[key]['side_effects'])
+
+    @contextmanager
+    def capture(self):
+        """
+        Captures the side effects of generating an output inside the ``with`` block in the list the context manager
+        returns. Side effects are deferred while they're being captured; they take effect when they're passed to
+        :meth:`apply`. This makes it possible to generate outputs in worker processes.
+
+        Captures can be nested; side effects are only captured by the innermost one.
+        """
+        side_effects = []
+        previous, self._side_effects = self._side_effects, side_effects
+        try:
+            yield side_effects
+        finally:
+            self._side_effects = previous
+
+    def record(self, output_path, inputs, side_effects=()):
+        """
+        Records that *output_path* was generated from *inputs* and had the given side effects. Transient side effects,
+        which only need to take effect once, aren't recorded.
+        """
+        key = self.key(output_path)
+        recorded = []
+        for side_effect in side_effects:
+            if side_effect[0] not in self.transient and side_effect not in recorded:
+                recorded.append(side_effect)
+        side_effects = recorded
+        self._records[key] = {'inputs': inputs, 'side_effects': side_effects}
+        self._produced.add(key)
+        self.stats['rendered'] += 1
+
+    def record_side_effect(self, kind, value):
+        """
+        Records a side effect of generating the current output. Called by the template helpers that have side effects.
+        Returns ``True`` if the side effect was captured and should be deferred.
+
+        A side effect is captured each time it's recorded, so that one occurrence of it can be withdrawn using
+        :meth:`withdraw_side_effect` without losing the others.
+        """
+        if self._side_effects is None:
+            return False
+        self._side_effects.append((kind, value))
+        return True
+
+    def withdraw_side_effect(self, kind, value):
+        """
+        Withdraws the most recent capture of a side effect of generating the current output, e.g. because the compress
+        filter bundled the asset a fingerprinted name was requested for. Side effects that have already taken effect
+        can't be withdrawn.
+        """
+        if self._side_effects is not None and (kind, value) in self._side_effects:
+            self._side_effects.reverse()
+            self._side_effects.remove((kind, value))
+            self._side_effects.reverse()
+
+    def apply(self, side_effects):
+        """Makes deferred or recorded *side_effects* take effect. Each side effect is applied once per build."""
+        for side_effect in side_effects:
+            if side_effect not in self._applied:
+                self._applied.add(side_effect)
+                self._replay(*side_effect)
+
+    def side_effects_valid(self, side_effects):
+        """``False`` if any of *side_effects* names an asset whose name has changed since it was recorded."""
+        return all(self._is_valid(*side_effect) for side_effect in side_effects)
+
+    @staticmethod
+    def _is_valid(kind, value):
+        """``False`` if a recorded side effect names an asset whose name has changed since it was recorded."""
+        from engineer.conf import settings
+
+        if kind == 'fingerprint':
+            key, fingerprint = value
+            return settings.ASSET_FINGERPRINTS.fingerprint(key) == fingerprint
+        elif kind == 'bundle':
+            key, compression_type, members = value
+            return settings.ASSET_BUNDLES.bundle_key(compression_type, members) == key
+        return True
+
+    @staticmethod
+    def _replay(kind, value):
+        from engineer.conf import settings
+
+        if kind == 'less':
+            settings.LESS_FILE_LIST.add(value)
+        elif kind == 'compress':
+            settings.COMPRESS_FILE_LIST.add(value)
+        elif kind == 'fingerprint':
+            key, fingerprint = value
+            settings.ASSET_FINGERPRINTS.requested[key] = fingerprint
+        elif kind == 'bundle':
+            key, compression_type, members = value
+            settings.ASSET_BUNDLES.requested[key] = compression_type, members
+        elif kind == 'fragment':
+            settings.FRAGMENT_CACHE.store(*value)
+        else:
+            logger.warning("Unknown side effect '%s' in the dependency graph." % kind)
+
+    def add_output(self, output_path):
+        """Registers *output_path* as an output of the current build without any recorded inputs."""
+        key = self.key(output_path)
+        self._produced.add(key)
+        if key not in self._records:
+            self._records[key] = None
+
+    def remove_orphans(self):
+        """Removes outputs of the previous build that weren't produced in this one. Returns the removed paths."""
+        removed = []
+        for key in list(self._records):
+            if key in self._produced:
+                continue
+            orphan = self.root / key
+            if orphan.isfile():
+                logger.debug("Removing orphaned output %s." % key)
+                orphan.remove()
+                removed.append(orphan)
+                # Remove any directories the orphan leaves empty, like the directory for a deleted tag's page
+                parent = orphan.dirname()
+                while parent != self.root and parent.isdir() and not parent.listdir():
+                    parent.rmdir()
+                    parent = parent.dirname()
+            del self._records[key]
+        self.stats['removed'] = len(removed)
+        return removed
@@ -1,4 +1,5 @@
 # coding=utf-8
+import multiprocessing
 from tempfile import mkdtemp
 
 # noinspection PyPackageRequirements
@@ -9,7 +10,7 @@ from clint.textui import colored, indent, puts
 from clint.textui import columns
 from path import path
 
-from engineer.processors import convert_less
+from engineer.processors import compile_less, LessCompilationError
 from engineer.themes import ThemeManager
 
 __author__ = 'Tyler Butler <tyler@tylerbutler.com>'
@@ -29,20 +30,23 @@ def compile_theme(theme_id=None):
         puts(colored.yellow("Using %s as the temporary path." % output_dir))
         puts(colored.yellow("Compiling %s themes." % len(themes)))
 
+        files = []
         for theme in themes:
             temp_theme_output_path = path(output_dir / theme.id).normpath()
             theme_output_path = (theme.static_root / ('stylesheets/%s_precompiled.css' % theme.id)).normpath()
 
-            puts(colored.cyan("Compiling theme %s to %s" % (theme.id, theme_output_path)))
-            with indent(4):
-                puts("Copying content to %s" % temp_theme_output_path)
-                theme.copy_all_content(temp_theme_output_path)
+            puts(colored.cyan("Copying theme %s to %s" % (theme.id, temp_theme_output_path)))
+            theme.copy_all_content(temp_theme_output_path)
+            files.append((temp_theme_output_path / ('stylesheets/%s.less' % theme.id), theme_output_path))
 
-                puts("Compiling...")
-                convert_less(temp_theme_output_path / 'stylesheets/%s.less' % theme.id,
-                             theme_output_path,
-                             minify=True)
-                puts(colored.green("Done.", bold=True))
+        puts("Compiling...")
+        try:
+            compile_less(files, minify=True, workers=multiprocessing.cpu_count())
+        except LessCompilationError as e:
+            puts(colored.red(e.message))
+            exit(1355)
+        for theme, (less_file, theme_output_path) in zip(themes, files):
+            puts(colored.green("Compiled theme %s to %s." % (theme.id, theme_output_path), bold=True))
 
 
 # noinspection PyShadowingBuiltins
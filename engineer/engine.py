@@ -1,7 +1,6 @@
 # coding=utf-8
 import argparse
-import filecmp
-import gzip
+import functools
 import logging
 import os
 import sys
@@ -16,7 +15,7 @@ from engineer.exceptions import ThemeNotFoundException
 from engineer.filters import naturaltime
 from engineer.log import get_console_handler, bootstrap
 from engineer.plugins import CommandPlugin, load_plugins
-from engineer.util import relpath, compress, has_files, diff_dir
+from engineer.util import relpath, has_files
 from engineer import version
 
 try:
@@ -63,6 +62,7 @@ def clean(args=None):
                 # we don't need to descend into the subdirs if this dir is in the ignore list
                 del dirnames[:]
 
+    settings.close_caches()
     try:
         settings.OUTPUT_CACHE_DIR.rmtree()
         settings.CACHE_DIR.rmtree()
@@ -76,25 +76,54 @@ def clean(args=None):
     logger.console('Cleaned output directory: %s' % settings.OUTPUT_DIR)
 
 
-#noinspection PyShadowingBuiltins
 def build(args=None):
     """Builds an Engineer site using the settings specified in *args*."""
     from engineer.conf import settings
+    from engineer.profiling import BuildProfile
+
+    profile_dump = getattr(args, 'profile_dump', False)
+    profile = BuildProfile(hooks=getattr(args, 'profile', False),
+                           dump_dir=settings.CACHE_DIR / 'profile' if profile_dump else None)
+    try:
+        return _build(args, profile)
+    finally:
+        # Stop timing templates and sampling the stack even if the build fails
+        profile.stop()
+
+
+#noinspection PyShadowingBuiltins
+def _build(args, profile):
+    from engineer.assets import minify_assets, write_bundles, write_fingerprinted_assets, write_gzip_sidecars
+    from engineer.cache import stat_signature, OutputWriter, StagedFile
+    from engineer.conf import settings
+    from engineer.dependencies import site_digest, listing_digest, content_digest, TemplateDependencies
     from engineer.loaders import LocalLoader
     from engineer.log import get_file_handler
     from engineer.models import PostCollection, TemplatePage
+    from engineer.pages import (feed_item, render_pages, ArchivePageJob, FeedJob, PostPageJob, RollupPageJob,
+                                SitemapJob, TagPageJob, TemplatePageJob)
+    from engineer.processors import preprocess_less_files
+    from engineer.sitemap import sitemap_entries, write_sitemaps, SitemapDates
     from engineer.themes import ThemeManager
-    from engineer.util import mirror_folder, ensure_exists, slugify
+    from engineer.util import sync_folder, transfer_file, ensure_exists, slugify, worker_count
 
     if args and args.clean:
         clean()
 
+    if args and getattr(args, 'jobs', None) is not None:
+        settings.BUILD_WORKERS = worker_count(args.jobs)
+
+    if profile.hooks:
+        # Plugin hooks and templates can only be timed in this process
+        settings.BUILD_WORKERS = 1
+
     settings.create_required_directories()
 
     logger = logging.getLogger('engineer.engine.build')
     logger.parent.addHandler(get_file_handler(settings.LOG_FILE))
 
     logger.debug("Starting build using configuration file %s." % settings.SETTINGS_FILE)
+    profile.start(settings.JINJA_ENV, 'prepare output cache')
 
     build_stats = {
         'time_run': times.now(),
@@ -106,11 +135,48 @@ def build(args=None):
             'tag_pages': 0,
         },
         'files': {},
+        'caches': {},
+        'pages': {},
+        'assets': {},
+        'sidecars': {},
+        'fingerprints': {},
+        'bundles': {},
+        'less': {},
+        'profile': {},
     }
 
-    # Remove the output cache (not the post cache or the Jinja cache)
-    # since we're rebuilding the site
-    settings.OUTPUT_CACHE_DIR.rmtree(ignore_errors=True)
+    settings.LESS_CACHE.reset_stats()
+
+    # The output cache is kept between builds, and pages whose inputs haven't changed since the previous build aren't
+    # generated again. If there's no record of what the previous build output, though, there's no telling what's in
+    # the output cache, so start from scratch.
+    dependencies = settings.BUILD_DEPENDENCIES
+    dependencies.reset()
+    outputs = settings.OUTPUT_MANIFEST
+    outputs.reset()
+    settings.ASSET_FINGERPRINTS.reset()
+    settings.ASSET_BUNDLES.reset()
+    settings.COMPRESS_CACHE.clear()
+    settings.FRAGMENT_CACHE.reset()
+    if dependencies.is_empty():
+        settings.OUTPUT_CACHE_DIR.rmtree(ignore_errors=True)
+
+    def copy_static(source, target):
+        # Static files are copied through the output manifest, which only copies a file again if its source changed.
+        # LESS files are only needed during the build if they're preprocessed, so they're copied without recording
+        # them, and aren't published.
+        if source.isdir():
+            files = [(f, target / source.relpathto(f)) for f in source.walkfiles()]
+        else:
+            files = [(source, target)]
+        for the_file, output_path in files:
+            if settings.PREPROCESS_LESS and the_file.ext == '.less':
+                if not output_path.isfile() or stat_signature(output_path)[:2] != stat_signature(the_file)[:2]:
+                    ensure_exists(output_path)
+                    transfer_file(the_file, output_path)
+            else:
+                outputs.copy(the_file, output_path)
+            dependencies.add_output(output_path)
 
     theme = ThemeManager.current_theme()
     engineer_lib = (settings.OUTPUT_STATIC_DIR / 'engineer/lib/').abspath()
@@ -118,32 +184,31 @@ def build(args=None):
     # Copy Foundation files if used
     if theme.use_foundation:
         s = settings.ENGINEER.LIB_DIR / settings.ENGINEER.FOUNDATION_CSS
-        t = ensure_exists(engineer_lib / settings.ENGINEER.FOUNDATION_CSS)
-        mirror_folder(s, t)
+        copy_static(s, engineer_lib / settings.ENGINEER.FOUNDATION_CSS)
         logger.debug("Copied Foundation library files.")
 
     # Copy LESS js file if needed
     if theme.use_lesscss and not settings.PREPROCESS_LESS:
         s = settings.ENGINEER.LIB_DIR / settings.ENGINEER.LESS_JS
-        s.copy(engineer_lib)
+        copy_static(s, engineer_lib / s.name)
         logger.debug("Copied LESS CSS files.")
 
     # Copy jQuery files if needed
     if theme.use_jquery:
         s = settings.ENGINEER.LIB_DIR / settings.ENGINEER.JQUERY
-        s.copy(engineer_lib)
+        copy_static(s, engineer_lib / s.name)
         logger.debug("Copied jQuery files.")
 
     # Copy modernizr files if needed
     if theme.use_modernizr:
         s = settings.ENGINEER.LIB_DIR / settings.ENGINEER.MODERNIZR
-        s.copy(engineer_lib)
+        copy_static(s, engineer_lib / s.name)
         logger.debug("Copied Modernizr files.")
 
     # Copy normalize.css if needed
     if theme.use_normalize_css:
         s = settings.ENGINEER.LIB_DIR / settings.ENGINEER.NORMALIZE_CSS
-        s.copy(engineer_lib)
+        copy_static(s, engineer_lib / s.name)
         logger.debug("Copied normalize.css.")
 
     # Copy 'raw' content to output cache - first pass
@@ -151,23 +216,17 @@ def build(args=None):
     # is needed by site-specific pages (like template pages) is available
     # during the build
     if settings.CONTENT_DIR.exists():
-        mirror_folder(settings.CONTENT_DIR,
-                      settings.OUTPUT_CACHE_DIR,
-                      delete_orphans=False)
+        copy_static(settings.CONTENT_DIR, settings.OUTPUT_CACHE_DIR)
 
-    # Copy theme static content to output dir
+    # Copy theme static content, and any additional theme content, to output dir
     theme_output_dir = settings.OUTPUT_STATIC_DIR / 'theme'
     logger.debug("Copying theme static files to output cache.")
-    theme.copy_content(theme_output_dir)
+    for s, t in theme.static_content(theme_output_dir):
+        copy_static(s, t)
     logger.debug("Copied static files for theme to %s." % relpath(theme_output_dir))
 
-    # Copy any theme additional content to output dir if needed
-    if theme.content_mappings:
-        logger.debug("Copying additional theme content to output cache.")
-        theme.copy_related_content(theme_output_dir)
-        logger.debug("Copied additional files for theme to %s." % relpath(theme_output_dir))
-
     # Load markdown input posts
+    profile.stage('load posts')
     logger.info("Loading posts...")
     new_posts, cached_posts = LocalLoader.load_all(input=settings.POST_DIR)
     all_posts = PostCollection(new_posts + cached_posts)
@@ -191,197 +250,210 @@ def build(args=None):
     all_posts = PostCollection(
         sorted(to_publish, reverse=True, key=lambda p: p.timestamp))
 
-    # Generate template pages
+    profile.stage('check pages')
+    # Every page depends on the settings and plugins, as well as the list of posts, since any page can link to any
+    # post. Pages also depend on the templates they're rendered with and the content of the posts they show.
+    site_inputs = {
+        'site': site_digest(),
+        'posts': listing_digest(all_posts),
+    }
+    templates = TemplateDependencies(settings.JINJA_ENV)
+
+    jobs = []
+
+    # Template pages
+    template_pages = []
     if settings.TEMPLATE_PAGE_DIR.exists():
         logger.info("Generating template pages from %s." % settings.TEMPLATE_PAGE_DIR)
-        template_pages = []
-        for template in settings.TEMPLATE_PAGE_DIR.walkfiles('*.html'):
-            # We create all the TemplatePage objects first so we have all of the URLs to them in the template
-            # environment. Without this step, template pages might have broken links if they link to a page that is
-            # loaded after them, since the URL to the not-yet-loaded page will be missing.
-            template_pages.append(TemplatePage(template))
-        for page in template_pages:
-            rendered_page = page.render_html(all_posts)
-            ensure_exists(page.output_path)
-            with open(page.output_path / page.output_file_name, mode='wb',
-                      encoding='UTF-8') as the_file:
-                the_file.write(rendered_page)
-                logger.info("Output template page %s." % relpath(the_file.name))
-                build_stats['counts']['template_pages'] += 1
-        logger.info("Generated %s template pages." % build_stats['counts']['template_pages'])
-
-    # Generate individual post pages
-    for post in all_posts:
-        rendered_post = post.render_html(all_posts)
-        ensure_exists(post.output_path)
-        with open(post.output_path, mode='wb',
-                  encoding='UTF-8') as the_file:
-            the_file.write(rendered_post)
-            if post in new_posts:
-                logger.console("Output new or modified post '%s'." % post.title)
-                build_stats['counts']['new_posts'] += 1
-            elif post in cached_posts:
-                build_stats['counts']['cached_posts'] += 1
-
-    # Generate rollup pages
+        # We create all the TemplatePage objects first so we have all of the URLs to them in the template
+        # environment. Without this step, template pages might have broken links if they link to a page that is
+        # loaded after them, since the URL to the not-yet-loaded page will be missing.
+        template_pages = [(TemplatePage(template), template)
+                          for template in settings.TEMPLATE_PAGE_DIR.walkfiles('*.html')]
+        jobs.extend(TemplatePageJob(page, template) for page, template in template_pages)
+        build_stats['counts']['template_pages'] = len(template_pages)
+
+    # Individual post pages
+    new_set, cached_set = set(new_posts), set(cached_posts)
+    for position, post in enumerate(all_posts):
+        jobs.append(PostPageJob(post, position))
+        if post in new_set:
+            logger.console("Output new or modified post '%s'." % post.title)
+            build_stats['counts']['new_posts'] += 1
+        elif post in cached_set:
+            build_stats['counts']['cached_posts'] += 1
+
+    # Rollup pages
     num_posts = len(all_posts)
     num_slices = (
         num_posts / settings.ROLLUP_PAGE_SIZE) if num_posts % settings.ROLLUP_PAGE_SIZE == 0 \
         else (num_posts / settings.ROLLUP_PAGE_SIZE) + 1
 
-    slice_num = 0
-    for posts in all_posts.paginate():
-        slice_num += 1
+    for slice_num in range(1, num_slices + 1):
+        start = (slice_num - 1) * settings.ROLLUP_PAGE_SIZE
+        end = start + settings.ROLLUP_PAGE_SIZE
         has_next = slice_num < num_slices
         has_previous = 1 < slice_num <= num_slices
-        rendered_page = posts.render_listpage_html(slice_num, has_next,
-                                                   has_previous)
-        ensure_exists(posts.output_path(slice_num))
-        with open(posts.output_path(slice_num), mode='wb',
-                  encoding='UTF-8') as the_file:
-            the_file.write(rendered_page)
-            logger.debug("Output rollup page %s." % relpath(the_file.name))
-            build_stats['counts']['rollups'] += 1
-
-        # Copy first rollup page to root of site - it's the homepage.
+        jobs.append(RollupPageJob(slice_num, start, end, has_next, has_previous))
+        build_stats['counts']['rollups'] += 1
+
+        # The first rollup page is also the homepage
         if slice_num == 1:
-            path.copyfile(posts.output_path(slice_num),
-                          settings.OUTPUT_CACHE_DIR / 'index.html')
-            logger.debug(
-                "Output '%s'." % (settings.OUTPUT_CACHE_DIR / 'index.html'))
+            jobs.append(RollupPageJob(slice_num, start, end, has_next, has_previous,
+                                      output_path=settings.OUTPUT_CACHE_DIR / 'index.html'))
 
-    # Generate archive page
     if num_posts > 0:
-        archive_output_path = settings.OUTPUT_CACHE_DIR / 'archives/index.html'
-        ensure_exists(archive_output_path)
-
-        rendered_archive = all_posts.render_archive_html(all_posts)
+        # Archive page
+        jobs.append(ArchivePageJob())
 
-        with open(archive_output_path, mode='wb', encoding='UTF-8') as the_file:
-            the_file.write(rendered_archive)
-            logger.debug("Output %s." % relpath(the_file.name))
-
-    # Generate tag pages
-    if num_posts > 0:
+        # Tag pages
         tags_output_path = settings.OUTPUT_CACHE_DIR / 'tag'
         for tag in all_posts.all_tags:
-            rendered_tag_page = all_posts.render_tag_html(tag, all_posts)
-            tag_path = ensure_exists(
-                tags_output_path / slugify(tag) / 'index.html')
-            with open(tag_path, mode='wb', encoding='UTF-8') as the_file:
-                the_file.write(rendered_tag_page)
-                build_stats['counts']['tag_pages'] += 1
-                logger.debug("Output %s." % relpath(the_file.name))
-
-    # Generate feeds
-    rss_feed_output_path = ensure_exists(settings.OUTPUT_CACHE_DIR / 'feeds/rss.xml')
-    atom_feed_output_path = ensure_exists(settings.OUTPUT_CACHE_DIR / 'feeds/atom.xml')
-    rss_feed = Rss201rev2Feed(
-        title=settings.FEED_TITLE,
-        link=settings.SITE_URL,
-        description=settings.FEED_DESCRIPTION,
-        feed_url=settings.FEED_URL
-    )
-
-    atom_feed = Atom1Feed(
-        title=settings.FEED_TITLE,
-        link=settings.SITE_URL,
-        description=settings.FEED_DESCRIPTION,
-        feed_url=settings.FEED_URL
-    )
-
-    for feed in (rss_feed, atom_feed):
-        for post in all_posts[:settings.FEED_ITEM_LIMIT]:
-            title = settings.JINJA_ENV.get_template('core/feeds/title.jinja2').render(post=post)
-            link = settings.JINJA_ENV.get_template('core/feeds/link.jinja2').render(post=post)
-            content = settings.JINJA_ENV.get_template('core/feeds/content.jinja2').render(post=post)
-            feed.add_item(
-                title=title,
-                link=link,
-                description=content,
-                pubdate=post.timestamp,
-                unique_id=post.absolute_url)
-
-    with open(rss_feed_output_path, mode='wb') as the_file:
-        rss_feed.write(the_file, 'UTF-8')
-        logger.debug("Output %s." % relpath(the_file.name))
-
-    with open(atom_feed_output_path, mode='wb') as the_file:
-        atom_feed.write(the_file, 'UTF-8')
-        logger.debug("Output %s." % relpath(the_file.name))
-
-    # Generate sitemap
-    sitemap_file_name = 'sitemap.xml.gz'
-    sitemap_output_path = ensure_exists(settings.OUTPUT_CACHE_DIR / sitemap_file_name)
-    sitemap_content = settings.JINJA_ENV.get_or_select_template(['sitemap.xml',
-                                                                 'theme/sitemap.xml',
-                                                                 'core/sitemap.xml']).render(post_list=all_posts)
-    with gzip.open(sitemap_output_path, mode='wb') as the_file:
-        the_file.write(sitemap_content)
-        logger.debug("Output %s." % relpath(the_file.name))
+            jobs.append(TagPageJob(tag, tags_output_path / slugify(tag) / 'index.html'))
+            build_stats['counts']['tag_pages'] += 1
+            if settings.TAG_FEEDS:
+                jobs.append(FeedJob(Rss201rev2Feed, tags_output_path / slugify(tag) / 'feeds/rss.xml', tag))
+                jobs.append(FeedJob(Atom1Feed, tags_output_path / slugify(tag) / 'feeds/atom.xml', tag))
+
+    # Feeds
+    jobs.append(FeedJob(Rss201rev2Feed, settings.OUTPUT_CACHE_DIR / 'feeds/rss.xml'))
+    jobs.append(FeedJob(Atom1Feed, settings.OUTPUT_CACHE_DIR / 'feeds/atom.xml'))
+
+    # Sitemap, if the site has its own template for it; otherwise it's written once the pages are
+    custom_sitemap = SitemapJob.has_template()
+    if custom_sitemap:
+        jobs.append(SitemapJob(settings.OUTPUT_CACHE_DIR / 'sitemap.xml.gz'))
+
+    # Skip the pages that are current, then render the rest
+    stale = []
+    for job in jobs:
+        job.inputs = dict(site_inputs,
+                          templates=templates.digest(*job.template_names),
+                          content=content_digest(job.posts(all_posts)))
+        if dependencies.is_current(job.output_path, job.inputs):
+            dependencies.skip(job.output_path)
+        else:
+            stale.append(job)
+
+    profile.stage('render pages')
+    # Render the items in the feeds once, before any worker processes start, so that every feed can share them
+    for job in stale:
+        if isinstance(job, FeedJob):
+            for post in job.posts(all_posts):
+                feed_item(post)
+
+    def page_written(job, side_effects):
+        dependencies.record(job.output_path, job.inputs, side_effects)
+        if isinstance(job, TemplatePageJob):
+            logger.info("Output template page %s." % relpath(job.output_path))
+        else:
+            logger.debug("Output %s." % relpath(job.output_path))
+
+    # Pages are written to disk by background threads while the next ones are rendered
+    writer = OutputWriter(outputs)
+    try:
+        writer.make_directories(job.output_path.dirname() for job in stale)
+        for job, staged, side_effects in render_pages(stale, all_posts, settings.BUILD_WORKERS, templates,
+                                                      stage=writer.stage):
+            dependencies.apply(side_effects)
+            writer.write_staged(staged, functools.partial(page_written, job, side_effects))
+        writer.finish()
+    finally:
+        writer.close()
+
+    if settings.TEMPLATE_PAGE_DIR.exists():
+        logger.info("Generated %s template pages." % build_stats['counts']['template_pages'])
+
+    # Sitemap
+    profile.stage('write sitemap')
+    if not custom_sitemap:
+        sitemap_dates = SitemapDates(settings.CACHE)
+        entries = sitemap_entries(all_posts, template_pages, templates, sitemap_dates)
+        for output_path in write_sitemaps(outputs, entries, settings.OUTPUT_CACHE_DIR):
+            dependencies.add_output(output_path)
+        sitemap_dates.save()
 
     # Copy 'raw' content to output cache - second/final pass
+    profile.stage('copy content')
     if settings.CONTENT_DIR.exists():
-        mirror_folder(settings.CONTENT_DIR,
-                      settings.OUTPUT_CACHE_DIR,
-                      delete_orphans=False)
-
-    # Compress all files marked for compression
-    for the_file, compression_type in settings.COMPRESS_FILE_LIST:
-        if the_file not in settings.COMPRESSION_CACHE:
-            with open(the_file, mode='rb') as input:
-                output = compress(input.read(), compression_type)
-                logger.debug("Compressed %s." % relpath(the_file))
-            settings.COMPRESSION_CACHE[the_file] = output
-        else:
-            logger.debug("Found pre-compressed file in cache: %s." % relpath(the_file))
-            output = settings.COMPRESSION_CACHE[the_file]
-        with open(the_file, mode='wb') as f:
-            f.write(output)
-
-    # Remove LESS files if LESS preprocessing is being done
-    if settings.PREPROCESS_LESS:
-        logger.debug("Deleting LESS files since PREPROCESS_LESS is True.")
-        for f in settings.OUTPUT_STATIC_DIR.walkfiles(pattern="*.less"):
-            logger.debug("Deleting file: %s." % relpath(f))
+        copy_static(settings.CONTENT_DIR, settings.OUTPUT_CACHE_DIR)
+
+    # Preprocess the LESS files the pages need
+    profile.stage('preprocess LESS')
+    build_stats['less'] = preprocess_less_files(settings.LESS_FILE_LIST,
+                                                settings.COMPRESSOR_ENABLED,
+                                                settings.BUILD_WORKERS)
+
+    # Write the bundles of the files linked in compress filter blocks
+    profile.stage('bundle assets')
+    if settings.BUNDLE_ASSETS:
+        build_stats['bundles'] = write_bundles(outputs,
+                                               settings.ASSET_BUNDLES,
+                                               settings.COMPRESSOR_ENABLED,
+                                               settings.BUILD_WORKERS)
+
+    # Minify all files marked for compression
+    profile.stage('minify assets')
+    build_stats['assets'] = minify_assets(settings.COMPRESS_FILE_LIST, settings.BUILD_WORKERS)
+    # Static files minified in a previous build that weren't minified in this one get their original content back
+    outputs.restore_unprocessed()
+    # The asset cache is shared by all sites, so commit right away rather than keeping it locked for the whole build
+    settings.ASSET_CACHE.sync()
+
+    # Remove anything the previous build output that this one didn't
+    profile.stage('remove orphans')
+    dependencies.remove_orphans()
+    logger.info("Generated %(rendered)d pages; %(skipped)d pages were unchanged. Removed %(removed)d orphaned "
+                "files from the output cache." % dependencies.stats)
+
+    # Write fingerprinted copies of the assets the pages refer to
+    profile.stage('fingerprint assets')
+    if settings.FINGERPRINT_ASSETS:
+        build_stats['fingerprints'] = write_fingerprinted_assets(outputs, settings.ASSET_FINGERPRINTS)
+
+    # Record everything else in the output cache, e.g. files put there by plugins. Files whose stat signature hasn't
+    # changed since the previous build aren't read. LESS files that were preprocessed aren't published.
+    profile.stage('record output cache')
+    for f in settings.OUTPUT_CACHE_DIR.walkfiles():
+        if StagedFile.is_staged(f):
             f.remove_p()
-
-    # Check if anything has changed other than the sitemap
-    have_changes = False
-    compare = filecmp.dircmp(settings.OUTPUT_CACHE_DIR,
-                             settings.OUTPUT_DIR,
-                             ignore=settings.OUTPUT_DIR_IGNORE)
-
-    # The algorithm below takes advantage of the fact that once we've determined that there is more than one file
-    # that's different, or if the first item returned by the generator is not the sitemap, then we can break out of
-    # the generator loop early. This is also advantageous because it doesn't require us to completely exhaust the
-    # generator. In the case of a fresh site build, for example, the generator will return a lot more data. So the
-    # other approach here of expanding the generator into a list with a list comprehension would be inefficient
-    # in many cases. This approach performs equally well in all cases at the cost of some unusual-looking code.
-    diff_file_count = 0
+        elif settings.PREPROCESS_LESS and f.ext == '.less':
+            continue
+        elif not outputs.is_recorded(f):
+            outputs.register(f)
+
+    # Write gzipped copies of text files if needed
+    profile.stage('gzip sidecars')
+    if settings.GZIP_SIDECARS:
+        build_stats['sidecars'] = write_gzip_sidecars(outputs,
+                                                      settings.GZIP_SIDECAR_EXTENSIONS,
+                                                      settings.GZIP_SIDECAR_MIN_SIZE,
+                                                      settings.BUILD_WORKERS)
+    outputs.remove_unrecorded()
+    logger.info("Wrote %(written)d files; %(unchanged)d files were unchanged." % outputs.stats)
+
+    # Determine what has changed since the output cache was last published
+    profile.stage('publish')
     if not has_files(settings.OUTPUT_DIR):
-        have_changes = True
-    else:
-        for file_path in diff_dir(compare):
-            diff_file_count += 1
-            if file_path != sitemap_output_path:
-                have_changes = True
-                break
-            if diff_file_count > 1:
-                have_changes = True
-                break
+        outputs.forget_published()
+    changes = outputs.changes(settings.OUTPUT_DIR)
+    have_changes = any(changes.values())
 
     if not have_changes:
+        # Record the signatures of published files that were checked, so they aren't hashed again
+        outputs.mark_published(settings.OUTPUT_DIR)
         logger.console('')
         logger.console("No site changes to publish.")
     else:
         logger.debug("Synchronizing output directory with output cache.")
-        build_stats['files'] = mirror_folder(settings.OUTPUT_CACHE_DIR,
-                                             settings.OUTPUT_DIR,
-                                             ignore_list=settings.OUTPUT_DIR_IGNORE)
+        build_stats['files'] = sync_folder(outputs,
+                                           settings.OUTPUT_DIR,
+                                           ignore_list=settings.OUTPUT_DIR_IGNORE,
+                                           changes=changes,
+                                           strategy=settings.PUBLISH_STRATEGY)
         from pprint import pformat
 
-        logger.debug("Folder mirroring report: %s" % pformat(build_stats['files']))
+        logger.debug("Folder sync report: %s" % pformat(build_stats['files']))
         logger.console('')
         logger.console("Site: '%s' output to %s." % (settings.SITE_TITLE, settings.OUTPUT_DIR))
         logger.console("Posts: %s (%s new or updated)" % (
@@ -396,16 +468,48 @@ def build(args=None):
             len(build_stats['files']['overwritten']),
             len(build_stats['files']['deleted'])))
 
+    build_stats['profile'] = profile.stop()
+    if profile.hooks:
+        log_profile(profile)
+
     logger.console('')
     logger.console("Full build log at %s." % settings.LOG_FILE)
     logger.console('')
 
+    for cache_name in ('POST_CACHE', 'LESS_CACHE', 'FRAGMENT_CACHE'):
+        build_stats['caches'][cache_name] = dict(getattr(settings, cache_name).stats)
+    build_stats['pages'] = dict(dependencies.stats)
+
     with open(settings.BUILD_STATS_FILE, mode='wb') as the_file:
         pickle.dump(build_stats, the_file)
     settings.CACHE.close()
+    settings.ASSET_CACHE.close()
     return build_stats
 
 
+def log_profile(profile):
+    """Writes a summary of a build's :class:`~engineer.profiling.BuildProfile` to the console."""
+    logger = logging.getLogger('engineer.engine.build')
+
+    logger.console('')
+    logger.console("Build time: %.2fs" % profile.total)
+    for stage, seconds in profile.stages:
+        logger.console("    %-24s %8.3fs" % (stage, seconds))
+    if profile.templates:
+        logger.console("Slowest templates (own time, total time, renders):")
+        for name, timings in profile.slowest('templates', key='self_seconds'):
+            logger.console("    %-40s %8.3fs %8.3fs %6d" % (name, timings['self_seconds'], timings['seconds'],
+                                                          timings['renders']))
+    if profile.plugins:
+        logger.console("Slowest plugin hooks (time, calls):")
+        for name, timings in profile.slowest('plugins'):
+            logger.console("    %-64s %8.3fs %6d" % (name, timings['seconds'], timings['calls']))
+    if profile.pstats_path:
+        logger.console("Profiler stats written to %s." % profile.pstats_path)
+    if profile.collapsed_path:
+        logger.console("Collapsed stacks written to %s." % profile.collapsed_path)
+
+
 def serve(args):
     import bottle
     from engineer.conf import settings
@@ -524,6 +628,22 @@ def get_argparser():
                               dest='clean',
                               action='store_true',
                               help="Clean the output directory and clear all the caches before building.")
+    parser_build.add_argument('-j', '--jobs',
+                              dest='jobs',
+                              type=int,
+                              default=None,
+                              help="The number of worker processes to use when building. Use 0 to use one worker per "
+                                   "CPU. Overrides the BUILD_WORKERS setting.")
+    parser_build.add_argument('--profile',
+                              dest='profile',
+                              action='store_true',
+                              help="Time every plugin hook and template render as well as each stage of the build. "
+                                   "The build runs in a single process.")
+    parser_build.add_argument('--profile-dump',
+                              dest='profile_dump',
+                              action='store_true',
+                              help="Like --profile, but also write cProfile stats and collapsed stacks for "
+                                   "flamegraphs to the cache directory.")
     parser_build.set_defaults(func=build)
 
     parser_clean = subparsers.add_parser('clean',
@@ -1,5 +1,6 @@
 # coding=utf-8
 import logging
+import posixpath
 import re
 import humanize
 import times
@@ -8,7 +9,7 @@ from path import path
 from typogrify import filters as Typogrify
 from typogrify.templatetags import jinja_filters
 
-from engineer.util import wrap_list
+from engineer.util import urljoin, wrap_list
 
 __author__ = 'Tyler Butler <tyler@tylerbutler.com>'
 
@@ -78,13 +79,129 @@ def naturaltime(value):
     return friendly
 
 
-# noinspection PyShadowingBuiltins
+def _asset_path(src):
+    """Returns the path in the output cache of the file at the URL *src*."""
+    from engineer.conf import settings
+
+    if src.startswith(settings.HOME_URL):
+        # trim the HOME_URL since it won't be part of the local path to the file
+        src = src[len(settings.HOME_URL):]
+    elif src.startswith('/'):
+        # trim the leading '/' from the src so we can combine it with the OUTPUT_CACHE_DIR to get a path
+        src = src[1:]
+    the_file = path(settings.OUTPUT_CACHE_DIR / src).abspath()
+    if settings.FINGERPRINT_ASSETS:
+        # The URL may already refer to a fingerprinted copy, which doesn't exist until the end of the build
+        the_file = settings.ASSET_FINGERPRINTS.original(the_file)
+    return the_file
+
+
+# Matches the tags in a compress filter block, along with any comments so the tags inside them can be left alone
+_compress_tag_pattern = re.compile(r'<!--.*?-->|<link\b[^>]*>|<script\b[^>]*>.*?</script>', flags=re.DOTALL | re.I)
+
+
+def _bundle(value):
+    """
+    Replaces the stylesheet links or scripts in the compress filter block *value* with a single tag referring to a
+    bundle of the files they link to. Tags inside comments, such as conditional comments, are left in place. Returns
+    ``None`` if the block can't be bundled, e.g. because it mixes stylesheets and scripts or contains inline scripts.
+
+    Otherwise returns the rewritten block along with the ``(key, fingerprint)`` tuples of the bundled files that the
+    block linked to by their fingerprinted names.
+    """
+    import html5lib
+    from engineer.conf import settings
+
+    matches = []
+    urls = []
+    files = []
+    types = set()
+    media = set()
+    for match in _compress_tag_pattern.finditer(value):
+        if match.group(0).startswith('<!--'):
+            continue
+        element = html5lib.parseFragment(match.group(0)).childNodes[0]
+        if element.name == 'link' and 'href' in element.attributes:
+            types.add('css')
+            media.add(element.attributes.get('media'))
+            urls.append(element.attributes['href'])
+        elif element.name == 'script' and 'src' in element.attributes:
+            types.add('js')
+            urls.append(element.attributes['src'])
+        else:
+            return None
+        files.append(_asset_path(urls[-1]))
+        matches.append(match)
+
+    if len(types) != 1 or len(media) > 1:
+        return None
+    compression_type = types.pop()
+    key = settings.ASSET_BUNDLES.request(compression_type, files)
+    if key is None:
+        return None
+
+    url = urljoin(settings.STATIC_URL, settings.ASSET_BUNDLES.directory, posixpath.basename(key))
+    if compression_type == 'css':
+        media = media.pop()
+        tag = u'<link rel="stylesheet" href="%s"%s type="text/css"/>' % (url, u' media="%s"' % media if media else u'')
+    else:
+        tag = u'<script src="%s" type="text/javascript"></script>' % url
+
+    # The bundle's tag takes the place of the first tag; the rest are removed
+    output = [value[:matches[0].start()], tag]
+    for previous, match in zip(matches, matches[1:]):
+        output.append(value[previous.end():match.start()])
+    output.append(value[matches[-1].end():])
+
+    fingerprints = settings.ASSET_FINGERPRINTS
+    fingerprinted = []
+    for url, the_file in zip(urls, files):
+        if posixpath.basename(url) != the_file.name:
+            key = fingerprints.key(the_file)
+            fingerprinted.append((key, fingerprints.fingerprint(key)))
+    return u''.join(output), tuple(fingerprinted)
+
+
 def compress(value):
+    """
+    Registers the stylesheets and scripts linked in *value* for minification, and rewrites their URLs to refer to
+    fingerprinted copies or bundles if needed.
+
+    The result for each distinct block is cached for the rest of the build along with its side effects, which are
+    replayed when the cached result is used, so blocks that appear on every page are only parsed once.
+
+    If the block is bundled, the fingerprinted names its files were linked by while it was rendered are no longer
+    used, so those requests are withdrawn; fingerprinted copies are only written for files also linked outside bundles.
+    """
     from engineer.conf import settings
 
-    if not settings.COMPRESSOR_ENABLED:
-        return value
-    else:  # COMPRESSOR_ENABLED == True
+    dependencies = settings.BUILD_DEPENDENCIES
+    try:
+        output, side_effects, bundled = settings.COMPRESS_CACHE[value]
+    except KeyError:
+        with dependencies.capture() as side_effects:
+            output, bundled = _compress(value)
+        settings.COMPRESS_CACHE[value] = output, side_effects, bundled
+    for side_effect in side_effects:
+        if not dependencies.record_side_effect(*side_effect):
+            dependencies.apply([side_effect])
+    for fingerprint in bundled:
+        dependencies.withdraw_side_effect('fingerprint', fingerprint)
+    return output
+
+
+# noinspection PyShadowingBuiltins
+def _compress(value):
+    from engineer.conf import settings
+
+    if settings.BUNDLE_ASSETS:
+        bundled = _bundle(value)
+        if bundled is not None:
+            return bundled
+
+    if not (settings.COMPRESSOR_ENABLED or settings.FINGERPRINT_ASSETS):
+        return value, ()
+    else:  # COMPRESSOR_ENABLED or FINGERPRINT_ASSETS == True
         import html5lib
 
         #noinspection PyUnresolvedReferences,PyUnusedLocal
@@ -118,17 +235,17 @@ def compress(value):
             else:
                 raise Exception("Hmmm, wasn't expecting a '%s' here." % item.name)
 
-            if src.startswith(settings.HOME_URL):
-                # trim the HOME_URL since it won't be part of the local path to the file
-                src = src[len(settings.HOME_URL):]
-            elif src.startswith('/'):
-                # trim the leading '/' from the src so we can combine it with the OUTPUT_CACHE_DIR to get a path
-                src = src[1:]
+            file = _asset_path(src)
 
-            file = path(settings.OUTPUT_CACHE_DIR / src).abspath()
+            if settings.COMPRESSOR_ENABLED and file.ext[1:] in settings.COMPRESSOR_FILE_EXTENSIONS:
+                if not settings.BUILD_DEPENDENCIES.record_side_effect('compress', (file, compression_type)):
+                    settings.COMPRESS_FILE_LIST.add((file, compression_type))
 
-            if file.ext[1:] in settings.COMPRESSOR_FILE_EXTENSIONS:
-                settings.COMPRESS_FILE_LIST.add((file, compression_type))
+            if settings.FINGERPRINT_ASSETS:
+                fingerprinted_name = settings.ASSET_FINGERPRINTS.request(file)
+                if fingerprinted_name != file.name:
+                    fingerprinted_src = posixpath.join(posixpath.dirname(src), fingerprinted_name)
+                    value = value.replace(src, fingerprinted_src)
 
                 # TODO: Inline script minification.
                 #    if has_inline: # Handle inline script
@@ -144,7 +261,7 @@ def compress(value):
                 #        for tag in generator:
                 #            output += tag
 
-        return value
+        return value, ()
 
 
 def typogrify_no_widont(value):
@@ -0,0 +1,125 @@
+# coding=utf-8
+import logging
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from engineer.conf import settings
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+logger = logging.getLogger(__name__)
+
+
+class FragmentCache(object):
+    """
+    Caches fragments of rendered templates marked with the ``{% cache %}`` tag (see :class:`FragmentCacheExtension`).
+
+    Fragments are cached in memory for the rest of the build, keyed by the template, the position of the tag in it and
+    the values of the tag's key expressions. Fragments marked ``persistent`` are also kept in *store* between builds,
+    additionally keyed by the settings, plugins and Engineer version, and by the templates the fragment's template
+    depends on.
+
+    Any side effects of rendering a fragment, such as registering files for minification, are cached with it and
+    replayed whenever the cached fragment is used, so the pages that use it record them too. Persistent fragments
+    whose side effects refer to assets that have changed since they were cached are rendered again.
+    """
+
+    def __init__(self, store, namespace='FRAGMENT_CACHE'):
+        self._store = store
+        self._persistent = store.namespace(namespace)
+        self.reset()
+
+    def reset(self):
+        """Forgets the fragments cached in memory and resets the counts in :attr:`stats`."""
+        self._fragments = {}
+        self._site_digest = None
+        self._template_dependencies = None
+        self.stats = {
+            'hit': 0,  # cached in memory in this build
+            'persistent': 0,  # cached in a previous build
+            'miss': 0,  # rendered
+        }
+
+    def _persistent_key(self, key):
+        from engineer.dependencies import digest, site_digest, TemplateDependencies
+
+        if self._site_digest is None:
+            self._site_digest = site_digest()
+            self._template_dependencies = TemplateDependencies(settings.JINJA_ENV)
+        name = key[0]
+        return digest(self._site_digest, self._template_dependencies.digest(name), key)
+
+    def render(self, name, lineno, key, persistent, caller):
+        """
+        Returns the fragment at line *lineno* of the template *name* for the given *key*, calling *caller* to render it
+        if it isn't cached.
+        """
+        dependencies = settings.BUILD_DEPENDENCIES
+        key = (name, lineno, repr(key))
+        persistent = persistent and name is not None
+        try:
+            output, side_effects = self._fragments[key]
+            self.stats['hit'] += 1
+        except KeyError:
+            output = side_effects = None
+            if persistent:
+                persistent_key = self._persistent_key(key)
+                try:
+                    output, side_effects = self._persistent[persistent_key]
+                except KeyError:
+                    pass
+                else:
+                    if dependencies.side_effects_valid(side_effects):
+                        self.stats['persistent'] += 1
+                    else:
+                        output = None
+            if output is None:
+                with dependencies.capture() as side_effects:
+                    output = caller()
+                self.stats['miss'] += 1
+                if persistent:
+                    # Worker processes can't write to the cache, so the build process stores the fragment
+                    side_effects = tuple(side_effects)
+                    if not dependencies.record_side_effect('fragment', (persistent_key, output, side_effects)):
+                        self.store(persistent_key, output, side_effects)
+            self._fragments[key] = output, tuple(side_effects)
+
+        for side_effect in side_effects:
+            if not dependencies.record_side_effect(*side_effect):
+                dependencies.apply([side_effect])
+        return output
+
+    def store(self, persistent_key, output, side_effects):
+        """Stores a fragment in the persistent tier of the cache."""
+        if not self._store.read_only:
+            self._persistent[persistent_key] = output, tuple(side_effects)
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds a ``{% cache %}`` tag that caches the rendered content between it and ``{% endcache %}`` using the
+    :class:`FragmentCache` in :attr:`~engineer.conf.EngineerConfiguration.FRAGMENT_CACHE`. The tag takes one or more
+    key expressions, which should include everything the content varies by, and an optional ``persistent`` flag:
+
+    .. code-block:: html+jinja
+
+        {% cache 'sidebar', post_list|length persistent %}
+            ...
+        {% endcache %}
+    """
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        persistent = parser.stream.skip_if('name:persistent')
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        args = [nodes.Const(parser.name), nodes.Const(lineno), nodes.List(key), nodes.Const(persistent)]
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    @staticmethod
+    def _render(name, lineno, key, persistent, caller):
+        return settings.FRAGMENT_CACHE.render(name, lineno, key, persistent, caller)
@@ -1,5 +1,6 @@
 # coding=utf-8
 import logging
+import multiprocessing
 
 from path import path
 
@@ -41,21 +42,72 @@ class LocalLoader(object):
             else:
                 logger.warning("Can't find source post directory %s." % directory)
 
+        settings.POST_CACHE.reset_stats()
+        to_parse = []
         for f in file_list:
+            if f not in settings.POST_CACHE:
+                to_parse.append(f)
+            else:
+                logger.info("'%s': FROM CACHE" % f.basename())
+                cached_posts.append(settings.POST_CACHE[f])
+
+        if settings.BUILD_WORKERS > 1 and len(to_parse) > 1:
+            logger.info("Parsing %d posts using %d worker processes." % (len(to_parse), settings.BUILD_WORKERS))
+            # Worker processes shouldn't inherit an open cache transaction
+            settings.CACHE.sync()
+            pool = multiprocessing.Pool(processes=min(settings.BUILD_WORKERS, len(to_parse)),
+                                        initializer=initialize_worker,
+                                        initargs=(settings.SETTINGS_FILE,))
             try:
-                if f not in settings.POST_CACHE:
-                    logger.debug("'%s': Beginning to parse." % f.basename())
-                    post = Post(f)
-                    logger.debug("'%s': Parsed successfully." % f.basename())
-                    new_posts.append(post)
-                    logger.info("'%s': LOADED" % f.basename())
-                else:
-                    logger.info("'%s': FROM CACHE" % f.basename())
-                    cached_posts.append(settings.POST_CACHE[f])
-            except PostMetadataError as e:
-                logger.warning("SKIPPING '%s': metadata is invalid. %s" % (f.basename(), e.message))
+                # Pool.map returns results in the same order as the input list regardless of the order the workers
+                # finish in, so the resulting collections are the same as a sequential load.
+                results = pool.map(_parse_post, to_parse)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = (_parse_post(f) for f in to_parse)
+
+        for f, post, error in results:
+            if post is None:
+                logger.warning("SKIPPING '%s': metadata is invalid. %s" % (f.basename(), error))
                 continue
+            settings.POST_CACHE[post.source] = post
+            new_posts.append(post)
+            logger.info("'%s': LOADED" % f.basename())
         logger.console("Found %d new posts and loaded %s from the cache." % (len(new_posts), len(cached_posts)))
+        logger.info("Post cache validation: %(stat)d matched by stat signature, %(checksum)d matched by checksum, "
+                    "%(miss)d missed." % settings.POST_CACHE.stats)
 
         settings.CACHE.sync()
         return new_posts, cached_posts
+
+
+def initialize_worker(settings_file):
+    """Prepares a worker process to parse or render on behalf of the main build process."""
+    from engineer.log import bootstrap
+    from engineer.plugins import load_plugins
+
+    # On platforms that fork, worker processes inherit the fully loaded settings and plugins from the parent. Elsewhere
+    # (e.g. Windows) they start from scratch and need to load them before they can parse anything.
+    if getattr(settings, 'SETTINGS_FILE', None) != settings_file:
+        bootstrap()
+        load_plugins()
+        settings.reload(settings_file)
+
+
+def _parse_post(source):
+    """
+    Parses a single post file. Returns a 3-tuple of the source path, the :class:`~engineer.models.Post` (or ``None``
+    if the post couldn't be parsed), and an error message.
+
+    This function is used both for sequential loading and as the task run by worker processes, so the post is not
+    added to the post cache here; the caller is responsible for that.
+    """
+    try:
+        logger.debug("'%s': Beginning to parse." % source.basename())
+        post = Post(source, update_cache=False)
+        logger.debug("'%s': Parsed successfully." % source.basename())
+        return source, post, None
+    except PostMetadataError as e:
+        return source, None, e.message
@@ -1,4 +1,5 @@
 # coding=utf-8
+import hashlib
 import logging
 import re
 from codecs import open
@@ -20,6 +21,7 @@ from engineer.enums import Status
 from engineer.exceptions import PostMetadataError
 from engineer.filters import localtime
 from engineer.plugins import PostProcessor
+from engineer.profiling import timed
 from engineer.util import setonce, slugify, chunk, urljoin, wrap_list
 
 
@@ -38,6 +40,9 @@ class Post(object):
     Represents a post written in Markdown and stored in a file.
 
     :param source: path to the source file for the post.
+    :param update_cache: if ``True`` (the default), the post is stored in the post cache once it has been parsed.
+        Worker processes that parse posts on behalf of the main build process pass ``False`` here; the main process
+        caches the post when it receives it.
     """
     _regex = re.compile(
         r'^[\n|\r\n]*(?P<fence>---)?[\n|\r\n]*(?P<metadata>.+?)[\n|\r\n]*---[\n|\r\n]*(?P<content>.*)[\n|\r\n]*',
@@ -48,11 +53,18 @@ class Post(object):
     _content_raw = setonce()
     _file_contents_raw = setonce()
 
+    # The post's content in its various forms. When a post is loaded from the cache, these are only loaded once
+    # something reads one of them.
+    _body_fields = ('content', 'content_preprocessed', 'content_teaser', '_content_finalized',
+                    _content_raw._name, _file_contents_raw._name)
+
     @staticmethod
     def convert_to_html(content):
         return typogrify(markdown.markdown(content, extensions=['extra', 'codehilite']))
 
-    def __init__(self, source):
+    def __init__(self, source, update_cache=True):
+        self._body_loader = None
+
         self.source = path(source).abspath()
         """The absolute path to the source file for the post."""
 
@@ -74,7 +86,8 @@ class Post(object):
 
         # Handle any preprocessor plugins
         for plugin in PostProcessor.plugins:
-            plugin.preprocess(self, metadata)
+            with timed('plugins', '%s.preprocess' % plugin.get_name()):
+                plugin.preprocess(self, metadata)
 
         self.title = metadata.pop('title', self.source.namebase.replace('-', ' ').replace('_', ' ').title())
         """The title of the post."""
@@ -152,10 +165,51 @@ class Post(object):
 
         # handle any postprocessor plugins
         for plugin in PostProcessor.plugins:
-            plugin.postprocess(self)
+            with timed('plugins', '%s.postprocess' % plugin.get_name()):
+                plugin.postprocess(self)
 
         # update cache
-        settings.POST_CACHE[self.source] = self
+        if update_cache:
+            settings.POST_CACHE[self.source] = self
+
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, so this is where the body of a cached post gets loaded.
+        if name in Post._body_fields and self.__dict__.get('_body_loader') is not None:
+            self._load_body()
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+
+    def _load_body(self):
+        loader = self.__dict__.get('_body_loader')
+        if loader is None:
+            return
+        self._body_loader = None
+        try:
+            body = loader()
+        except KeyError:
+            logger.warning("'%s': Cached content is missing, so reloading the post." % self.source.basename())
+            fresh = Post(self.source, update_cache=False)
+            body = dict((f, fresh.__dict__[f]) for f in Post._body_fields if f in fresh.__dict__)
+        for field, value in body.iteritems():
+            # Anything set since the post was loaded from the cache takes precedence.
+            self.__dict__.setdefault(field, value)
+
+    def cache_split(self):
+        """
+        Splits the post for storage in a :class:`~engineer.cache.SimpleFileCache`. Returns a tuple of a copy of the
+        post without its content, which is small enough to load for every post in every build, and a dict of the
+        content.
+        """
+        self._load_body()
+        record = Post.__new__(Post)
+        record.__dict__.update(self.__dict__)
+        body = dict((f, record.__dict__.pop(f)) for f in Post._body_fields if f in record.__dict__)
+        return record, body
+
+    def cache_attach(self, loader):
+        """Attaches a callable that loads the content removed by :meth:`cache_split` when it's first needed."""
+        self._body_loader = loader
 
     @cached_property
     def url(self):
@@ -234,6 +288,9 @@ class Post(object):
                 item = the_file.read()
 
         self._file_contents_raw = item
+        self.content_hash = hashlib.sha256(item.encode('utf-8')).hexdigest()
+        """A hash of the post's source file. Used to determine which pages need to be regenerated."""
+
         parsed_content = re.match(self._regex, item)
 
         if parsed_content is None or parsed_content.group('metadata') is None:
@@ -266,21 +323,22 @@ class Post(object):
         :param all_posts: An optional :class:`PostCollection` containing all of the posts in the site.
         :return: The rendered HTML as a string.
         """
-        index = all_posts.index(self)
-        if index > 0:  # has newer posts
-            newer_post = all_posts[index - 1]
-        else:
-            newer_post = None
+        return u''.join(self.generate_html(all_posts))
 
-        if index < len(all_posts) - 1:  # has older posts
-            older_post = all_posts[index + 1]
+    def generate_html(self, all_posts=None):
+        """
+        Like :meth:`render_html`, but renders the HTML piece by piece. Returns an iterator of strings.
+        """
+        if all_posts is not None:
+            newer_post = all_posts.newer_of(self)
+            older_post = all_posts.older_of(self)
         else:
-            older_post = None
-        return settings.JINJA_ENV.get_template(self.html_template_path).render(post=self,
-                                                                               newer_post=newer_post,
-                                                                               older_post=older_post,
-                                                                               all_posts=all_posts,
-                                                                               nav_context='post')
+            newer_post = older_post = None
+        return settings.JINJA_ENV.get_template(self.html_template_path).generate(post=self,
+                                                                                 newer_post=newer_post,
+                                                                                 older_post=older_post,
+                                                                                 all_posts=all_posts,
+                                                                                 nav_context='post')
 
     def set_finalized_content(self, content, caller_class):
         """
@@ -317,15 +375,119 @@ class Post(object):
     __repr__ = __unicode__
 
 
+def _invalidates_indexes(method):
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._invalidate()
+        return result
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
 class PostCollection(list):
-    """A collection of :class:`Posts <engineer.models.Post>`."""
+    """
+    A collection of :class:`Posts <engineer.models.Post>`.
+
+    The collection keeps an index of each post's position and of the posts with each tag, so membership tests,
+    :meth:`index`, :meth:`tagged` and the neighbour lookups used when rendering posts don't need to scan the whole
+    collection. The indexes are built the first time they're needed and rebuilt after the collection is modified.
+    """
+
+    # cached_property values that depend on the contents of the collection
+    _derived_properties = ('published', 'drafts', 'review', 'all_tags')
 
     #noinspection PyTypeChecker
     def __init__(self, seq=()):
         list.__init__(self, seq)
+        self._positions = None
+        self._tags = None
         self.listpage_template = settings.JINJA_ENV.get_template('theme/post_list.html')
         self.archive_template = settings.JINJA_ENV.get_template('theme/post_archives.html')
 
+    def _invalidate(self):
+        self._positions = None
+        self._tags = None
+        for name in self._derived_properties:
+            self.__dict__.pop(name, None)
+
+    append = _invalidates_indexes(list.append)
+    extend = _invalidates_indexes(list.extend)
+    insert = _invalidates_indexes(list.insert)
+    remove = _invalidates_indexes(list.remove)
+    pop = _invalidates_indexes(list.pop)
+    sort = _invalidates_indexes(list.sort)
+    reverse = _invalidates_indexes(list.reverse)
+    __setitem__ = _invalidates_indexes(list.__setitem__)
+    __delitem__ = _invalidates_indexes(list.__delitem__)
+    __setslice__ = _invalidates_indexes(list.__setslice__)
+    __delslice__ = _invalidates_indexes(list.__delslice__)
+    __iadd__ = _invalidates_indexes(list.__iadd__)
+    __imul__ = _invalidates_indexes(list.__imul__)
+
+    @property
+    def _position_index(self):
+        if self._positions is None:
+            positions = {}
+            for i, post in enumerate(self):
+                # list.index returns the first position of an item, so keep the first one here too
+                positions.setdefault(post, i)
+            self._positions = positions
+        return self._positions
+
+    @property
+    def _tag_index(self):
+        if self._tags is None:
+            tags = {}
+            for post in self:
+                for tag in set(post.tags):
+                    tags.setdefault(tag, []).append(post)
+            self._tags = tags
+        return self._tags
+
+    def __contains__(self, item):
+        try:
+            return item in self._position_index
+        except TypeError:
+            # unhashable items can't be in the index, but they might still compare equal to something in the list
+            return list.__contains__(self, item)
+
+    def index(self, item, *args):
+        if args:
+            return list.index(self, item, *args)
+        try:
+            return self._position_index[item]
+        except (KeyError, TypeError):
+            return list.index(self, item)
+
+    def position_of(self, post):
+        """Returns the position of *post* in the collection, or ``None`` if it's not in the collection."""
+        try:
+            return self._position_index.get(post)
+        except TypeError:
+            return None
+
+    def newer_of(self, post):
+        """
+        Returns the post before *post* in the collection, or ``None`` if there isn't one. Collections of posts are
+        usually sorted newest first, so this is the next newer post.
+        """
+        position = self.position_of(post)
+        if position is None or position == 0:
+            return None
+        return self[position - 1]
+
+    def older_of(self, post):
+        """
+        Returns the post after *post* in the collection, or ``None`` if there isn't one. Collections of posts are
+        usually sorted newest first, so this is the next older post.
+        """
+        position = self.position_of(post)
+        if position is None or position == len(self) - 1:
+            return None
+        return self[position + 1]
+
     def paginate(self, paginate_by=None):
         if paginate_by is None:
             paginate_by = settings.ROLLUP_PAGE_SIZE
@@ -354,21 +516,21 @@ class PostCollection(list):
     @cached_property
     def all_tags(self):
         """Returns a list of all the unique tags, as strings, that posts in the collection have."""
-        tags = set()
-        for post in self:
-            tags.update(post.tags)
-        return list(tags)
+        return list(self._tag_index.keys())
 
     def tagged(self, tag):
         """Returns a new PostCollection containing the subset of posts that are tagged with *tag*."""
-        return PostCollection([p for p in self if unicode(tag) in p.tags])
+        return PostCollection(self._tag_index.get(unicode(tag), []))
 
     @staticmethod
     def output_path(slice_num):
         return path(settings.OUTPUT_CACHE_DIR / ("page/%s/index.html" % slice_num))
 
     def render_listpage_html(self, slice_num, has_next, has_previous, all_posts=None):
-        return self.listpage_template.render(
+        return u''.join(self.generate_listpage_html(slice_num, has_next, has_previous, all_posts))
+
+    def generate_listpage_html(self, slice_num, has_next, has_previous, all_posts=None):
+        return self.listpage_template.generate(
             post_list=self,
             slice_num=slice_num,
             has_next=has_next,
@@ -377,15 +539,21 @@ class PostCollection(list):
             nav_context='listpage')
 
     def render_archive_html(self, all_posts=None):
-        return self.archive_template.render(post_list=self,
-                                            all_posts=all_posts,
-                                            nav_context='archive')
+        return u''.join(self.generate_archive_html(all_posts))
+
+    def generate_archive_html(self, all_posts=None):
+        return self.archive_template.generate(post_list=self,
+                                              all_posts=all_posts,
+                                              nav_context='archive')
 
     def render_tag_html(self, tag, all_posts=None):
-        return settings.JINJA_ENV.get_template('theme/tags_list.html').render(tag=tag,
-                                                                              post_list=self.tagged(tag),
-                                                                              all_posts=all_posts,
-                                                                              nav_context='tag')
+        return u''.join(self.generate_tag_html(tag, all_posts))
+
+    def generate_tag_html(self, tag, all_posts=None):
+        return settings.JINJA_ENV.get_template('theme/tags_list.html').generate(tag=tag,
+                                                                                post_list=self.tagged(tag),
+                                                                                all_posts=all_posts,
+                                                                                nav_context='tag')
 
 
 class TemplatePage(object):
@@ -403,6 +571,8 @@ class TemplatePage(object):
         settings.URLS[self.name] = self.absolute_url
 
     def render_html(self, all_posts=None):
-        rendered = self.html_template.render(nav_context=self.name,
-                                             all_posts=all_posts)
-        return rendered
+        return u''.join(self.generate_html(all_posts))
+
+    def generate_html(self, all_posts=None):
+        return self.html_template.generate(nav_context=self.name,
+                                           all_posts=all_posts)
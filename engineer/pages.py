@@ -0,0 +1,330 @@
+# coding=utf-8
+import codecs
+import functools
+import gzip
+import logging
+import multiprocessing
+from io import BytesIO
+
+from jinja2 import TemplateNotFound
+from path import path
+
+from engineer.cache import StagedFile
+from engineer.conf import settings
+from engineer.dependencies import post_summary
+from engineer.models import PostCollection, TemplatePage
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+logger = logging.getLogger(__name__)
+
+# The posts being published, as seen by a worker process
+_worker_posts = None
+
+
+def buffered(strings, size):
+    """
+    Joins the strings in the iterable *strings* into chunks at least *size* characters long, except for the last one.
+    """
+    pending = []
+    length = 0
+    for s in strings:
+        pending.append(s)
+        length += len(s)
+        if length >= size:
+            yield ''.join(pending)
+            pending = []
+            length = 0
+    if pending:
+        yield ''.join(pending)
+
+
+def gzipped(chunks):
+    """
+    Compresses *chunks*, an iterable of byte strings, into a gzip stream as they're produced. Yields the compressed
+    bytes in chunks. The gzip header's timestamp is fixed, so the output only changes when the content does.
+    """
+    output = BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=output, mtime=0) as the_file:
+        for chunk in chunks:
+            the_file.write(chunk)
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+
+class PageJob(object):
+    """
+    A file in the site that's generated by rendering templates.
+
+    Page jobs may be rendered in worker processes, so they only hold data that can be pickled. They refer to posts by
+    their position in the collection of all the posts being published, which is passed to :meth:`render`.
+
+    Pages are rendered piece by piece by :meth:`generate` and written to disk in chunks of :attr:`chunk_size`
+    characters by :meth:`stream`, so a page's content is never held in memory all at once.
+
+    :param output_path: The path to output the page to.
+    :param template_names: The names of the templates the page is rendered with.
+    """
+    encoding = 'UTF-8'
+    chunk_size = 64 * 1024
+
+    def __init__(self, output_path, template_names):
+        self.output_path = path(output_path)
+        self.template_names = list(template_names)
+        self.inputs = None
+
+    def posts(self, all_posts):
+        """Returns the posts whose content appears on the page."""
+        return []
+
+    def render(self, all_posts):
+        """Renders the page. Returns its content."""
+        return u''.join(self.generate(all_posts))
+
+    def generate(self, all_posts):
+        """Renders the page piece by piece. Returns an iterable of strings that make up its content."""
+        raise NotImplementedError()
+
+    def stream(self, all_posts):
+        """Renders the page. Yields the bytes to output in chunks."""
+        chunks = buffered(self.generate(all_posts), self.chunk_size)
+        if self.encoding is None:
+            for chunk in chunks:
+                yield chunk
+            return
+        encoder = codecs.getincrementalencoder(self.encoding)()
+        for chunk in chunks:
+            yield encoder.encode(chunk)
+        yield encoder.encode(u'', final=True)
+
+
+class PostPageJob(PageJob):
+    def __init__(self, post, position):
+        super(PostPageJob, self).__init__(post.output_path, [post.html_template_path])
+        self.position = position
+
+    def posts(self, all_posts):
+        return [all_posts[self.position]]
+
+    def generate(self, all_posts):
+        return all_posts[self.position].generate_html(all_posts)
+
+
+class RollupPageJob(PageJob):
+    def __init__(self, slice_num, start, end, has_next, has_previous, output_path=None):
+        if output_path is None:
+            output_path = PostCollection.output_path(slice_num)
+        super(RollupPageJob, self).__init__(output_path, ['theme/post_list.html'])
+        self.slice_num = slice_num
+        self.start = start
+        self.end = end
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def posts(self, all_posts):
+        return all_posts[self.start:self.end]
+
+    def generate(self, all_posts):
+        return PostCollection(self.posts(all_posts)).generate_listpage_html(self.slice_num,
+                                                                            self.has_next,
+                                                                            self.has_previous)
+
+
+class ArchivePageJob(PageJob):
+    def __init__(self):
+        super(ArchivePageJob, self).__init__(settings.OUTPUT_CACHE_DIR / 'archives/index.html',
+                                             ['theme/post_archives.html'])
+
+    def generate(self, all_posts):
+        return all_posts.generate_archive_html(all_posts)
+
+
+class TagPageJob(PageJob):
+    def __init__(self, tag, output_path):
+        super(TagPageJob, self).__init__(output_path, ['theme/tags_list.html'])
+        self.tag = tag
+
+    def posts(self, all_posts):
+        return all_posts.tagged(self.tag)
+
+    def generate(self, all_posts):
+        return all_posts.generate_tag_html(self.tag, all_posts)
+
+
+class TemplatePageJob(PageJob):
+    def __init__(self, template_page, template_path):
+        super(TemplatePageJob, self).__init__(template_page.output_path / template_page.output_file_name,
+                                              [template_page.html_template.name])
+        self.template_path = template_path
+
+    def posts(self, all_posts):
+        # Template pages can show anything, including the content of any post
+        return all_posts
+
+    def generate(self, all_posts):
+        return TemplatePage(self.template_path).generate_html(all_posts)
+
+
+def feed_item(post):
+    """
+    Returns the title, link and content of *post*'s feed item, rendered using :attr:`FeedJob.templates`. Each is
+    rendered at most once per build and kept between builds in the
+    :attr:`~engineer.conf.EngineerConfiguration.FRAGMENT_CACHE`, keyed by the post and the template, so the same items
+    are shared by every feed.
+    """
+    key = (post_summary(post), post.content_hash)
+    return [settings.FRAGMENT_CACHE.render(name, None, key, True, functools.partial(_render_feed_template, name, post))
+            for name in FeedJob.templates]
+
+
+def _render_feed_template(name, post):
+    return settings.JINJA_ENV.get_template(name).render(post=post)
+
+
+class FeedJob(PageJob):
+    """
+    A feed of the most recent posts, or of the most recent posts with *tag* if it's given.
+    """
+    encoding = None
+    templates = ['core/feeds/title.jinja2', 'core/feeds/link.jinja2', 'core/feeds/content.jinja2']
+
+    def __init__(self, feed_class, output_path, tag=None):
+        super(FeedJob, self).__init__(output_path, self.templates)
+        self.feed_class = feed_class
+        self.tag = tag
+
+    def posts(self, all_posts):
+        if self.tag is not None:
+            all_posts = all_posts.tagged(self.tag)
+        return all_posts[:settings.FEED_ITEM_LIMIT]
+
+    def render(self, all_posts):
+        if self.tag is None:
+            feed = self.feed_class(
+                title=settings.FEED_TITLE,
+                link=settings.SITE_URL,
+                description=settings.FEED_DESCRIPTION,
+                feed_url=settings.FEED_URL
+            )
+        else:
+            feed = self.feed_class(
+                title=u'%s: %s' % (settings.FEED_TITLE, self.tag),
+                link=u'{0}{1}'.format(settings.SITE_URL, settings.URLS['tag'](self.tag)),
+                description=u"The %s most recent posts tagged '%s' from %s." % (settings.FEED_ITEM_LIMIT, self.tag,
+                                                                                 settings.SITE_URL),
+                feed_url=settings.URLS['tag_feed'](self.tag)
+            )
+        for post in self.posts(all_posts):
+            title, link, content = feed_item(post)
+            feed.add_item(
+                title=title,
+                link=link,
+                description=content,
+                pubdate=post.timestamp,
+                unique_id=post.absolute_url)
+        return feed.writeString('UTF-8')
+
+    def generate(self, all_posts):
+        return [self.render(all_posts)]
+
+
+class SitemapJob(PageJob):
+    """
+    A sitemap rendered from a custom :ref:`sitemap template <sitemap template>`. Sites without one get sitemaps written
+    by :func:`~engineer.sitemap.write_sitemaps` instead.
+    """
+    templates = ['sitemap.xml', 'theme/sitemap.xml']
+
+    def __init__(self, output_path):
+        super(SitemapJob, self).__init__(output_path, self.templates)
+
+    @classmethod
+    def has_template(cls):
+        """``True`` if the site or its theme provides a sitemap template."""
+        try:
+            settings.JINJA_ENV.select_template(cls.templates)
+        except TemplateNotFound:
+            return False
+        return True
+
+    def generate(self, all_posts):
+        return settings.JINJA_ENV.select_template(self.templates).generate(post_list=all_posts)
+
+    def stream(self, all_posts):
+        return gzipped(super(SitemapJob, self).stream(all_posts))
+
+
+def render_pages(jobs, all_posts, workers=1, template_dependencies=None, stage=StagedFile):
+    """
+    Renders *jobs*, using a pool of *workers* processes if *workers* is more than one. Each page is streamed to a
+    :class:`~engineer.cache.StagedFile` next to its output path as it's rendered. Yields a tuple of
+    ``(job, staged, side_effects)`` for each job, in the same order as *jobs*; the caller should move the staged file
+    into place, e.g. using :meth:`~engineer.cache.OutputManifest.write_staged`. The side effects are those captured by
+    :meth:`~engineer.dependencies.DependencyGraph.capture` while the page was rendered; the caller should apply them.
+
+    :param stage: A callable taking an output path and an iterable of byte strings, used instead of
+        :class:`~engineer.cache.StagedFile` to stage pages rendered in this process, e.g.
+        :meth:`~engineer.cache.OutputWriter.stage`. Worker processes always use :class:`~engineer.cache.StagedFile`.
+
+    :param template_dependencies: A :class:`~engineer.dependencies.TemplateDependencies` used to load all the
+        templates the pages need before starting the worker processes, so that they inherit the compiled templates.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            staged, side_effects = _render(job, all_posts, stage)
+            yield job, staged, side_effects
+        return
+
+    if template_dependencies is not None:
+        names = set()
+        for job in jobs:
+            names.update(template_dependencies.closure(*job.template_names) or [])
+        for name in names:
+            try:
+                settings.JINJA_ENV.get_template(name)
+            except TemplateNotFound:
+                pass
+
+    # Worker processes shouldn't inherit an open cache transaction, and they need to be able to read everything the
+    # build has cached so far, like the content of new posts.
+    settings.CACHE.sync()
+
+    workers = min(workers, len(jobs))
+    logger.info("Rendering %d pages using %d worker processes." % (len(jobs), workers))
+    pool = multiprocessing.Pool(processes=workers,
+                                initializer=_initialize_worker,
+                                initargs=(settings.SETTINGS_FILE, list(all_posts), dict(settings.URLS)))
+    try:
+        # imap returns results in the same order as the jobs regardless of the order the workers finish in
+        results = pool.imap(_render_in_worker, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+        for job, (staged, side_effects) in zip(jobs, results):
+            yield job, staged, side_effects
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _render(job, all_posts, stage=StagedFile):
+    with settings.BUILD_DEPENDENCIES.capture() as side_effects:
+        staged = stage(job.output_path, job.stream(all_posts))
+    return staged, side_effects
+
+
+def _initialize_worker(settings_file, posts, urls):
+    global _worker_posts
+    from engineer.loaders import initialize_worker
+
+    initialize_worker(settings_file)
+    # Workers only read from the cache; the main build process records everything
+    settings.CACHE.read_only = True
+    settings.URLS.update(urls)
+    _worker_posts = PostCollection(posts)
+
+
+def _render_in_worker(job):
+    return _render(job, _worker_posts)
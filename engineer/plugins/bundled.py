@@ -20,26 +20,36 @@ class PostBreaksProcessor(PostProcessor):
     _regex = re.compile(r'^(?P<teaser_content>.*?)(?P<break>\s*<?!?-{2,}\s*more\s*-{2,}>?)\s*(?P<rest_of_content>.*)',
                         re.DOTALL)
 
+    _marker = '<!-- more -->'
+
     @classmethod
     def preprocess(cls, post, metadata):
-        from engineer.models import Post
+        post.content_teaser = None
 
         # First check if either form of the break marker is present using the regex
         parsed_content = re.match(cls._regex, post.content_preprocessed)
         if parsed_content is None or parsed_content.group('teaser_content') is None:
-            post.content_teaser = None
             return post
 
-        # Post is meant to be broken apart, so normalize the break marker to the HTML comment form.
+        # Post is meant to be broken apart, so normalize the break marker to the HTML comment form. The teaser is
+        # split out in postprocess.
         post.content_preprocessed = unicode(parsed_content.group('teaser_content') +
-                                            '\n\n<!-- more -->\n\n' +
+                                            '\n\n%s\n\n' % cls._marker +
                                             parsed_content.group('rest_of_content'))
+        return post
+
+    @classmethod
+    def postprocess(cls, post):
+        if cls._marker not in post.content_preprocessed:
+            return post
 
-        # Convert the full post to HTML, then use the regex again to split the resulting HTML post. This is needed
-        # since Markdown might have links in the first half of the post that are listed at the bottom. By converting
-        # the whole post to HTML first then splitting we get a correctly processed HTML teaser.
-        parsed_content = re.match(cls._regex, Post.convert_to_html(post.content_preprocessed))
-        post.content_teaser = parsed_content.group('teaser_content')
+        # Split the post's HTML content using the regex again. Splitting the whole post after it's been converted to
+        # HTML is needed since Markdown might have links in the first half of the post that are listed at the
+        # bottom. By the time postprocess is called the post has already been converted, so there's no need to
+        # convert it a second time just to get the teaser.
+        parsed_content = re.match(cls._regex, post.content)
+        if parsed_content is not None:
+            post.content_teaser = parsed_content.group('teaser_content')
         return post
 
 
@@ -373,6 +383,18 @@ class JinjaPostProcessor(PostProcessor):
         return post, metadata
 
 
+class FragmentCachePlugin(JinjaEnvironmentPlugin):
+    """Adds the ``{% cache %}`` tag to the Jinja environment. See :class:`~engineer.fragments.FragmentCacheExtension`."""
+
+    @classmethod
+    def update_environment(cls, jinja_env):
+        from engineer.fragments import FragmentCacheExtension
+
+        super(FragmentCachePlugin, cls).update_environment(jinja_env)
+        jinja_env.add_extension(FragmentCacheExtension)
+        cls.get_logger().debug("Registered the fragment cache extension.")
+
+
 class BundledFilters(JinjaEnvironmentPlugin):
     filters = {
         'date': format_datetime,
@@ -1,10 +1,17 @@
 # coding=utf-8
+import hashlib
 import logging
+import os
 import platform
+import re
 import subprocess
+import time
+from multiprocessing.pool import ThreadPool
 
 from path import path
 
+from engineer import version
+from engineer.cache import StagedFile
 from engineer.conf import settings
 
 
@@ -13,45 +20,259 @@ __author__ = 'Tyler Butler <tyler@tylerbutler.com>'
 logger = logging.getLogger(__name__)
 
 
-def convert_less(infile, outfile, minify=True):
-    if minify:
-        preprocessor = str(settings.LESS_PREPROCESSOR) + ' -x'
-    else:
-        preprocessor = str(settings.LESS_PREPROCESSOR)
+class LessCompilationError(Exception):
+    """Raised when :program:`lessc` fails to compile a LESS file."""
+
+    def __init__(self, infile, message):
+        super(LessCompilationError, self).__init__(message)
+        self.infile = infile
+
+
+def _less_command(infile, outfile, *options):
+    # lessc accepts options anywhere on its command line, so they're appended in case LESS_PREPROCESSOR starts with an
+    # interpreter rather than lessc itself
+    return str.format(str(settings.LESS_PREPROCESSOR), infile=infile, outfile=outfile).split() + list(options)
+
 
-    cmd = str.format(preprocessor, infile=infile, outfile=outfile).split()
+def _run_lessc(infile, cmd):
     try:
-        subprocess.check_output(cmd)
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
-        logger.critical("Error pre-processing LESS file %s." % file)
-        logger.critical(e.output)
-        exit(1355)
-    except WindowsError as e:
-        logger.critical("Unexpected error pre-processing LESS file %s." % file)
-        logger.critical(e.strerror)
-        exit(1355)
-    except Exception as e:
-        logger.critical("Unexpected error pre-processing LESS file %s." % file)
-        logger.critical(e.message)
+        raise LessCompilationError(infile, "Error pre-processing LESS file %s.\n%s" % (infile, e.output))
+    except OSError as e:
+        message = "Unexpected error pre-processing LESS file %s.\n%s" % (infile, e.strerror)
         if platform.system() != 'Windows':
-            logger.critical("Are you sure lessc is on your path?")
+            message += "\nAre you sure lessc is on your path?"
+        raise LessCompilationError(infile, message)
+
+
+# Strings are matched so that comment markers inside them are left alone
+_less_comments = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/|//[^\n]*''', re.DOTALL)
+_less_imports = re.compile(r'''@import\s*(?:\(([^)]*)\)\s*)?(?:url\(\s*)?(?:"([^"]*)"|'([^']*)'|([^\s'";)]+))''')
+
+
+def parse_less_imports(source):
+    """
+    Returns the files imported by the LESS *source*, as a list of ``(file name, options)`` tuples in the order they're
+    imported. Imports of plain CSS and of URLs are left out, since :program:`lessc` doesn't read them.
+    """
+    imports = []
+    source = _less_comments.sub(lambda m: m.group(1) or '', source)
+    for match in _less_imports.finditer(source):
+        options = set(o.strip() for o in (match.group(1) or '').split(','))
+        name = next(n for n in match.group(2, 3, 4) if n is not None)
+        if '//' in name or 'css' in options:
+            continue
+        if name.endswith('.css') and not options & set(['less', 'inline']):
+            continue
+        if not re.search(r'(\.[a-z]*$)|([?;].*)$', name):
+            name += '.less'
+        imports.append((name, options))
+    return imports
+
+
+def less_dependencies(infile):
+    """
+    Returns the absolute paths of all the files *infile* imports, directly or indirectly. Like :program:`lessc`,
+    imports are looked up next to the importing file, then next to *infile*. Imports whose names use variables can't
+    be found, and are skipped.
+    """
+    infile = path(infile).abspath()
+    dependencies = []
+    to_read = [infile]
+    while to_read:
+        the_file = to_read.pop(0)
+        for name, options in parse_less_imports(the_file.text(encoding='utf-8')):
+            if '@{' in name:
+                logger.debug("Can't track the import of %s by LESS file %s." % (name, the_file))
+                continue
+            candidates = [(the_file.dirname() / name).normpath(), (infile.dirname() / name).normpath()]
+            imported = next((c for c in candidates if c.isfile()), candidates[0])
+            if imported in dependencies or imported == infile:
+                continue
+            dependencies.append(imported)
+            if imported.isfile() and 'inline' not in options:
+                to_read.append(imported)
+    return dependencies
+
+
+def _compile(infile, outfile, minify=True):
+    """
+    Compiles *infile* to a temporary file next to *outfile* and returns the path of the temporary file, so *outfile*
+    itself is only ever replaced.
+    """
+    staging_path = outfile.dirname() / ('.%s.%d.tmp' % (outfile.name, os.getpid()))
+    try:
+        _run_lessc(infile, _less_command(infile, staging_path, *(['-x'] if minify else [])))
+    except LessCompilationError:
+        staging_path.remove_p()
+        raise
+    return staging_path
+
+
+def _replace(outfile, staging_path, outputs=None):
+    """
+    Puts the CSS compiled to *staging_path* at *outfile*, using the :class:`~engineer.cache.OutputManifest` *outputs*
+    if it's given. Returns the CSS.
+    """
+    css = staging_path.bytes()
+    if outputs is not None:
+        staging_path.remove()
+        outputs.write(outfile, css)
+    else:
+        # The file is replaced rather than overwritten in case it's linked to a published copy
+        outfile.remove_p()
+        staging_path.rename(outfile)
+    return css
+
+
+def convert_less(infile, outfile, minify=True):
+    try:
+        _replace(path(outfile), _compile(infile, path(outfile), minify))
+    except LessCompilationError as e:
+        logger.critical(e.message)
         exit(1355)
 
 
+class LessCache(object):
+    """
+    A cache of compiled LESS files, keyed by the file and everything it imports.
+
+    Each entry records the files the LESS file imported when it was compiled, along with a digest of the content of the
+    LESS file and all those imports. An entry is only valid as long as that digest is unchanged, so editing a partial
+    invalidates every stylesheet that imports it. If the imports themselves change, the file that changed to add or
+    remove an import is part of the digest too.
+    """
+
+    def __init__(self, store, namespace='LESS_GRAPH'):
+        self._records = store.namespace(namespace)
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Resets the counts in :attr:`stats`."""
+        self.stats = {
+            'hit': 0,  # the cached CSS was used
+            'miss': 0,  # the file or one of its imports changed, or it wasn't cached
+        }
+
+    @staticmethod
+    def key(infile):
+        return unicode(path(infile).abspath())
+
+    @staticmethod
+    def graph_digest(infile, dependencies, minify):
+        """Returns a digest of the content of *infile* and its *dependencies*."""
+        h = hashlib.sha256()
+        h.update('%s:%s:%s:' % (version, settings.LESS_PREPROCESSOR, minify))
+        for the_file in [path(infile)] + sorted(path(d) for d in dependencies):
+            h.update(the_file.encode('utf-8'))
+            h.update(the_file.read_hexhash('sha256') if the_file.isfile() else '-')
+        return h.hexdigest()
+
+    def get(self, infile, minify):
+        """Returns the cached CSS for *infile*, or ``None`` if it isn't cached or is out of date."""
+        try:
+            record = self._records[self.key(infile)]
+        except KeyError:
+            record = None
+        if record is None or record['digest'] != self.graph_digest(infile, record['dependencies'], minify):
+            self.stats['miss'] += 1
+            return None
+        self.stats['hit'] += 1
+        return record['css']
+
+    def set(self, infile, minify, dependencies, css):
+        """Caches the *css* compiled from *infile*, which imported *dependencies*."""
+        self._records[self.key(infile)] = {
+            'dependencies': [unicode(d) for d in dependencies],
+            'digest': self.graph_digest(infile, dependencies, minify),
+            'css': css,
+        }
+
+
+def _compile_with_dependencies(item):
+    infile, outfile, minify = item
+    start = time.time()
+    try:
+        staging_path = _compile(infile, outfile, minify)
+        return staging_path, less_dependencies(infile), time.time() - start, None
+    except LessCompilationError as e:
+        return None, None, time.time() - start, e
+
+
+def compile_less(files, minify=True, workers=1, cache=None, outputs=None):
+    """
+    Compiles the LESS files in *files*, an iterable of ``(LESS file, CSS file)`` tuples. Files whose output is cached
+    in *cache*, a :class:`LessCache`, aren't compiled again. The rest are compiled concurrently using *workers* threads,
+    each of which runs :program:`lessc` once, and their imports are found by reading the LESS files.
+
+    CSS files are only written if their content changes, and are always replaced rather than overwritten; if
+    *outputs*, an :class:`~engineer.cache.OutputManifest`, is given, they're written using it. Returns a dict mapping
+    each LESS file to a dict of statistics: the ``'seconds'`` spent compiling it and whether it was ``'cached'``.
+    Raises :exc:`LessCompilationError` if a file can't be compiled.
+    """
+    stats = {}
+    to_compile = []
+    for infile, outfile in sorted(set((path(i), path(o).abspath()) for i, o in files)):
+        css = None if cache is None else cache.get(infile, minify)
+        if css is None:
+            to_compile.append((infile, outfile, minify))
+        else:
+            if outputs is not None:
+                outputs.write(outfile, css)
+            elif not outfile.isfile() or outfile.bytes() != css:
+                _replace(outfile, StagedFile(outfile, [css]).path)
+            stats[infile] = {'seconds': 0.0, 'cached': True}
+            logger.debug("Found cached output for LESS file %s." % infile.name)
+
+    if to_compile:
+        workers = max(1, min(workers, len(to_compile)))
+        logger.info("Compiling %d LESS files using %d threads." % (len(to_compile), workers))
+        pool = ThreadPool(processes=workers)
+        try:
+            results = pool.map(_compile_with_dependencies, to_compile)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        errors = [error for staging_path, dependencies, seconds, error in results if error is not None]
+        if errors:
+            for staging_path, dependencies, seconds, error in results:
+                if staging_path is not None:
+                    staging_path.remove_p()
+            raise errors[0]
+        for (infile, outfile, minify), (staging_path, dependencies, seconds, _) in zip(to_compile, results):
+            css = _replace(outfile, staging_path, outputs)
+            if cache is not None:
+                cache.set(infile, minify, dependencies, css)
+            stats[infile] = {'seconds': seconds, 'cached': False}
+            logger.info("Preprocessed LESS file %s ==> %s in %.3f seconds." % (infile.name, outfile.name, seconds))
+    return stats
+
+
 # Helper function to preprocess LESS files on demand
 def preprocess_less(less_file):
-    input_file = path(settings.OUTPUT_CACHE_DIR / settings.ENGINEER.STATIC_DIR.basename() / less_file)
-    css_file = path("%s.css" % str(input_file)[:-5])
-    is_cached = input_file in settings.LESS_CACHE
-    exists = css_file.exists()
-    if is_cached and not exists:
-        with open(css_file, mode='wb') as the_file:
-            the_file.write(settings.LESS_CACHE[input_file])
-        logger.info('Found cached output for LESS file %s. Skipping recompilation.' % less_file)
-    elif not is_cached or not css_file.exists():
-        convert_less(input_file, css_file, settings.COMPRESSOR_ENABLED)
-        with open(css_file, mode='rb') as the_file:
-            contents = the_file.read()
-        settings.LESS_CACHE[input_file] = contents
-        logger.info("Preprocessed LESS file %s ==> %s." % (less_file, css_file.name))
+    if not settings.BUILD_DEPENDENCIES.record_side_effect('less', less_file):
+        settings.LESS_FILE_LIST.add(less_file)
+    # The file is preprocessed by the build's LESS stage; see preprocess_less_files
     return ""
+
+
+def preprocess_less_files(less_files, minify=True, workers=1):
+    """
+    Preprocesses the LESS files requested by templates using :func:`preprocess_less`, given as paths relative to the
+    static folder in the output cache, into CSS files next to them. Exits the build if a file can't be compiled.
+    Returns the statistics from :func:`compile_less`, keyed by the paths of the LESS files.
+    """
+    files = []
+    for less_file in less_files:
+        input_file = path(settings.OUTPUT_STATIC_DIR / less_file)
+        files.append((input_file, path("%s.css" % str(input_file)[:-5])))
+    try:
+        stats = compile_less(files, minify, workers, settings.LESS_CACHE, settings.OUTPUT_MANIFEST)
+    except LessCompilationError as e:
+        logger.critical(e.message)
+        exit(1355)
+    return dict((unicode(settings.OUTPUT_STATIC_DIR.relpathto(f)).replace('\\', '/'), s) for f, s in stats.items())
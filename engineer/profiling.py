@@ -0,0 +1,265 @@
+# coding=utf-8
+import cProfile
+import logging
+import signal
+from collections import defaultdict
+from contextlib import contextmanager
+from timeit import default_timer as clock
+
+from jinja2 import Template
+from path import path
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+logger = logging.getLogger(__name__)
+
+# The profile of the build in progress, if it's timing plugin hooks and templates
+_active = None
+
+
+@contextmanager
+def timed(category, name):
+    """
+    Adds the time spent in the block to the timings of *name* in *category*, e.g. ``'plugins'``, of the active
+    :class:`BuildProfile`. Does nothing if no profile is active.
+    """
+    profile = _active
+    if profile is None:
+        yield
+        return
+    start = clock()
+    try:
+        yield
+    finally:
+        profile.add(category, name, clock() - start)
+
+
+class ProfiledTemplate(Template):
+    """
+    A Jinja template whose renders are timed by the active :class:`BuildProfile`. The blocks a template defines are
+    timed as part of that template, even when they're rendered by the template it extends.
+    """
+
+    @classmethod
+    def _from_namespace(cls, environment, namespace, globals):
+        # The compiled template refers to its block functions by name when calling super(), which finds the parent
+        # block by identity, so the functions are replaced in the template's namespace rather than wrapped afterwards
+        name = namespace['name'] or '<string>'
+        namespace['root'] = _profiled(name, namespace['root'], True)
+        for block, func in namespace['blocks'].items():
+            namespace['blocks'][block] = namespace['block_' + block] = _profiled(name, func, False)
+        return super(ProfiledTemplate, cls)._from_namespace(environment, namespace, globals)
+
+
+def _profiled(name, func, root):
+    if getattr(func, 'profiled', False):
+        # Precompiled templates' namespaces are shared by every load of the template
+        return func
+
+    def render(context):
+        if _active is None:
+            return func(context)
+        return _active.render(name, func(context), root)
+
+    render.profiled = True
+    return render
+
+
+class StackSampler(object):
+    """
+    Samples the build process' call stack every *interval* seconds of CPU time and counts the stacks in the collapsed
+    format used by flamegraph tools. Only the main thread is sampled. Sampling isn't available on Windows.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self._previous_handler = None
+
+    @staticmethod
+    def available():
+        return hasattr(signal, 'setitimer') and hasattr(signal, 'SIGPROF')
+
+    def start(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        # Don't interrupt system calls, e.g. reads from worker processes, when a sample is taken
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+
+    #noinspection PyUnusedLocal
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, file_path):
+        with open(file_path, 'wb') as the_file:
+            for stack, count in sorted(self.stacks.iteritems()):
+                the_file.write('%s %d\n' % (stack, count))
+
+
+class BuildProfile(object):
+    """
+    Times the stages of a build. If *hooks* is ``True``, every plugin hook call and every template render is timed
+    too, aggregated by plugin hook and template name; templates are timed both inclusive of and excluding the
+    templates they render, e.g. through ``include`` or ``extends``.
+
+    If *dump_dir* is set, the build is also run under :mod:`cProfile`, whose stats are written to
+    :file:`build.pstats` in *dump_dir*, and its stack is sampled to write :file:`build.collapsed`, which flamegraph
+    tools can read.
+    """
+
+    def __init__(self, hooks=False, dump_dir=None):
+        self.hooks = hooks or dump_dir is not None
+        self.dump_dir = path(dump_dir) if dump_dir is not None else None
+        self.stages = []
+        self.plugins = {}
+        self.templates = {}
+        self.total = None
+        self.pstats_path = None
+        self.collapsed_path = None
+        self._stage = None
+        self._started = None
+        self._env = None
+        self._template_class = None
+        self._rendering = []
+        self._depth = defaultdict(int)
+        self._profiler = None
+        self._sampler = None
+
+    def start(self, env, stage=None):
+        """
+        Starts timing the build, and stage *stage* if it's given. Templates loaded by the Jinja environment *env*
+        from now on are timed.
+        """
+        global _active
+        if _active is not None:
+            # A previous build stopped by an error
+            _active.stop()
+        self._started = clock()
+        if stage is not None:
+            self.stage(stage)
+        if not self.hooks:
+            return
+
+        _active = self
+        self._env = env
+        self._template_class = env.template_class
+        env.template_class = ProfiledTemplate
+        env.cache.clear()
+        if self.dump_dir is not None:
+            self.dump_dir.makedirs_p()
+            try:
+                if not StackSampler.available():
+                    raise ValueError("not supported on this platform")
+                self._sampler = StackSampler()
+                self._sampler.start()
+            except ValueError as e:
+                # Signal handlers can only be set in the main thread
+                self._sampler = None
+                logger.warning("Couldn't sample the build's call stack, so no collapsed stacks will be written: %s" % e)
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stage(self, name):
+        """Ends the current stage of the build, if there is one, and starts timing the stage *name*."""
+        now = clock()
+        if self._stage is not None:
+            self.stages.append((self._stage[0], now - self._stage[1]))
+        self._stage = (name, now) if name is not None else None
+
+    def add(self, category, name, seconds):
+        """Adds a call of *name* that took *seconds* to the timings in *category*."""
+        timings = getattr(self, category).setdefault(name, {'calls': 0, 'seconds': 0.0})
+        timings['calls'] += 1
+        timings['seconds'] += seconds
+
+    def render(self, name, events, root):
+        """
+        Times the render of template *name*, whose output is generated by *events*. *root* is ``False`` if *events*
+        renders one of the template's blocks.
+        """
+        # Time spent in the templates this one renders, so it can be subtracted from this one's own time
+        nested = [0.0]
+        seconds = 0.0
+        outermost = self._depth[name] == 0
+        self._depth[name] += 1
+        try:
+            while True:
+                self._rendering.append(nested)
+                start = clock()
+                try:
+                    event = next(events)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed = clock() - start
+                    self._rendering.pop()
+                    seconds += elapsed
+                    if self._rendering:
+                        self._rendering[-1][0] += elapsed
+                yield event
+        finally:
+            self._depth[name] -= 1
+            timings = self.templates.setdefault(name, {'renders': 0, 'seconds': 0.0, 'self_seconds': 0.0})
+            if root:
+                timings['renders'] += 1
+            if outermost:
+                # Blocks rendered by the template itself are already included in its time
+                timings['seconds'] += seconds
+            timings['self_seconds'] += seconds - nested[0]
+
+    def stop(self):
+        """Stops timing the build and returns the results. Calling :meth:`stop` again has no effect."""
+        global _active
+        if self._started is None:
+            return self.results
+        self.stage(None)
+        self.total = clock() - self._started
+        self._started = None
+        self.pstats_path = self.collapsed_path = None
+        if _active is self:
+            _active = None
+            self._env.template_class = self._template_class
+            self._env.cache.clear()
+            if self._profiler is not None:
+                self._profiler.disable()
+                self.pstats_path = self.dump_dir / 'build.pstats'
+                self._profiler.dump_stats(self.pstats_path)
+            if self._sampler is not None:
+                self._sampler.stop()
+                self.collapsed_path = self.dump_dir / 'build.collapsed'
+                self._sampler.write(self.collapsed_path)
+        return self.results
+
+    @property
+    def results(self):
+        """
+        The timings as a dict of plain values that can be stored with the build's stats:
+
+        * ``total``: the duration of the build in seconds
+        * ``stages``: a list of ``(stage, seconds)`` tuples in the order the stages ran
+        * ``plugins``: a dict of the ``calls`` and ``seconds`` of each plugin hook, keyed by e.g.
+          ``'PostBreaksProcessor.preprocess'``
+        * ``templates``: a dict of the ``renders``, ``seconds`` and ``self_seconds`` of each template, keyed by name
+        * ``pstats``, ``collapsed``: the paths of the files dumped, or ``None``
+        """
+        return {
+            'total': self.total,
+            'stages': list(self.stages),
+            'plugins': dict(self.plugins),
+            'templates': dict(self.templates),
+            'pstats': unicode(self.pstats_path) if self.pstats_path else None,
+            'collapsed': unicode(self.collapsed_path) if self.collapsed_path else None,
+        }
+
+    def slowest(self, category, count=10, key='seconds'):
+        """Returns the *count* slowest ``(name, timings)`` items in *category*, slowest first."""
+        return sorted(getattr(self, category).iteritems(), key=lambda item: item[1][key], reverse=True)[:count]
@@ -0,0 +1,209 @@
+# coding=utf-8
+import logging
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+import times
+from path import path
+
+from engineer.cache import StagedFile
+from engineer.conf import settings
+from engineer.dependencies import digest, post_summary
+from engineer.pages import buffered, gzipped
+from engineer.util import urljoin
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+logger = logging.getLogger(__name__)
+
+# The limits the sitemap protocol sets for a single sitemap file
+MAX_URLS = 50000
+MAX_BYTES = 50 * 1024 * 1024
+
+LASTMOD_FORMAT = '%Y-%m-%dT%H:%MZ'
+
+_URLSET_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+                 '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+_URLSET_FOOTER = '</urlset>\n'
+_INDEX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+_INDEX_FOOTER = '</sitemapindex>\n'
+
+
+class SitemapDates(object):
+    """
+    Records when the content at each URL in the sitemap last changed, so that its ``lastmod`` date stays the same
+    between builds until it changes again.
+
+    Each URL is recorded with a digest of its content. If the digest differs from the one recorded in the previous
+    build, the content is considered to have changed at the time of the current build. URLs that weren't in the
+    previous build's sitemap get the date they were first published, if it's known.
+    """
+
+    def __init__(self, store, namespace='SITEMAP_DATES'):
+        self._records = store.namespace(namespace)
+        self._previous = None
+        self._current = {}
+        self.now = times.now()
+
+    def lastmod(self, loc, content_digest, first_seen=None):
+        """
+        Returns the date the content at *loc*, whose digest is *content_digest*, last changed. *first_seen* is used if
+        *loc* wasn't in the previous build's sitemap.
+        """
+        if self._previous is None:
+            self._previous = self._records.get('dates', {})
+        previous = self._previous.get(loc)
+        if previous is None:
+            lastmod = first_seen or self.now
+        elif previous[0] != content_digest:
+            lastmod = self.now
+        else:
+            lastmod = previous[1]
+        self._current[loc] = content_digest, lastmod
+        return lastmod
+
+    def save(self):
+        """Stores the dates of the URLs seen in the current build, forgetting the rest."""
+        if self._current != self._previous:
+            self._records['dates'] = self._current
+
+
+def sitemap_entries(all_posts, template_pages, template_dependencies, dates):
+    """
+    Returns the entries in the site's sitemap: the home page, template pages, posts and tag pages, in that order. Each
+    entry is a tuple of ``(loc, lastmod, changefreq, priority)``.
+
+    :param template_pages: A list of ``(TemplatePage, template path)`` tuples.
+    :param template_dependencies: A :class:`~engineer.dependencies.TemplateDependencies` used to tell when a template
+        page's templates change.
+    :param dates: The :class:`SitemapDates` to take ``lastmod`` dates from.
+    """
+    post_dates = [dates.lastmod(post.absolute_url, digest(post_summary(post), post.content_hash), post.timestamp)
+                  for post in all_posts]
+    post_dates = dict(zip(all_posts, post_dates))
+
+    entries = [(settings.SITE_URL, max(post_dates.values()) if post_dates else None, 'daily', '1.0')]
+
+    for page, template_path in sorted(template_pages, key=lambda p: p[0].absolute_url):
+        loc = u'{0}{1}'.format(settings.SITE_URL, page.absolute_url)
+        template_digest = template_dependencies.digest(page.html_template.name)
+        modified = datetime.utcfromtimestamp(path(template_path).mtime)
+        entries.append((loc, dates.lastmod(loc, template_digest, modified), 'monthly', '0.5'))
+
+    for post in all_posts:
+        entries.append((post.absolute_url, post_dates[post], 'yearly', '0.5'))
+
+    for tag in sorted(all_posts.all_tags):
+        loc = u'{0}{1}'.format(settings.SITE_URL, settings.URLS['tag'](tag))
+        entries.append((loc, max(post_dates[post] for post in all_posts.tagged(tag)), 'weekly', '0.3'))
+    return entries
+
+
+def _url(loc, lastmod, changefreq, priority):
+    lines = [u'    <url>\n', u'        <loc>%s</loc>\n' % escape(loc)]
+    if lastmod is not None:
+        lines.append(u'        <lastmod>%s</lastmod>\n' % lastmod.strftime(LASTMOD_FORMAT))
+    lines.append(u'        <changefreq>%s</changefreq>\n' % changefreq)
+    lines.append(u'        <priority>%s</priority>\n' % priority)
+    lines.append(u'    </url>\n')
+    return u''.join(lines).encode('utf-8')
+
+
+class _Shard(object):
+    # One sitemap file's worth of entries, taken from a shared iterator until a limit is reached
+    def __init__(self, entries, max_urls, max_bytes):
+        self.entries = entries
+        self.max_urls = max_urls
+        self.max_bytes = max_bytes
+        self.count = 0
+        self.lastmod = None
+        self.exhausted = False
+
+    def chunks(self):
+        yield _URLSET_HEADER
+        size = len(_URLSET_HEADER) + len(_URLSET_FOOTER)
+        while True:
+            try:
+                entry = self.entries.peek()
+            except StopIteration:
+                self.exhausted = True
+                break
+            url = _url(*entry)
+            if self.count == self.max_urls or (self.count and size + len(url) > self.max_bytes):
+                break
+            next(self.entries)
+            size += len(url)
+            self.count += 1
+            if self.lastmod is None or entry[1] > self.lastmod:
+                self.lastmod = entry[1]
+            yield url
+        yield _URLSET_FOOTER
+
+
+class _Peekable(object):
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._next = []
+
+    def __iter__(self):
+        return self
+
+    def peek(self):
+        if not self._next:
+            self._next.append(next(self._iterator))
+        return self._next[0]
+
+    def next(self):
+        if self._next:
+            return self._next.pop()
+        return next(self._iterator)
+
+
+def write_sitemaps(outputs, entries, output_dir, max_urls=MAX_URLS, max_bytes=MAX_BYTES, chunk_size=64 * 1024):
+    """
+    Writes the sitemap *entries* from :func:`sitemap_entries` to :file:`sitemap.xml.gz` in *output_dir* using
+    *outputs*, an :class:`~engineer.cache.OutputManifest`. Entries are streamed into the gzipped file as they're
+    formatted, so the sitemap is never held in memory.
+
+    If there are more entries than fit in one sitemap file, which holds at most *max_urls* URLs and *max_bytes* bytes
+    uncompressed, they're split between :file:`sitemap-1.xml.gz`, :file:`sitemap-2.xml.gz` and so on, listed in a
+    :file:`sitemap.xml` sitemap index. The index is also written to :file:`sitemap.xml.gz`, so the sitemap's URL stays
+    the same however many files it's split into.
+
+    Files whose content hasn't changed aren't written. Returns the paths of the files in the sitemap.
+    """
+    output_dir = path(output_dir)
+    entries = _Peekable(entries)
+    shards = []
+    while not shards or not shards[-1][1].exhausted:
+        shard = _Shard(entries, max_urls, max_bytes)
+        staged = StagedFile(output_dir / ('sitemap-%d.xml.gz' % (len(shards) + 1)),
+                            gzipped(buffered(shard.chunks(), chunk_size)))
+        shards.append((staged, shard))
+
+    if len(shards) == 1:
+        # The staged file is in the same folder, so it can be moved into place under a different name
+        staged = shards[0][0]
+        staged.output_path = output_dir / 'sitemap.xml.gz'
+        outputs.write_staged(staged)
+        logger.debug("Wrote a sitemap of %d URLs." % shards[0][1].count)
+        return [staged.output_path]
+
+    written = []
+    index = [_INDEX_HEADER]
+    for staged, shard in shards:
+        outputs.write_staged(staged)
+        written.append(staged.output_path)
+        loc = u'{0}{1}'.format(settings.SITE_URL, urljoin(settings.HOME_URL, staged.output_path.name))
+        index.append(u'    <sitemap>\n        <loc>%s</loc>\n' % escape(loc))
+        if shard.lastmod is not None:
+            index.append(u'        <lastmod>%s</lastmod>\n' % shard.lastmod.strftime(LASTMOD_FORMAT))
+        index.append(u'    </sitemap>\n')
+    index.append(_INDEX_FOOTER)
+    index = u''.join(index).encode('utf-8')
+    for name, data in (('sitemap.xml', index), ('sitemap.xml.gz', ''.join(gzipped([index])))):
+        outputs.write(output_dir / name, data)
+        written.append(output_dir / name)
+    logger.info("Wrote a sitemap of %d URLs split between %d files." % (sum(s.count for _, s in shards), len(shards)))
+    return written
@@ -0,0 +1,74 @@
+# coding=utf-8
+import logging
+
+import jinja2
+from jinja2 import BaseLoader, ModuleLoader, TemplateNotFound
+from path import path
+
+from engineer import version
+from engineer.dependencies import digest, template_set_digest
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+logger = logging.getLogger(__name__)
+
+
+class PrecompiledLoader(BaseLoader):
+    """
+    A Jinja loader that loads templates from modules precompiled by :func:`precompile_templates`, falling back to
+    *source_loader* for any template that couldn't be precompiled. Template sources are still available through
+    :meth:`get_source`, e.g. for :class:`~engineer.dependencies.TemplateDependencies`.
+    """
+
+    def __init__(self, archive, source_loader):
+        self.module_loader = ModuleLoader(archive)
+        self.source_loader = source_loader
+
+    def get_source(self, environment, template):
+        return self.source_loader.get_source(environment, template)
+
+    def list_templates(self):
+        return self.source_loader.list_templates()
+
+    def load(self, environment, name, globals=None):
+        try:
+            return self.module_loader.load(environment, name, globals)
+        except TemplateNotFound:
+            return self.source_loader.load(environment, name, globals)
+
+
+def template_modules_digest(env):
+    """
+    Returns a digest of everything the compiled form of the templates in *env* depends on: the templates' sources, the
+    environment's extensions and options, and the versions of Jinja and Engineer.
+    """
+    options = (env.trim_blocks, env.lstrip_blocks, env.autoescape, env.block_start_string, env.block_end_string,
+               env.variable_start_string, env.variable_end_string, env.comment_start_string, env.comment_end_string,
+               env.line_statement_prefix, env.line_comment_prefix, env.newline_sequence, env.keep_trailing_newline)
+    return digest(template_set_digest(env), sorted(env.extensions), options, jinja2.__version__, str(version))
+
+
+def precompile_templates(env, cache_dir):
+    """
+    Compiles every template available to *env* into a zip of Python modules in *cache_dir*, unless an archive compiled
+    from the same templates already exists, and replaces *env*'s loader with a :class:`PrecompiledLoader` that reads
+    from it. Archives compiled from other versions of the templates are deleted.
+
+    The environment is also frozen: templates are never checked for changes once they're loaded, so rendering doesn't
+    touch the template files at all. Templates that change while Engineer is running won't be reloaded.
+    """
+    cache_dir = path(cache_dir)
+    cache_dir.makedirs_p()
+    archive = cache_dir / ('templates-%s.zip' % template_modules_digest(env)[:16])
+    if not archive.isfile():
+        logger.info("Precompiling templates to %s." % archive.name)
+        temp_archive = archive + '.tmp'
+        env.compile_templates(temp_archive, zip='deflated', py_compile=True, ignore_errors=True)
+        temp_archive.rename(archive)
+    for stale in cache_dir.files('templates-*.zip'):
+        if stale != archive:
+            stale.remove_p()
+
+    env.loader = PrecompiledLoader(archive, env.loader)
+    env.auto_reload = False
+    return archive
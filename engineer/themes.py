@@ -103,6 +103,24 @@ class Theme(object):
                 else:
                     s.copy(ensure_exists(t))
 
+    def static_content(self, output_path):
+        """
+        Returns a list of ``(source, target)`` tuples of the folders and files :meth:`copy_all_content` copies to
+        *output_path*.
+        """
+        output_path = path(output_path).abspath()
+        try:
+            content = [(self.static_root.abspath(), output_path)]
+        except ThemeNotFoundException as e:
+            self.logger.critical(e.message)
+            exit()
+        for s, t in self.content_mappings.iteritems():
+            t = path(output_path / t).abspath()
+            if s.isfile() and not t.ext:
+                t = t / s.name
+            content.append((s, t))
+        return content
+
     def copy_all_content(self, output_dir):
         self.copy_content(output_dir)
         self.copy_related_content(output_dir)
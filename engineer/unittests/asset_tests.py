@@ -0,0 +1,301 @@
+# coding=utf-8
+import os
+
+from path import path
+
+from engineer.cache import SQLiteCacheStore
+from engineer.log import bootstrap
+from engineer.plugins import load_plugins
+from engineer.unittests import CopyDataTestCase
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+test_data_root = path(__file__).dirname() / 'test_data'
+
+
+class AssetTestCase(CopyDataTestCase):
+    def setUp(self):
+        from engineer.conf import settings
+
+        bootstrap()
+        load_plugins()
+        self.source_path = test_data_root
+        os.chdir(self.copied_data_path)
+        settings.reload(self.copied_data_path / 'post_tests/configs/settings.yaml')
+        settings.create_required_directories()
+        # Keep the test's minified output out of the cache shared by all sites
+        settings.ASSET_CACHE = SQLiteCacheStore(self.copied_data_path / 'assets.cache.sqlite')
+        self.css = u"body {\n    color: #ff0000;\n}\n"
+        self.files = []
+        for name in ('one.css', 'two.css'):
+            the_file = settings.OUTPUT_STATIC_DIR / name
+            the_file.dirname().makedirs_p()
+            the_file.write_text(self.css)
+            self.files.append((the_file, 'css'))
+
+    def tearDown(self):
+        from engineer.conf import settings
+
+        settings.close_caches()
+        super(AssetTestCase, self).tearDown()
+
+
+class MinificationTests(AssetTestCase):
+    def content_keyed_cache_test(self):
+        """Files with the same content are minified once, and only minified again if their content changes."""
+        from engineer.assets import minify_assets
+        from engineer.conf import settings
+
+        stats = minify_assets(self.files)
+        self.assertEqual(len(settings.ASSET_CACHE.namespace('MINIFIED')), 1)
+        # The deprecated setting refers to the same cache
+        self.assertEqual(len(settings.COMPRESSION_CACHE), 1)
+        self.assertFalse(any(s['cached'] for s in stats.values()))
+        for the_file, compression_type in self.files:
+            self.assertEqual(the_file.text(), u"body{color:#f00}")
+            self.assertLess(stats[settings.OUTPUT_MANIFEST.key(the_file)]['minified'], len(self.css))
+
+        settings.OUTPUT_MANIFEST.reset()
+        for the_file, compression_type in self.files:
+            the_file.write_text(self.css)
+        stats = minify_assets(self.files)
+        self.assertTrue(all(s['cached'] for s in stats.values()))
+        for the_file, compression_type in self.files:
+            self.assertEqual(the_file.text(), u"body{color:#f00}")
+
+    def minified_copy_test(self):
+        """Static files that are still minified from the same source aren't copied or minified again."""
+        from engineer.assets import minify_assets
+        from engineer.conf import settings
+
+        manifest = settings.OUTPUT_MANIFEST
+        source = self.copied_data_path / 'site.css'
+        source.write_text(self.css)
+        the_file = settings.OUTPUT_STATIC_DIR / 'site.css'
+        manifest.copy(source, the_file)
+        minify_assets([(the_file, 'css')])
+        manifest.restore_unprocessed()
+        self.assertEqual(the_file.text(), u"body{color:#f00}")
+        mtime = the_file.mtime
+
+        manifest.reset()
+        self.assertFalse(manifest.copy(source, the_file))
+        self.assertEqual(manifest.content(the_file), self.css)
+        stats = minify_assets([(the_file, 'css')])
+        manifest.restore_unprocessed()
+        self.assertEqual(manifest.stats['written'], 0)
+        self.assertEqual(the_file.mtime, mtime)
+        self.assertEqual(stats[manifest.key(the_file)]['original'], len(self.css))
+        self.assertTrue(stats[manifest.key(the_file)]['cached'])
+
+        # Files that aren't minified any more get their original content back
+        manifest.reset()
+        manifest.copy(source, the_file)
+        manifest.restore_unprocessed()
+        self.assertEqual(the_file.text(), self.css)
+
+    def parallel_minification_test(self):
+        from engineer.assets import minify_assets
+
+        self.files[1][0].write_text(u"a {\n    color: #0000ff;\n}\n")
+        stats = minify_assets(self.files, workers=2)
+        self.assertFalse(any(s['cached'] for s in stats.values()))
+        self.assertEqual(self.files[1][0].text(), u"a{color:#00f}")
+
+
+class GzipSidecarTests(AssetTestCase):
+    def sidecars_test(self):
+        """Sidecars are written for large enough files, and removed along with their originals."""
+        import gzip
+        from engineer.assets import write_gzip_sidecars
+        from engineer.conf import settings
+
+        manifest = settings.OUTPUT_MANIFEST
+        page = settings.OUTPUT_CACHE_DIR / 'index.html'
+        small = settings.OUTPUT_CACHE_DIR / 'small.html'
+        manifest.write(page, 'Some output. ' * 100)
+        manifest.write(small, 'Tiny.')
+        for the_file, compression_type in self.files:
+            manifest.register(the_file)
+
+        stats = write_gzip_sidecars(manifest, ['html'], min_size=100)
+        self.assertEqual(stats['written'], 1)
+        with gzip.open(page + '.gz') as the_file:
+            self.assertEqual(the_file.read(), page.bytes())
+        self.assertFalse((small + '.gz').exists())
+        self.assertFalse((self.files[0][0] + '.gz').exists())
+        self.assertEqual(len(settings.CACHE.namespace('GZIPPED')), 1)
+        # Sidecars that already have the right content aren't counted as written
+        stats = write_gzip_sidecars(manifest, ['html'], min_size=100)
+        self.assertEqual((stats['written'], stats['unchanged'], stats['cached']), (0, 1, 1))
+
+        manifest.mark_published()
+        manifest.reset()
+        page.remove()
+        write_gzip_sidecars(manifest, ['html'], min_size=100)
+        manifest.remove_unrecorded()
+        self.assertFalse((page + '.gz').exists())
+        self.assertIn('index.html.gz', manifest.changes()['deleted'])
+        # Compressed copies of content that's gone are dropped from the cache
+        self.assertEqual(len(settings.CACHE.namespace('GZIPPED')), 0)
+
+
+class FingerprintTests(AssetTestCase):
+    def fingerprint_test(self):
+        """Pages refer to fingerprinted copies of assets, and are rendered again when the assets change."""
+        import json
+        from engineer.assets import write_fingerprinted_assets
+        from engineer.conf import settings
+        from engineer.filters import compress
+
+        settings.COMPRESSOR_ENABLED = False
+        settings.FINGERPRINT_ASSETS = True
+        fingerprints = settings.ASSET_FINGERPRINTS
+        dependencies = settings.BUILD_DEPENDENCIES
+        one, two = [the_file for the_file, compression_type in self.files]
+        url = settings.STATIC_URL + '/one.css'
+        page = settings.OUTPUT_CACHE_DIR / 'index.html'
+
+        with dependencies.capture() as side_effects:
+            value = compress(u'<link rel="stylesheet" href="%s"/>' % url)
+            static_url = settings.JINJA_ENV.from_string(u"{{ urlname('static', 'two.css') }}").render()
+        fingerprint = fingerprints.fingerprint('static/one.css')
+        self.assertEqual(value, u'<link rel="stylesheet" href="%s"/>' % url.replace('.css', '.%s.css' % fingerprint))
+        self.assertEqual(static_url, settings.STATIC_URL + '/two.%s.css' % fingerprints.fingerprint('static/two.css'))
+        # Both files have the same content
+        self.assertEqual(fingerprints.fingerprint('static/one.css'), fingerprints.fingerprint('static/two.css'))
+        self.assertEqual(fingerprints.requested, {})
+
+        page.write_text(value)
+        dependencies.record(page, {}, side_effects)
+        dependencies.apply(side_effects)
+        mapping = write_fingerprinted_assets(settings.OUTPUT_MANIFEST, fingerprints)
+        self.assertEqual(sorted(mapping), ['static/one.css', 'static/two.css'])
+        self.assertEqual((settings.OUTPUT_CACHE_DIR / mapping['static/one.css']).text(), self.css)
+        self.assertEqual(json.loads((settings.OUTPUT_CACHE_DIR / 'assets.json').text()), mapping)
+        self.assertTrue(dependencies.is_current(page, {}))
+
+        one.write_text(u"a {\n    color: #0000ff;\n}\n")
+        fingerprints.reset()
+        self.assertFalse(dependencies.is_current(page, {}))
+        self.assertNotEqual(fingerprints.fingerprint('static/one.css'), fingerprint)
+
+    def less_fingerprint_test(self):
+        """CSS generated from LESS is fingerprinted again when a file the LESS file imports changes."""
+        from engineer.conf import settings
+
+        fingerprints = settings.ASSET_FINGERPRINTS
+        less_file = settings.OUTPUT_STATIC_DIR / 'site.less'
+        partial = settings.OUTPUT_STATIC_DIR / 'partials/colors.less'
+        partial.dirname().makedirs_p()
+        less_file.write_text(u'@import "partials/colors.less";\nbody { color: @text; }\n')
+        partial.write_text(u"@text: #ff0000;\n")
+        fingerprint = fingerprints.fingerprint('static/site.css')
+        self.assertIsNotNone(fingerprint)
+
+        partial.write_text(u"@text: #0000ff;\n")
+        fingerprints.reset()
+        self.assertNotEqual(fingerprints.fingerprint('static/site.css'), fingerprint)
+
+    def fingerprinted_url_compress_test(self):
+        """Compress filter blocks can link to assets using URLs that are already fingerprinted."""
+        from engineer.conf import settings
+        from engineer.filters import compress
+
+        settings.FINGERPRINT_ASSETS = True
+        one = self.files[0][0]
+        block = settings.JINJA_ENV.from_string(
+            u"""{% filter compress %}<link rel="stylesheet" href="{{ urlname('static', 'one.css') }}"/>"""
+            u"""{% endfilter %}""").render()
+        self.assertEqual(block, u'<link rel="stylesheet" href="%s/one.%s.css"/>' % (
+            settings.STATIC_URL, settings.ASSET_FINGERPRINTS.fingerprint('static/one.css')))
+        self.assertEqual(compress(block), block)
+        # The original file is minified, not its fingerprinted copy
+        self.assertIn((one, 'css'), settings.COMPRESS_FILE_LIST)
+
+
+class BundleTests(AssetTestCase):
+    def bundle_test(self):
+        """Each compress filter block is replaced by a single tag referring to a bundle of its files."""
+        from engineer.assets import write_bundles
+        from engineer.conf import settings
+        from engineer.filters import compress
+
+        settings.BUNDLE_ASSETS = True
+        dependencies = settings.BUILD_DEPENDENCIES
+        one, two = [the_file for the_file, compression_type in self.files]
+        nested = settings.OUTPUT_STATIC_DIR / 'nested/three.css'
+        nested.dirname().makedirs_p()
+        nested.write_text(u"a {\n    background: url(images/a.png);\n}\n")
+        block = (u'<link rel="stylesheet" href="%(static)s/one.css">\n'
+                 u'<!--[if lt IE 9]><link rel="stylesheet" href="%(static)s/ie.css"><![endif]-->\n'
+                 u'<link rel="stylesheet" href="%(static)s/nested/three.css">' % {'static': settings.STATIC_URL})
+        page = settings.OUTPUT_CACHE_DIR / 'index.html'
+
+        with dependencies.capture() as side_effects:
+            value = compress(block)
+        (kind, (key, compression_type, members)), = side_effects
+        self.assertEqual(members, ('static/one.css', 'static/nested/three.css'))
+        self.assertEqual(value, u'<link rel="stylesheet" href="%s/bundles/%s" type="text/css"/>\n'
+                                u'<!--[if lt IE 9]><link rel="stylesheet" href="%s/ie.css"><![endif]-->\n' %
+                                (settings.STATIC_URL, key.split('/')[-1], settings.STATIC_URL))
+        # Blocks that mix stylesheets and scripts aren't bundled
+        mixed = block + u'<script src="%s/site.js"></script>' % settings.STATIC_URL
+        self.assertEqual(compress(mixed), mixed)
+
+        page.write_text(value)
+        dependencies.record(page, {}, side_effects)
+        dependencies.apply(side_effects)
+        stats = write_bundles(settings.OUTPUT_MANIFEST, settings.ASSET_BUNDLES)
+        self.assertEqual(stats[key]['members'], list(members))
+        self.assertEqual((settings.OUTPUT_CACHE_DIR / key).text(),
+                         u"body{color:#f00}a{background:url(../nested/images/a.png)}")
+        self.assertTrue(dependencies.is_current(page, {}))
+
+        one.write_text(u"body {\n    color: #0000ff;\n}\n")
+        settings.ASSET_FINGERPRINTS.reset()
+        self.assertFalse(dependencies.is_current(page, {}))
+
+    def bundled_fingerprints_test(self):
+        """Fingerprinted copies are only written for bundled files that are also linked outside a bundle."""
+        from engineer.conf import settings
+
+        settings.BUNDLE_ASSETS = True
+        settings.FINGERPRINT_ASSETS = True
+        dependencies = settings.BUILD_DEPENDENCIES
+        template = settings.JINJA_ENV.from_string(
+            u"""{% filter compress %}<link rel="stylesheet" href="{{ urlname('static', 'one.css') }}">"""
+            u"""<link rel="stylesheet" href="{{ urlname('static', 'two.css') }}">{% endfilter %}"""
+            u"""{% if linked %}<link rel="stylesheet" href="{{ urlname('static', 'two.css') }}">{% endif %}""")
+
+        with dependencies.capture() as side_effects:
+            template.render(linked=False)
+        self.assertEqual([kind for kind, value in side_effects], ['bundle'])
+
+        with dependencies.capture() as side_effects:
+            template.render(linked=True)
+        dependencies.apply(side_effects)
+        self.assertEqual(sorted(settings.ASSET_FINGERPRINTS.requested), ['static/two.css'])
+
+
+class CompressFilterTests(AssetTestCase):
+    def memoized_side_effects_test(self):
+        """Cached results of the compress filter have the same side effects as the first result."""
+        from engineer.conf import settings
+        from engineer.filters import compress
+
+        dependencies = settings.BUILD_DEPENDENCIES
+        block = u'<link rel="stylesheet" href="%s/one.css">' % settings.STATIC_URL
+        with dependencies.capture() as first:
+            self.assertEqual(compress(block), block)
+        with dependencies.capture() as second:
+            self.assertEqual(compress(block), block)
+        self.assertEqual(first, [('compress', (self.files[0][0], 'css'))])
+        self.assertEqual(second, first)
+        self.assertEqual(len(settings.COMPRESS_CACHE), 1)
+
+        # Outside a capture, the side effects take effect immediately
+        settings.COMPRESS_FILE_LIST.clear()
+        compress(block)
+        self.assertEqual(settings.COMPRESS_FILE_LIST, set([self.files[0]]))
+        settings.COMPRESS_FILE_LIST.clear()
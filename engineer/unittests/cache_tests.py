@@ -0,0 +1,372 @@
+# coding=utf-8
+import functools
+import hashlib
+import os
+import time
+from tempfile import mkdtemp
+from unittest.case import TestCase
+
+from path import path
+
+from engineer.cache import OutputManifest, OutputWriter, SimpleFileCache, SQLiteCacheStore, StagedFile
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+
+class SimpleFileCacheTests(TestCase):
+    def setUp(self):
+        self.temp_dir = path(mkdtemp())
+        self.the_file = self.temp_dir / 'cached.txt'
+        self.the_file.write_text(u'Some content.')
+        self._age(self.the_file)
+
+    def tearDown(self):
+        self.temp_dir.rmtree(ignore_errors=True)
+
+    @staticmethod
+    def _age(the_file, seconds=60):
+        """Moves the file's modification time into the past so its stat signature is trusted."""
+        past = time.time() - seconds
+        os.utime(the_file, (past, past))
+
+    def stat_hit_test(self):
+        cache = SimpleFileCache()
+        cache[self.the_file] = 'value'
+
+        self.assertIn(self.the_file, cache)
+        self.assertEqual(cache.stats, {'stat': 1, 'checksum': 0, 'miss': 0})
+
+    def touched_file_test(self):
+        """A touched but unchanged file is validated by checksum, then by stat signature."""
+        cache = SimpleFileCache()
+        cache[self.the_file] = 'value'
+        self._age(self.the_file, seconds=30)
+
+        self.assertIn(self.the_file, cache)
+        self.assertIn(self.the_file, cache)
+        self.assertEqual(cache.stats, {'stat': 1, 'checksum': 1, 'miss': 0})
+
+    def changed_file_test(self):
+        cache = SimpleFileCache()
+        cache[self.the_file] = 'value'
+        self.the_file.write_text(u'Some new content.')
+
+        self.assertNotIn(self.the_file, cache)
+        self.assertEqual(cache.stats['miss'], 1)
+
+    def racy_file_test(self):
+        """Files modified just before they're cached are always validated by checksum."""
+        cache = SimpleFileCache()
+        self.the_file.write_text(u'Some fresh content.')
+        cache[self.the_file] = 'value'
+
+        self.assertIn(self.the_file, cache)
+        self.assertEqual(cache.stats, {'stat': 0, 'checksum': 1, 'miss': 0})
+
+    def checksum_validation_test(self):
+        cache = SimpleFileCache()
+        cache.validation = 'checksum'
+        cache[self.the_file] = 'value'
+
+        self.assertIn(self.the_file, cache)
+        self.assertEqual(cache.stats, {'stat': 0, 'checksum': 1, 'miss': 0})
+
+
+class SQLiteCacheStoreTests(TestCase):
+    def setUp(self):
+        self.temp_dir = path(mkdtemp())
+        self.cache_file = self.temp_dir / 'engineer.cache.sqlite'
+        self.the_file = self.temp_dir / 'cached.txt'
+        self.the_file.write_text(u'Some content.')
+
+    def tearDown(self):
+        self.temp_dir.rmtree(ignore_errors=True)
+
+    def persistence_test(self):
+        store = SQLiteCacheStore(self.cache_file)
+        store['version'] = '0.6.0'
+        store.set('posts', 'a', {'title': u'A post'})
+        store.close()
+
+        store = SQLiteCacheStore(self.cache_file)
+        self.assertEqual(store['version'], '0.6.0')
+        self.assertEqual(store.get('posts', 'a'), {'title': u'A post'})
+        store.close()
+
+    def uncommitted_writes_test(self):
+        """Writes that were never synced are discarded."""
+        store = SQLiteCacheStore(self.cache_file)
+        store.set('posts', 'a', 1)
+        store.sync()
+        store.set('posts', 'b', 2)
+        store.connection.rollback()
+
+        self.assertEqual(store.keys('posts'), [u'a'])
+        store.close()
+
+    def columns_test(self):
+        store = SQLiteCacheStore(self.cache_file)
+        values = store.namespace('posts', 'value')
+        meta = store.namespace('posts', 'meta')
+        values['a'] = 1
+
+        self.assertIn('a', values)
+        self.assertNotIn('a', meta)
+        meta['a'] = 2
+        del values['a']
+        self.assertNotIn('a', values)
+        self.assertEqual(meta['a'], 2)
+        store.close()
+
+    def invalid_file_test(self):
+        """An invalid cache file, e.g. one left over from an older version, is replaced."""
+        self.cache_file.write_bytes('not a database' * 100)
+        store = SQLiteCacheStore(self.cache_file)
+
+        self.assertNotIn('version', store)
+        store['version'] = '0.6.0'
+        self.assertEqual(store['version'], '0.6.0')
+        store.close()
+
+    def file_cache_test(self):
+        store = SQLiteCacheStore(self.cache_file)
+        cache = SimpleFileCache(store=store, namespace='POST_CACHE')
+        cache[self.the_file] = 'value'
+        store.close()
+
+        cache = SimpleFileCache(store=SQLiteCacheStore(self.cache_file), namespace='POST_CACHE')
+        self.assertIn(self.the_file, cache)
+        self.assertEqual(cache[self.the_file], 'value')
+
+
+class OutputManifestTests(TestCase):
+    def setUp(self):
+        self.temp_dir = path(mkdtemp())
+        self.output_dir = self.temp_dir / 'output'
+        self.store = SQLiteCacheStore(self.temp_dir / 'engineer.cache.sqlite')
+        self.manifest = OutputManifest(self.store, self.output_dir)
+
+    def tearDown(self):
+        self.store.close()
+        self.temp_dir.rmtree(ignore_errors=True)
+
+    def write_if_changed_test(self):
+        page = self.output_dir / 'page/1/index.html'
+        self.assertTrue(self.manifest.write(page, 'Some output.'))
+        mtime = page.mtime
+
+        self.manifest.reset()
+        self.assertFalse(self.manifest.write(page, 'Some output.'))
+        self.assertEqual(page.mtime, mtime)
+        self.assertEqual(self.manifest.stats['unchanged'], 1)
+
+        # Files changed behind the manifest's back are rewritten
+        page.write_bytes('Something else.')
+        self.assertTrue(self.manifest.write(page, 'Some output.'))
+        self.assertEqual(page.bytes(), 'Some output.')
+
+    def copy_test(self):
+        """Static files are only copied again if their source changes or the copy is changed."""
+        source = self.temp_dir / 'static/site.css'
+        source.dirname().makedirs()
+        source.write_bytes('body {}')
+        copied = self.output_dir / 'static/site.css'
+        self.assertTrue(self.manifest.copy(source, copied))
+        self.assertEqual(copied.bytes(), 'body {}')
+        self.assertEqual(self.manifest.checksum(copied), hashlib.sha256('body {}').hexdigest())
+
+        self.manifest.reset()
+        self.assertFalse(self.manifest.copy(source, copied))
+        self.assertTrue(self.manifest.is_recorded(copied))
+
+        copied.write_bytes('a {}')
+        self.assertTrue(self.manifest.copy(source, copied))
+        self.assertEqual(copied.bytes(), 'body {}')
+        source.write_bytes('p {}')
+        self.assertTrue(self.manifest.copy(source, copied))
+        self.assertEqual(copied.bytes(), 'p {}')
+
+        # Files written over a copy aren't copied again if they have the same content
+        self.manifest.write(copied, 'p {}')
+        self.assertFalse(self.manifest.copy(source, copied))
+
+    def process_test(self):
+        """Processed files aren't written again with the content they were processed from."""
+        the_file = self.output_dir / 'static/site.css'
+        self.manifest.write(the_file, 'body { }')
+        self.assertFalse(self.manifest.keep_processed(the_file, 'minify:css'))
+        self.assertTrue(self.manifest.process(the_file, 'body{}', 'minify:css'))
+        self.assertEqual(self.manifest.sizes(the_file), (len('body { }'), len('body{}')))
+
+        self.manifest.reset()
+        self.assertFalse(self.manifest.write(the_file, 'body { }'))
+        self.assertEqual(the_file.bytes(), 'body{}')
+        self.assertEqual(self.manifest.content(the_file), 'body { }')
+        self.assertTrue(self.manifest.keep_processed(the_file, 'minify:css'))
+        self.manifest.restore_unprocessed()
+        self.assertEqual(the_file.bytes(), 'body{}')
+
+        # Files that aren't processed again are restored
+        self.manifest.reset()
+        self.manifest.write(the_file, 'body { }')
+        self.manifest.restore_unprocessed()
+        self.assertEqual(the_file.bytes(), 'body { }')
+        self.assertFalse(self.manifest.keep_processed(the_file, 'minify:css'))
+
+        # New content is written over processed files
+        self.manifest.process(the_file, 'body{}', 'minify:css')
+        self.manifest.reset()
+        self.assertTrue(self.manifest.write(the_file, 'a { }'))
+        self.assertEqual(the_file.bytes(), 'a { }')
+        self.assertFalse(self.manifest.keep_processed(the_file, 'minify:css'))
+
+    def write_staged_test(self):
+        page = self.output_dir / 'archives/index.html'
+        staged = StagedFile(page, ['Some ', 'output.'])
+        self.assertTrue(StagedFile.is_staged(staged.path))
+        self.assertEqual(staged.size, len('Some output.'))
+        self.assertTrue(self.manifest.write_staged(staged))
+        self.assertEqual(page.bytes(), 'Some output.')
+        self.assertFalse(staged.path.exists())
+        mtime = page.mtime
+
+        self.manifest.reset()
+        staged = StagedFile(page, ['Some output.'])
+        self.assertFalse(self.manifest.write_staged(staged))
+        self.assertFalse(staged.path.exists())
+        self.assertEqual(page.mtime, mtime)
+        self.assertEqual(self.manifest.checksum(page), hashlib.sha256('Some output.').hexdigest())
+
+    def background_writer_test(self):
+        written = []
+        writer = OutputWriter(self.manifest, threads=2, queue_size=2)
+        try:
+            pages = [self.output_dir / ('page/%d/index.html' % i) for i in range(10)]
+            writer.make_directories(page.dirname() for page in pages)
+            for i, page in enumerate(pages):
+                if i % 2:
+                    staged = writer.stage(page, ['Page ', str(i)])
+                else:
+                    staged = StagedFile(page, ['Page ', str(i)])
+                writer.write_staged(staged, functools.partial(written.append, i))
+            writer.finish()
+        finally:
+            writer.close()
+        self.assertEqual(written, range(10))
+        self.assertEqual(pages[3].bytes(), 'Page 3')
+        self.assertEqual(self.manifest.checksum(pages[3]), hashlib.sha256('Page 3').hexdigest())
+        self.assertEqual(self.manifest.stats['written'], 10)
+
+    def background_writer_error_test(self):
+        written = []
+        writer = OutputWriter(self.manifest, threads=2)
+        try:
+            writer.write_staged(writer.stage(self.output_dir / 'index.html', ['Some output.']),
+                                functools.partial(written.append, 'index.html'))
+            missing = StagedFile(self.output_dir / 'missing.html', ['Some output.'])
+            missing.discard()
+
+            def submit():
+                # The error is raised by whichever call finds the write finished
+                writer.write_staged(missing, functools.partial(written.append, 'missing.html'))
+                writer.finish()
+
+            self.assertRaises(OSError, submit)
+        finally:
+            writer.close()
+        # Files submitted before the one that failed are still recorded
+        self.assertEqual(written, ['index.html'])
+        self.assertTrue(self.manifest.is_recorded(self.output_dir / 'index.html'))
+
+    def changes_test(self):
+        kept = self.output_dir / 'index.html'
+        modified = self.output_dir / 'feeds/rss.xml'
+        deleted = self.output_dir / 'tag/old-tag/index.html'
+        copied = self.output_dir / 'robots.txt'
+        for output in (kept, modified, deleted):
+            self.manifest.write(output, 'Some output.')
+        self.assertEqual(self.manifest.changes()['new'], set(['index.html', 'feeds/rss.xml', 'tag/old-tag/index.html']))
+        self.manifest.mark_published()
+        self.assertEqual(self.manifest.changes(), {'new': set(), 'overwritten': set(), 'deleted': set()})
+
+        self.manifest.reset()
+        self.manifest.write(kept, 'Some output.')
+        self.manifest.write(modified, 'New output.')
+        copied.write_text(u'User-agent: *')
+        self.manifest.register(copied)
+        self.manifest.remove_unrecorded()
+        self.assertEqual(self.manifest.changes(), {'new': set(['robots.txt']),
+                                                   'overwritten': set(['feeds/rss.xml']),
+                                                   'deleted': set(['tag/old-tag/index.html'])})
+
+        self.manifest.forget_published()
+        self.assertEqual(self.manifest.changes()['new'], set(['index.html', 'feeds/rss.xml', 'robots.txt']))
+
+    def sync_test(self):
+        from engineer.util import sync_folder
+
+        target = self.temp_dir / 'published'
+        kept = self.output_dir / 'index.html'
+        deleted = self.output_dir / 'tag/old-tag/index.html'
+        ignored = self.output_dir / 'keep/me.txt'
+        for output in (kept, deleted, ignored):
+            self.manifest.write(output, 'Some output.')
+        report = sync_folder(self.manifest, target, ignore_list=['keep'])
+        self.assertEqual(report['new'], set([target / 'index.html', target / 'tag/old-tag/index.html',
+                                             target / 'tag', target / 'tag/old-tag']))
+        self.assertEqual((target / 'index.html').bytes(), 'Some output.')
+        self.assertFalse((target / 'keep').exists())
+
+        self.manifest.reset()
+        self.manifest.write(kept, 'New output.')
+        self.manifest.remove_unrecorded()
+        report = sync_folder(self.manifest, target, ignore_list=['keep'])
+        self.assertEqual(report, {'new': set(),
+                                  'overwritten': set([target / 'index.html']),
+                                  'deleted': set([target / 'tag/old-tag/index.html', target / 'tag/old-tag',
+                                                  target / 'tag'])})
+        self.assertEqual((target / 'index.html').bytes(), 'New output.')
+        self.assertFalse((target / 'tag').exists())
+
+    def sync_drift_test(self):
+        """Published files that were edited or deleted in the output directory are published again."""
+        from engineer.util import sync_folder
+
+        target = self.temp_dir / 'published'
+        edited = self.output_dir / 'index.html'
+        deleted = self.output_dir / 'feeds/rss.xml'
+        for output in (edited, deleted):
+            self.manifest.write(output, 'Some output.')
+        sync_folder(self.manifest, target)
+        self.assertEqual(self.manifest.changes(target), {'new': set(), 'overwritten': set(), 'deleted': set()})
+
+        (target / 'index.html').write_bytes('Edited by hand.')
+        (target / 'feeds/rss.xml').remove()
+        self.assertEqual(self.manifest.changes(target), {'new': set(['feeds/rss.xml']),
+                                                         'overwritten': set(['index.html']),
+                                                         'deleted': set()})
+        sync_folder(self.manifest, target)
+        self.assertEqual((target / 'index.html').bytes(), 'Some output.')
+        self.assertEqual((target / 'feeds/rss.xml').bytes(), 'Some output.')
+        self.assertEqual(self.manifest.changes(target), {'new': set(), 'overwritten': set(), 'deleted': set()})
+
+    def rename_swap_test(self):
+        from engineer.util import sync_folder
+
+        target = self.temp_dir / 'published'
+        (target / '.git').makedirs()
+        (target / '.git/HEAD').write_text(u'ref: refs/heads/master')
+        (target / 'stale.html').write_text(u'Not output by Engineer.')
+        page = self.output_dir / 'index.html'
+        self.manifest.write(page, 'Some output.')
+
+        report = sync_folder(self.manifest, target, ignore_list=['.git'], strategy='rename-swap')
+        self.assertEqual(report['new'], set([target / 'index.html']))
+        self.assertEqual(sorted(f.basename() for f in target.listdir()), ['.git', 'index.html'])
+        self.assertEqual((target / '.git/HEAD').text(), u'ref: refs/heads/master')
+        if hasattr(os, 'link'):
+            self.assertEqual(os.stat(page).st_ino, os.stat(target / 'index.html').st_ino)
+
+        # Writing a new version of the page in the output cache doesn't change the published one
+        self.manifest.write(page, 'New output.')
+        self.assertEqual((target / 'index.html').bytes(), 'Some output.')
@@ -0,0 +1,146 @@
+# coding=utf-8
+from tempfile import mkdtemp
+from unittest.case import TestCase
+
+from jinja2 import DictLoader, Environment
+from path import path
+
+from engineer.cache import SQLiteCacheStore
+from engineer.dependencies import DependencyGraph, TemplateDependencies
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+
+class DependencyGraphTests(TestCase):
+    def setUp(self):
+        self.temp_dir = path(mkdtemp())
+        self.output_dir = self.temp_dir / 'output'
+        self.output_dir.makedirs()
+        self.store = SQLiteCacheStore(self.temp_dir / 'engineer.cache.sqlite')
+        self.inputs = {'site': 'a', 'content': 'b'}
+
+    def tearDown(self):
+        self.store.close()
+        self.temp_dir.rmtree(ignore_errors=True)
+
+    def _generate(self, graph, relative_path, inputs):
+        output = self.output_dir / relative_path
+        output.dirname().makedirs_p()
+        output.write_text(u'Some output.')
+        graph.record(output, inputs)
+        return output
+
+    def current_test(self):
+        graph = DependencyGraph(self.store, self.output_dir)
+        self.assertTrue(graph.is_empty())
+        output = self._generate(graph, 'page/1/index.html', self.inputs)
+
+        self.assertFalse(graph.is_empty())
+        self.assertTrue(graph.is_current(output, dict(self.inputs)))
+        self.assertFalse(graph.is_current(output, dict(self.inputs, content='c')))
+        output.remove()
+        self.assertFalse(graph.is_current(output, self.inputs))
+
+    def side_effects_test(self):
+        from engineer.conf import settings
+
+        compressed = (self.output_dir / 'static/site.css', 'css')
+        graph = DependencyGraph(self.store, self.output_dir)
+        output = self.output_dir / 'index.html'
+        with graph.capture() as side_effects:
+            self.assertTrue(graph.record_side_effect('compress', compressed))
+        self.assertFalse(graph.record_side_effect('compress', compressed))
+        output.write_text(u'Some output.')
+        graph.record(output, self.inputs, side_effects)
+
+        settings.COMPRESS_FILE_LIST.discard(compressed)
+        graph.reset()
+        graph.skip(output)
+        self.assertIn(compressed, settings.COMPRESS_FILE_LIST)
+        self.assertEqual(graph.stats['skipped'], 1)
+        settings.COMPRESS_FILE_LIST.discard(compressed)
+
+    def orphans_test(self):
+        graph = DependencyGraph(self.store, self.output_dir)
+        kept = self._generate(graph, 'index.html', self.inputs)
+        orphan = self._generate(graph, 'tag/old-tag/index.html', self.inputs)
+        copied = self.output_dir / 'robots.txt'
+        copied.write_text(u'User-agent: *')
+        graph.add_output(copied)
+
+        graph.reset()
+        graph.skip(kept)
+        self.assertEqual(sorted(graph.remove_orphans()), sorted([orphan, copied]))
+        self.assertFalse(orphan.exists())
+        self.assertFalse((self.output_dir / 'tag').exists())
+        self.assertFalse(copied.exists())
+        self.assertTrue(kept.exists())
+
+
+class TemplateDependenciesTests(TestCase):
+    def setUp(self):
+        self.templates = {
+            'base.html': u"{% from '_macros.html' import link %}<html>{% block content %}{% endblock %}</html>",
+            '_macros.html': u"{% macro link(url) %}<a href='{{ url }}'>{{ url }}</a>{% endmacro %}",
+            '_single_post.html': u"{{ post }}",
+            'post_detail.html': u"{% extends 'base.html' %}{% block content %}"
+                                u"{% include '_single_post.html' %}{% endblock %}",
+            'tags_list.html': u"{% extends 'base.html' %}{% block content %}{{ tag }}{% endblock %}",
+            'dynamic.html': u"{% include name %}",
+        }
+        self.env = Environment(loader=DictLoader(self.templates))
+
+    def closure_test(self):
+        dependencies = TemplateDependencies(self.env)
+
+        self.assertEqual(dependencies.closure('post_detail.html'),
+                         ['_macros.html', '_single_post.html', 'base.html', 'post_detail.html'])
+        self.assertEqual(dependencies.closure('tags_list.html'), ['_macros.html', 'base.html', 'tags_list.html'])
+        self.assertIsNone(dependencies.closure('dynamic.html'))
+
+    def digest_test(self):
+        names = ('post_detail.html', 'tags_list.html', 'dynamic.html')
+        before = [TemplateDependencies(self.env).digest(name) for name in names]
+        self.templates['_single_post.html'] = u"<article>{{ post }}</article>"
+        after = [TemplateDependencies(self.env).digest(name) for name in names]
+
+        self.assertNotEqual(before[0], after[0])
+        self.assertEqual(before[1], after[1])
+        # Templates with dynamic references depend on every template
+        self.assertNotEqual(before[2], after[2])
+
+
+class PrecompiledTemplateTests(TestCase):
+    def setUp(self):
+        self.temp_dir = path(mkdtemp())
+        self.templates = {
+            'base.html': u"<html>{% block content %}{% endblock %}</html>",
+            'page.html': u"{% extends 'base.html' %}{% block content %}{{ title }}{% endblock %}",
+        }
+
+    def tearDown(self):
+        self.temp_dir.rmtree(ignore_errors=True)
+
+    def _environment(self):
+        return Environment(loader=DictLoader(dict(self.templates)))
+
+    def precompile_test(self):
+        from engineer.template_cache import PrecompiledLoader, precompile_templates
+
+        env = self._environment()
+        archive = precompile_templates(env, self.temp_dir)
+        self.assertIsInstance(env.loader, PrecompiledLoader)
+        self.assertFalse(env.auto_reload)
+        self.assertEqual(env.get_template('page.html').render(title=u'Hi'), u"<html>Hi</html>")
+        self.assertTrue(env.get_template('page.html').filename.startswith(archive))
+        # Sources are still available for dependency tracking
+        self.assertEqual(TemplateDependencies(env).closure('page.html'), ['base.html', 'page.html'])
+
+        # The same templates reuse the archive; changed templates replace it
+        self.assertEqual(precompile_templates(self._environment(), self.temp_dir), archive)
+        self.templates['base.html'] = u"<body>{% block content %}{% endblock %}</body>"
+        env = self._environment()
+        new_archive = precompile_templates(env, self.temp_dir)
+        self.assertNotEqual(new_archive, archive)
+        self.assertFalse(archive.exists())
+        self.assertEqual(env.get_template('page.html').render(title=u'Hi'), u"<body>Hi</body>")
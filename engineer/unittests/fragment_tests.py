@@ -0,0 +1,75 @@
+# coding=utf-8
+import os
+
+from path import path
+
+from engineer.log import bootstrap
+from engineer.plugins import load_plugins
+from engineer.unittests import CopyDataTestCase
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+test_data_root = path(__file__).dirname() / 'test_data'
+
+
+class FragmentCacheTests(CopyDataTestCase):
+    def setUp(self):
+        from engineer.conf import settings
+
+        bootstrap()
+        load_plugins()
+        self.source_path = test_data_root
+        os.chdir(self.copied_data_path)
+        settings.reload(self.copied_data_path / 'post_tests/configs/settings.yaml')
+        settings.create_required_directories()
+        self.renders = []
+        settings.JINJA_ENV.globals['count_render'] = lambda: self.renders.append(1) or len(self.renders)
+        settings.TEMPLATE_DIR.makedirs_p()
+        (settings.TEMPLATE_DIR / 'fragment.html').write_text(
+            u"{% cache 'fragment', key persistent %}{{ count_render() }}{{ preprocess_less('x.less') }}{% endcache %}")
+
+    def tearDown(self):
+        from engineer.conf import settings
+
+        settings.close_caches()
+        super(FragmentCacheTests, self).tearDown()
+
+    def memoized_fragment_test(self):
+        """Fragments are rendered once per build for each key, and replay their side effects when they're reused."""
+        from engineer.conf import settings
+
+        template = settings.JINJA_ENV.from_string(u"{% cache 'a', key %}{{ count_render() }}{% endcache %}")
+        self.assertEqual(template.render(key=1), u'1')
+        self.assertEqual(template.render(key=1), u'1')
+        self.assertEqual(template.render(key=2), u'2')
+        self.assertEqual(settings.FRAGMENT_CACHE.stats, {'hit': 1, 'persistent': 0, 'miss': 2})
+
+        template = settings.JINJA_ENV.get_template('fragment.html')
+        for i in range(2):
+            with settings.BUILD_DEPENDENCIES.capture() as side_effects:
+                self.assertEqual(template.render(key=1), u'3')
+            self.assertIn(('less', 'x.less'), side_effects)
+
+    def persistent_fragment_test(self):
+        """Persistent fragments are reused in later builds, but aren't recorded with the pages that use them."""
+        from engineer.conf import settings
+
+        dependencies = settings.BUILD_DEPENDENCIES
+        template = settings.JINJA_ENV.get_template('fragment.html')
+        page = settings.OUTPUT_CACHE_DIR / 'index.html'
+        with dependencies.capture() as side_effects:
+            self.assertEqual(template.render(key=1), u'1')
+        self.assertEqual(sorted(kind for kind, value in side_effects), ['fragment', 'less'])
+        page.dirname().makedirs_p()
+        page.write_text(u'1')
+        dependencies.record(page, {}, side_effects)
+        dependencies.apply(side_effects)
+        self.assertEqual(dependencies._records[dependencies.key(page)]['side_effects'], [('less', 'x.less')])
+
+        # A new build
+        settings.FRAGMENT_CACHE.reset()
+        with dependencies.capture() as side_effects:
+            self.assertEqual(template.render(key=1), u'1')
+        self.assertEqual(side_effects, [('less', 'x.less')])
+        self.assertEqual(settings.FRAGMENT_CACHE.stats['persistent'], 1)
+        self.assertEqual(len(self.renders), 1)
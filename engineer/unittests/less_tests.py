@@ -0,0 +1,57 @@
+# coding=utf-8
+from tempfile import mkdtemp
+from unittest.case import TestCase
+
+from path import path
+
+from engineer.cache import SQLiteCacheStore
+from engineer.processors import LessCache, less_dependencies, parse_less_imports
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+
+class LessCacheTests(TestCase):
+    def setUp(self):
+        self.temp_dir = path(mkdtemp())
+        self.store = SQLiteCacheStore(self.temp_dir / 'engineer.cache.sqlite')
+        self.site = self.temp_dir / 'site.less'
+        self.partial = self.temp_dir / 'partials/_colors.less'
+        self.partial.dirname().makedirs()
+        self.site.write_text(u'@import "partials/_colors.less";\nbody { color: @text; }\n')
+        self.partial.write_text(u'@text: #333;\n')
+
+    def tearDown(self):
+        self.store.close()
+        self.temp_dir.rmtree(ignore_errors=True)
+
+    def parse_imports_test(self):
+        source = (u'@import "a";\n@import (reference) \'b.less\';\n@import url("c.less") screen;\n'
+                  u'@import "plain.css";\n@import (less) "d.css";\n@import (css) "e";\n'
+                  u'@import "http://example.com/f.less";\n// @import "commented";\n/* @import "g"; */\n'
+                  u'@import "h.less?v=1";\n')
+        self.assertEqual([name for name, options in parse_less_imports(source)],
+                         ['a.less', 'b.less', 'c.less', 'd.css', 'h.less?v=1'])
+
+    def dependencies_test(self):
+        """Imports are found recursively, relative to the importing file or else the compiled file."""
+        mixins = self.temp_dir / 'partials/_mixins.less'
+        mixins.write_text(u'@import "shared.less";\n@import (inline) "raw.less";\n')
+        (self.temp_dir / 'shared.less').write_text(u'@import "site.less";\n')
+        (self.temp_dir / 'partials/raw.less').write_text(u'@import "ignored";\n')
+        self.partial.write_text(u'@import "_mixins";\n@text: #333;\n')
+        self.assertEqual(less_dependencies(self.site),
+                         [self.partial, mixins, self.temp_dir / 'shared.less', self.temp_dir / 'partials/raw.less'])
+
+    def import_graph_test(self):
+        """Cached CSS is invalidated when the LESS file or anything it imports changes."""
+        cache = LessCache(self.store)
+        self.assertIsNone(cache.get(self.site, True))
+        cache.set(self.site, True, [self.partial], 'body{color:#333}')
+
+        cache = LessCache(self.store)
+        self.assertEqual(cache.get(self.site, True), 'body{color:#333}')
+        self.assertIsNone(cache.get(self.site, False))
+
+        self.partial.write_text(u'@text: #000;\n')
+        self.assertIsNone(cache.get(self.site, True))
+        self.assertEqual(cache.stats, {'hit': 1, 'miss': 2})
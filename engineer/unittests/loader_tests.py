@@ -5,6 +5,18 @@ __author__ = 'Tyler Butler <tyler@tylerbutler.com>'
 
 
 class LoaderTest(PostTestCase):
+    def setUp(self):
+        from engineer.conf import settings
+
+        super(LoaderTest, self).setUp()
+        self.build_workers = settings.BUILD_WORKERS
+
+    def tearDown(self):
+        from engineer.conf import settings
+
+        settings.BUILD_WORKERS = self.build_workers
+        super(LoaderTest, self).tearDown()
+
     def subdir_loading_test(self):
         from engineer.conf import settings
         from engineer.loaders import LocalLoader
@@ -29,3 +41,34 @@ class LoaderTest(PostTestCase):
         all_posts = PostCollection(new_posts + cached_posts)
 
         self.assertNotIn(expected_post, all_posts)
+
+    def parallel_loading_test(self):
+        from engineer.conf import settings
+        from engineer.loaders import LocalLoader
+
+        settings.BUILD_WORKERS = 2
+        parallel_posts, cached_posts = LocalLoader.load_all(settings.POST_DIR)
+        self.assertEqual(len(cached_posts), 0)
+        for post in parallel_posts:
+            self.assertIn(post.source, settings.POST_CACHE)
+
+        settings.POST_CACHE.clear()
+        settings.BUILD_WORKERS = 1
+        sequential_posts, cached_posts = LocalLoader.load_all(settings.POST_DIR)
+        self.assertEqual([p.slug for p in parallel_posts], [p.slug for p in sequential_posts])
+
+    def lazy_cached_post_test(self):
+        """The content of cached posts is only loaded when it's used."""
+        from engineer.conf import settings
+        from engineer.loaders import LocalLoader
+
+        new_posts, cached_posts = LocalLoader.load_all(settings.POST_DIR)
+        expected = dict((p.source, p.content) for p in new_posts)
+
+        settings.close_caches()
+        new_posts, cached_posts = LocalLoader.load_all(settings.POST_DIR)
+        self.assertEqual(len(new_posts), 0)
+        for post in cached_posts:
+            self.assertNotIn('content', post.__dict__)
+            self.assertEqual(post.content, expected[post.source])
+            self.assertIn('content_preprocessed', post.__dict__)
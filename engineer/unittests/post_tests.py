@@ -7,7 +7,7 @@ from path import path
 
 from engineer.exceptions import PostMetadataError
 from engineer.log import bootstrap
-from engineer.models import Post
+from engineer.models import Post, PostCollection
 from engineer.plugins import load_plugins
 from engineer.unittests import CopyDataTestCase
 
@@ -151,6 +151,25 @@ class ContentTests(PostTestCase):
 
         self.assertNotEqual(getattr(post, 'content_teaser', None), None)
 
+    def post_breaks_single_conversion_test(self):
+        """Post breaks don't convert the post to HTML twice."""
+        file = self.post_dir / 'post_breaks_simple.md'
+        convert_to_html = Post.convert_to_html
+        calls = []
+
+        def counting_convert(content):
+            calls.append(content)
+            return convert_to_html(content)
+
+        Post.convert_to_html = staticmethod(counting_convert)
+        try:
+            post = Post(file)
+        finally:
+            Post.convert_to_html = staticmethod(convert_to_html)
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(post.content.startswith(post.content_teaser))
+
     def unicode_content_test(self):
         """Unicode post content."""
         file = self.post_dir / 'unicode_content.md'
@@ -260,3 +279,96 @@ class GlobalLinksTests(PostTestCase):
 
         actual_content = unicode(post.convert_to_html(post.content_preprocessed))
         self.assertEqual(actual_content.strip(), expected_content.strip())
+
+
+class PostCollectionTests(PostTestCase):
+    def setUp(self):
+        super(PostCollectionTests, self).setUp()
+        self.single = Post(self.post_dir / 'tag_single.md')
+        self.multiple = Post(self.post_dir / 'tag_multiple.md')
+        self.numeric = Post(self.post_dir / 'numeric_tags.md')
+
+    def neighbors_test(self):
+        posts = PostCollection([self.single, self.multiple, self.numeric])
+
+        self.assertEqual(posts.position_of(self.multiple), 1)
+        self.assertEqual(posts.index(self.numeric), 2)
+        self.assertIs(posts.newer_of(self.multiple), self.single)
+        self.assertIs(posts.older_of(self.multiple), self.numeric)
+        self.assertIsNone(posts.newer_of(self.single))
+        self.assertIsNone(posts.older_of(self.numeric))
+
+    def modified_collection_test(self):
+        """The indexes are kept valid when the collection is modified."""
+        posts = PostCollection([self.single, self.multiple])
+        self.assertNotIn(self.numeric, posts)
+        self.assertEqual(posts.tagged('single'), [self.single])
+
+        posts.insert(0, self.numeric)
+        self.assertIn(self.numeric, posts)
+        self.assertEqual(posts.position_of(self.single), 1)
+
+        posts.reverse()
+        self.assertIs(posts.older_of(self.multiple), self.single)
+        self.assertIsNone(posts.position_of(Post(self.post_dir / 'published.md')))
+
+        posts.remove(self.single)
+        self.assertEqual(posts.tagged('single'), [])
+        self.assertNotIn('single', posts.all_tags)
+
+    def tagged_test(self):
+        posts = PostCollection([self.single, self.multiple, self.numeric])
+
+        self.assertEqual(posts.tagged('multiple'), [self.multiple])
+        self.assertEqual(posts.tagged('nonexistent'), [])
+        self.assertEqual(set(posts.all_tags), set(self.single.tags + self.multiple.tags + self.numeric.tags))
+
+    def parallel_rendering_test(self):
+        """Pages rendered in worker processes are the same as pages rendered sequentially."""
+        from engineer.pages import render_pages, PostPageJob, TagPageJob
+
+        posts = PostCollection([self.single, self.multiple, self.numeric])
+        jobs = [PostPageJob(post, position) for position, post in enumerate(posts)]
+        jobs.extend(TagPageJob(tag, self.copied_data_path / tag / 'index.html') for tag in posts.all_tags)
+
+        def render(workers):
+            pages = []
+            for job, staged, side_effects in render_pages(jobs, posts, workers=workers):
+                self.assertEqual(staged.output_path, job.output_path)
+                pages.append((job, staged.bytes()))
+                staged.discard()
+            return pages
+
+        self.assertEqual(render(1), render(2))
+
+    def streamed_rendering_test(self):
+        """Pages are streamed in chunks with the same content they'd have if rendered all at once."""
+        from engineer.pages import ArchivePageJob
+
+        posts = PostCollection([self.single, self.multiple, self.numeric])
+        job = ArchivePageJob()
+        job.chunk_size = 256
+        chunks = list(job.stream(posts))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), job.render(posts).encode(job.encoding))
+
+    def shared_feed_items_test(self):
+        """Each post's feed item is rendered once and shared by every feed, including tag feeds."""
+        from feedgenerator import Atom1Feed, Rss201rev2Feed
+        from engineer.conf import settings
+        from engineer.pages import FeedJob
+
+        posts = PostCollection([self.single, self.multiple, self.numeric])
+        tag = self.single.tags[0]
+        settings.FRAGMENT_CACHE.reset()
+        feed_classes = (Rss201rev2Feed, Atom1Feed)
+        feeds = [FeedJob(feed_class, self.copied_data_path / 'feed.xml', tag=tag) for feed_class in feed_classes]
+        feeds.extend(FeedJob(feed_class, self.copied_data_path / 'feed.xml') for feed_class in feed_classes)
+        rendered = [feed.render(posts) for feed in feeds]
+
+        stats = settings.FRAGMENT_CACHE.stats
+        self.assertEqual(stats['miss'] + stats['persistent'], len(FeedJob.templates) * len(posts))
+        self.assertEqual(feeds[0].posts(posts), posts.tagged(tag))
+        for post in posts:
+            self.assertIn(post.absolute_url, rendered[2])
+            self.assertEqual(post.absolute_url in rendered[0], post in posts.tagged(tag))
@@ -0,0 +1,60 @@
+# coding=utf-8
+import time
+from unittest import TestCase
+
+from jinja2 import DictLoader, Environment, Template
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.env = Environment(loader=DictLoader({
+            'base.html': u"<{% block body %}base{% endblock %}>",
+            'child.html': u"{% extends 'base.html' %}{% block body %}{{ super() }} {{ slow() }}{% endblock %}",
+        }))
+        self.env.globals['slow'] = lambda: time.sleep(0.05) or 'child'
+
+    def template_timing_test(self):
+        """Templates are timed by name, and blocks are timed as part of the template that defines them."""
+        from engineer.profiling import BuildProfile
+
+        profile = BuildProfile(hooks=True)
+        profile.start(self.env, 'render')
+        self.assertEqual(self.env.get_template('child.html').render(), u'<base child>')
+        self.assertEqual(self.env.get_template('child.html').render(), u'<base child>')
+        results = profile.stop()
+
+        self.assertIs(self.env.template_class, Template)
+        self.assertEqual(results['stages'][0][0], 'render')
+        child, base = results['templates']['child.html'], results['templates']['base.html']
+        self.assertEqual((child['renders'], base['renders']), (2, 2))
+        self.assertGreaterEqual(child['self_seconds'], 0.1)
+        self.assertLess(base['self_seconds'], 0.05)
+        # The child's render includes its parent's, which includes the child's block
+        self.assertAlmostEqual(child['seconds'], child['self_seconds'] + base['self_seconds'], delta=0.01)
+        self.assertGreaterEqual(base['seconds'], 0.1)
+
+        # Once the profile is stopped, nothing is timed
+        self.env.get_template('child.html').render()
+        self.assertEqual(profile.templates['child.html']['renders'], 2)
+
+    def timed_test(self):
+        """Blocks are only timed while a profile that times plugin hooks is active."""
+        from engineer.profiling import timed, BuildProfile
+
+        with timed('plugins', 'hook'):
+            pass
+
+        profile = BuildProfile()
+        profile.start(self.env)
+        with timed('plugins', 'hook'):
+            pass
+        self.assertEqual(profile.stop()['plugins'], {})
+
+        profile = BuildProfile(hooks=True)
+        profile.start(self.env)
+        for _ in range(2):
+            with timed('plugins', 'hook'):
+                pass
+        self.assertEqual(profile.stop()['plugins']['hook']['calls'], 2)
@@ -0,0 +1,79 @@
+# coding=utf-8
+import gzip
+import os
+from datetime import datetime, timedelta
+
+from path import path
+
+from engineer.log import bootstrap
+from engineer.unittests import CopyDataTestCase
+
+__author__ = 'Tyler Butler <tyler@tylerbutler.com>'
+
+test_data_root = path(__file__).dirname() / 'test_data'
+
+
+class SitemapTests(CopyDataTestCase):
+    def setUp(self):
+        from engineer.cache import OutputManifest, SQLiteCacheStore
+        from engineer.conf import settings
+
+        bootstrap()
+        self.source_path = test_data_root
+        os.chdir(self.copied_data_path)
+        settings.reload(self.copied_data_path / 'post_tests/configs/settings.yaml')
+        self.output_dir = self.copied_data_path / 'sitemap_output'
+        self.store = SQLiteCacheStore(self.copied_data_path / 'sitemap.cache.sqlite')
+        self.outputs = OutputManifest(self.store, self.output_dir)
+
+    def tearDown(self):
+        self.store.close()
+        super(SitemapTests, self).tearDown()
+
+    @staticmethod
+    def entries(count):
+        return [(u'http://example.com/%d/' % i, datetime(2014, 1, 1) + timedelta(days=i), 'yearly', '0.5')
+                for i in range(count)]
+
+    def split_test(self):
+        """Sitemaps are split into several files listed in a sitemap index at the limits."""
+        from engineer.sitemap import write_sitemaps
+
+        written = write_sitemaps(self.outputs, self.entries(5), self.output_dir, max_urls=2)
+        self.assertEqual([p.name for p in written], ['sitemap-1.xml.gz', 'sitemap-2.xml.gz', 'sitemap-3.xml.gz',
+                                                     'sitemap.xml', 'sitemap.xml.gz'])
+        index = (self.output_dir / 'sitemap.xml').bytes()
+        self.assertEqual(index.count('<sitemap>'), 3)
+        self.assertIn('/sitemap-3.xml.gz</loc>\n        <lastmod>2014-01-05T00:00Z</lastmod>', index)
+        self.assertEqual(gzip.open(self.output_dir / 'sitemap.xml.gz').read(), index)
+        shard = gzip.open(self.output_dir / 'sitemap-3.xml.gz').read()
+        self.assertEqual(shard.count('<url>'), 1)
+        self.assertTrue(shard.endswith('</urlset>\n'))
+
+        # Files are split by size too
+        written = write_sitemaps(self.outputs, self.entries(4), self.output_dir, max_bytes=400)
+        self.assertEqual(len(written), 4 + 2)
+
+        # Unchanged files aren't written again
+        self.outputs.reset()
+        written = write_sitemaps(self.outputs, self.entries(2), self.output_dir)
+        self.assertEqual([p.name for p in written], ['sitemap.xml.gz'])
+        self.assertEqual(gzip.open(written[0]).read().count('<url>'), 2)
+        self.outputs.reset()
+        write_sitemaps(self.outputs, self.entries(2), self.output_dir)
+        self.assertEqual(self.outputs.stats, {'written': 0, 'unchanged': 1})
+
+    def lastmod_test(self):
+        """Dates only change when the content at a URL does."""
+        from engineer.sitemap import SitemapDates
+
+        published = datetime(2014, 1, 1)
+        dates = SitemapDates(self.store)
+        self.assertEqual(dates.lastmod('/post/', 'a', published), published)
+        self.assertEqual(dates.lastmod('/page/', 'b'), dates.now)
+        dates.save()
+
+        dates = SitemapDates(self.store)
+        dates.now = datetime(2015, 1, 1)
+        self.assertEqual(dates.lastmod('/post/', 'a', published), published)
+        self.assertEqual(dates.lastmod('/page/', 'c'), datetime(2015, 1, 1))
@@ -5,8 +5,11 @@ import filecmp
 import hashlib
 import itertools
 import logging
+import multiprocessing
+import os
 import posixpath
 import re
+import shutil
 from itertools import chain, islice
 import urlparse
 
@@ -77,6 +80,12 @@ def chunk(seq, chunksize, process=iter):
         yield process(chain([it.next()], islice(it, chunksize - 1)))
 
 
+def worker_count(workers):
+    """Returns the number of worker processes to use for *workers*; ``0`` or less means one per CPU."""
+    workers = int(workers)
+    return workers if workers > 0 else multiprocessing.cpu_count()
+
+
 def expand_path(path_list, root_path=None):
     """
     Given a list of paths, returns a list of all parent paths (including the original paths).
@@ -189,7 +198,7 @@ def mirror_folder(source, target, delete_orphans=True, recurse=True, ignore_list
     for item in compare.diff_files:
         logger.debug(
             "Overwriting existing file %s ==> %s" % ((d1 / item), (d2 / item)))
-        (d1 / item).copy2(d2)
+        transfer_file(d1 / item, d2 / item)
         report['overwritten'].add(d2 / item)
 
     # Recurse into subfolders that exist in both the source and target
@@ -202,6 +211,192 @@ def mirror_folder(source, target, delete_orphans=True, recurse=True, ignore_list
     return report
 
 
+PUBLISH_STRATEGIES = ('copy', 'hardlink', 'reflink', 'rename-swap')
+
+# The Linux ioctl that clones a file's extents into another file, i.e. makes a copy-on-write copy
+_FICLONE = 0x40049409
+
+
+def _reflink(source, target):
+    import fcntl
+
+    with open(source, 'rb') as s:
+        with open(target, 'wb') as t:
+            fcntl.ioctl(t.fileno(), _FICLONE, s.fileno())
+    shutil.copystat(source, target)
+
+
+def transfer_file(source, target, strategy='copy'):
+    """
+    Puts a copy of the file *source* at *target*, replacing any file already there. Depending on *strategy*, the copy
+    is a hard link to *source* (``'hardlink'``), a copy-on-write clone of it (``'reflink'``), or a regular copy
+    (``'copy'``). If the file system doesn't support links or clones, the file is copied instead. Returns the method
+    that was actually used.
+    """
+    source = path(source)
+    target = path(target)
+    # Files are replaced rather than overwritten so that writing to a linked file never changes the other link
+    if target.isfile() or target.islink():
+        target.remove()
+    if strategy in ('hardlink', 'rename-swap'):
+        try:
+            source.link(target)
+            return 'hardlink'
+        except (AttributeError, OSError):
+            pass
+    elif strategy == 'reflink':
+        try:
+            _reflink(source, target)
+            return 'reflink'
+        except (ImportError, IOError, OSError):
+            target.remove_p()
+    source.copy2(target)
+    return 'copy'
+
+
+def sync_folder(manifest, target, ignore_list=None, changes=None, strategy='copy'):
+    """
+    Publishes the folder tracked by an :class:`~engineer.cache.OutputManifest` to a target folder *target*.
+
+    Unlike :func:`mirror_folder`, neither folder is walked or compared; the files to copy and delete are taken from
+    the manifest's :meth:`~engineer.cache.OutputManifest.changes`, or from *changes* if it is passed in. Files that
+    were published before but have since been deleted or edited in *target* are copied again. Paths in
+    *ignore_list*, which are relative to *target*, are never overwritten or deleted. Returns a report in the same
+    form as :func:`mirror_folder`, including the directories that were created or removed.
+
+    Files are put in *target* using :func:`transfer_file` with the given *strategy*, except for ``'rename-swap'``. In
+    that case a complete copy of the folder is assembled next to *target* using hard links, then swapped into place
+    by renaming it; see :func:`swap_folder`.
+    """
+    logger = logging.getLogger('engineer.util.sync_folder')
+
+    source = manifest.root
+    target = path(target).normpath()
+    if changes is None:
+        changes = manifest.changes(target)
+    ignore_list = [path(target / i).normpath() for i in (ignore_list or [])]
+
+    def is_ignored(p):
+        return any(p == i or p.startswith(i + os.sep) for i in ignore_list)
+
+    report = {
+        'deleted': set([]),
+        'overwritten': set([]),
+        'new': set([])
+    }
+    to_copy = []
+    copied = set()
+    for kind in ('deleted', 'overwritten', 'new'):
+        for key in sorted(changes[kind]):
+            fullpath = path(target / key).normpath()
+            if is_ignored(fullpath):
+                logger.debug("%s ==> Ignored - path is in ignore list" % fullpath)
+                continue
+            report[kind].add(fullpath)
+            if kind != 'deleted':
+                to_copy.append((source / key, fullpath))
+                copied.add(key)
+
+    if strategy == 'rename-swap':
+        keys = manifest.recorded_keys()
+        directories = set()
+        for key in keys:
+            parent = path(target / key).normpath().dirname()
+            while parent != target and parent not in directories:
+                directories.add(parent)
+                parent = parent.dirname()
+        if target.isdir():
+            existing = set(d.normpath() for d in target.walkdirs() if not is_ignored(d.normpath()))
+        else:
+            existing = set()
+        report['new'].update(directories - existing)
+        report['deleted'].update(existing - directories)
+        swap_folder(source, keys, target, ignore_list)
+        manifest.mark_published(target, set(keys))
+        return report
+
+    # Delete first, in case a deleted file is in the way of a new directory
+    for fullpath in sorted(report['deleted']):
+        if fullpath.isfile():
+            logger.debug("%s ==> Deleted - doesn't exist in source" % fullpath)
+            fullpath.remove()
+            parent = fullpath.dirname()
+            while parent != target and parent.isdir() and not parent.listdir():
+                parent.rmdir()
+                report['deleted'].add(parent)
+                parent = parent.dirname()
+
+    for directory in sorted(set(t.dirname() for s, t in to_copy)):
+        parent = directory
+        while parent != target and not parent.isdir():
+            report['new'].add(parent)
+            parent = parent.dirname()
+        directory.makedirs_p()
+    fallbacks = 0
+    for s, t in to_copy:
+        logger.debug("Copying %s ==> %s" % (s, t))
+        if transfer_file(s, t, strategy) != strategy:
+            fallbacks += 1
+    if strategy != 'copy' and fallbacks:
+        logger.warning("Couldn't use the '%s' publish strategy for %d files; they were copied instead." %
+                       (strategy, fallbacks))
+
+    manifest.mark_published(target, copied)
+    return report
+
+
+def swap_folder(source, keys, target, ignore_list=None):
+    """
+    Replaces the folder *target* with a new folder containing the files in *source* with the relative paths in *keys*.
+
+    The new folder is assembled next to *target* using hard links where possible, so the files aren't copied, and
+    then renamed to *target*. The previous contents of *target* remain in place until the new folder is complete, so a
+    build that dies while publishing doesn't leave a half-written site behind. Paths in *ignore_list*, which must be
+    absolute paths inside *target*, are moved into the new folder.
+    """
+    logger = logging.getLogger('engineer.util.swap_folder')
+
+    source = path(source)
+    target = path(target).abspath()
+    staging = target.dirname() / ('.%s.staging' % target.basename())
+    previous = target.dirname() / ('.%s.previous' % target.basename())
+    ignore_list = ignore_list or []
+
+    def move_ignored(from_dir, to_dir):
+        for ignored in ignore_list:
+            ignored = path(ignored).abspath()
+            moved = from_dir / target.relpathto(ignored)
+            if moved.exists():
+                destination = to_dir / target.relpathto(ignored)
+                if destination.isdir():
+                    destination.rmtree()
+                elif destination.exists():
+                    destination.remove()
+                destination.dirname().makedirs_p()
+                moved.rename(destination)
+
+    # Finish a swap that a previous build didn't complete
+    if previous.exists():
+        if not target.exists():
+            previous.rename(target)
+        else:
+            move_ignored(previous, target)
+            previous.rmtree()
+
+    staging.rmtree_p()
+    for key in keys:
+        staged = staging / key
+        staged.dirname().makedirs_p()
+        transfer_file(source / key, staged, 'hardlink')
+
+    logger.debug("Swapping %s into place as %s." % (staging, target))
+    if target.exists():
+        target.rename(previous)
+    staging.rename(target)
+    move_ignored(previous, target)
+    previous.rmtree_p()
+
+
 def ensure_exists(p, assume_dirs=False):
     """
     Ensures a given path *p* exists.